@@ -0,0 +1,364 @@
+"""Benchmarks of MongoQueryAggregator, Bulk and BulkOperator against the
+in-process FakeMongo.
+
+    $ python -m benchmarks.bench --ops 100000
+    $ python -m benchmarks.bench --save-baseline baseline.json
+    $ python -m benchmarks.bench --compare baseline.json --tolerance 0.1
+    $ python -m benchmarks.bench aggregator_threaded --threads 8 --latency 0.002
+
+With --compare the exit status is 1 if any scenario regressed more than
+`tolerance` against the baseline.
+"""
+from __future__ import print_function
+from moquag.main import MongoQueryAggregator, Bulk, BulkOperator
+from moquag.retry import RetryPolicy
+from moquag.adaptive import AdaptiveBatchController
+from moquag.backends import EncodedBulkWriteBackend
+from .fake import FakeMongo, FakeCollection
+from time import time
+import threading
+import argparse
+import json
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# metric name: True if higher is better
+COMPARED_METRICS = {
+    'ops_per_sec': True,
+    'flush_p50': False,
+    'flush_p99': False,
+    'peak_memory': False,
+    'bytes_per_op': False,
+}
+
+
+def operator_insert(mongo, batch_size, **options):
+    state = {'operator': None}
+
+    def new_operator():
+        state['operator'] = BulkOperator(FakeCollection(mongo, 'bench', 'coll'),
+                                         backend=mongo, **options)
+
+    def enqueue(i):
+        state['operator'].insert({'i': i, 'name': 'user'})
+        if state['operator'].total_ops >= batch_size:
+            flush()
+
+    def flush():
+        state['operator'].execute()
+        new_operator()
+
+    new_operator()
+    return enqueue, flush
+
+
+def bulk_update(mongo, batch_size, **options):
+    bulk = Bulk(mongo, 'bench', {}, batch_size, ordered=False, backend=mongo, **options)
+
+    def enqueue(i):
+        bulk.coll.find({'i': i % 1000}).upsert().update_one({'$inc': {'count': 1}})
+
+    return enqueue, bulk.execute
+
+
+def aggregator_insert(mongo, batch_size, **options):
+    aggregator = MongoQueryAggregator({}, 3600, batch_size, backend=mongo, **options)
+
+    def enqueue(i):
+        aggregator.bench['coll{}'.format(i % 4)].insert({'i': i, 'name': 'user'})
+
+    return enqueue, aggregator.execute
+
+
+def aggregator_handle(mongo, batch_size, **options):
+    aggregator = MongoQueryAggregator({}, 3600, batch_size, backend=mongo, **options)
+    writers = [aggregator.collection('bench', 'coll{}'.format(i)) for i in range(4)]
+
+    def enqueue(i):
+        writers[i % 4].insert({'i': i, 'name': 'user'})
+
+    return enqueue, aggregator.execute
+
+
+def aggregator_insert_many(mongo, batch_size, **options):
+    aggregator = MongoQueryAggregator({}, 3600, batch_size, backend=mongo, **options)
+    writer = aggregator.collection('bench', 'coll')
+    pending = []
+
+    def enqueue(i):
+        pending.append({'i': i, 'name': 'user'})
+        if len(pending) == 100:
+            writer.insert_many(pending)
+            del pending[:]
+
+    def flush():
+        writer.insert_many(pending)
+        del pending[:]
+        aggregator.execute()
+
+    return enqueue, flush
+
+
+def aggregator_encoded(mongo, batch_size, **options):
+    mongo.backend = EncodedBulkWriteBackend
+    return aggregator_insert(mongo, batch_size, **options)
+
+
+def aggregator_mixed(mongo, batch_size, **options):
+    aggregator = MongoQueryAggregator({}, 3600, batch_size, backend=mongo, **options)
+
+    def enqueue(i):
+        if i % 2:
+            aggregator.bench.coll.insert({'i': i})
+        else:
+            aggregator.bench.coll.find({'i': i}).upsert().update({'$set': {'seen': True}})
+
+    return enqueue, aggregator.execute
+
+
+def aggregator_coalesce(mongo, batch_size, **options):
+    aggregator = MongoQueryAggregator({}, 3600, batch_size, backend=mongo,
+                                      ordered=False, coalesce=True, **options)
+
+    def enqueue(i):
+        aggregator.bench.counters.find({'_id': i % 100}).upsert().update_one(
+            {'$inc': {'hits': 1}})
+
+    return enqueue, aggregator.execute
+
+
+def aggregator_sorted(mongo, batch_size, **options):
+    aggregator = MongoQueryAggregator({}, 3600, batch_size, backend=mongo,
+                                      ordered=False, sort_key='id', **options)
+
+    def enqueue(i):
+        # ids in random order, as upserts of user events arrive
+        key = i * 2654435761 % 4294967296
+        if i % 2:
+            aggregator.bench.coll.insert({'id': key})
+        else:
+            aggregator.bench.coll.find({'id': key}).upsert().update_one({'$set': {'seen': True}})
+
+    return enqueue, aggregator.execute
+
+
+def aggregator_dedupe(mongo, batch_size, **options):
+    aggregator = MongoQueryAggregator({}, 3600, batch_size, backend=mongo, dedupe_key='_id',
+                                      dedupe_filter_capacity=100000, **options)
+
+    def enqueue(i):
+        # every message is redelivered once, a few operations later
+        aggregator.bench.events.insert({'_id': i // 2 + i % 2 * 8, 'name': 'event'})
+
+    return enqueue, aggregator.execute
+
+
+def aggregator_counter(mongo, batch_size, **options):
+    aggregator = MongoQueryAggregator({}, 3600, batch_size, backend=mongo, **options)
+
+    def enqueue(i):
+        aggregator.counter('bench', 'counters', {'_id': i % 100}).incr('hits')
+
+    return enqueue, aggregator.execute
+
+
+def aggregator_threaded(mongo, batch_size, **options):
+    aggregator = MongoQueryAggregator({}, 3600, batch_size, backend=mongo,
+                                      thread_safe=True, **options)
+
+    def enqueue(i):
+        aggregator.bench['coll{}'.format(i % 8)].insert({'i': i, 'name': 'user'})
+
+    return enqueue, aggregator.execute
+
+# scenarios whose enqueue may be called from several threads
+aggregator_threaded.thread_safe = True
+
+
+def aggregator_bytes(mongo, batch_size, **options):
+    return aggregator_insert(mongo, batch_size, max_batch_bytes=batch_size * 64, **options)
+
+
+def aggregator_adaptive(mongo, batch_size, **options):
+    controller = AdaptiveBatchController(target_latency=0.01, min_batch_size=10)
+    return aggregator_insert(mongo, batch_size, batch_controller=controller, **options)
+
+
+SCENARIOS = {
+    'operator_insert': operator_insert,
+    'bulk_update': bulk_update,
+    'aggregator_insert': aggregator_insert,
+    'aggregator_mixed': aggregator_mixed,
+    'aggregator_coalesce': aggregator_coalesce,
+    'aggregator_sorted': aggregator_sorted,
+    'aggregator_dedupe': aggregator_dedupe,
+    'aggregator_counter': aggregator_counter,
+    'aggregator_bytes': aggregator_bytes,
+    'aggregator_adaptive': aggregator_adaptive,
+    'aggregator_handle': aggregator_handle,
+    'aggregator_insert_many': aggregator_insert_many,
+    'aggregator_encoded': aggregator_encoded,
+    'aggregator_threaded': aggregator_threaded,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def new_mongo(args):
+    return FakeMongo(latency=args.latency, jitter=args.jitter,
+                     error_rate=args.error_rate, seed=args.seed)
+
+
+def get_options(args):
+    # injected errors are retried and dead lettered instead of raised
+    if not args.error_rate:
+        return {}
+    return {'retry_policy': RetryPolicy(max_retries=args.max_retries, backoff=0,
+                                        dead_letter=lambda *error: None)}
+
+
+def run_producers(enqueue, ops, threads):
+    # producer number n enqueues ops n, n + threads, ...
+    if threads == 1:
+        for i in range(ops):
+            enqueue(i)
+        return
+
+    def produce(first):
+        for i in range(first, ops, threads):
+            enqueue(i)
+    producers = [threading.Thread(target=produce, args=(first,)) for first in range(threads)]
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+
+
+def run_scenario(scenario, args):
+    """returns dict of metrics of one scenario"""
+    mongo = new_mongo(args)
+    enqueue, flush = scenario(mongo, args.batch_size, **get_options(args))
+    started = time()
+    run_producers(enqueue, args.ops, args.threads)
+    enqueue_seconds = time() - started
+    flush()
+    total_seconds = time() - started
+    latencies = mongo.flush_latencies
+    result = {
+        'ops_per_sec': args.ops / max(enqueue_seconds, 1e-9),
+        'total_seconds': total_seconds,
+        'flushes': len(latencies),
+        'flush_p50': percentile(latencies, 0.5),
+        'flush_p90': percentile(latencies, 0.9),
+        'flush_p99': percentile(latencies, 0.99),
+        'flush_max': max(latencies) if latencies else 0.0,
+    }
+    if tracemalloc is not None:
+        result.update(measure_memory(scenario, args))
+    return result
+
+
+def measure_memory(scenario, args):
+    # peak memory of a batched run, and bytes retained per buffered op by
+    # a run which never flushes
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        enqueue, flush = scenario(new_mongo(args), args.batch_size, **get_options(args))
+        for i in range(args.ops):
+            enqueue(i)
+        flush()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        del enqueue, flush
+        buffered_ops = min(args.ops, args.memory_ops)
+        base = tracemalloc.get_traced_memory()[0]
+        enqueue, flush = scenario(new_mongo(args), buffered_ops + 1, **get_options(args))
+        for i in range(buffered_ops):
+            enqueue(i)
+        retained = tracemalloc.get_traced_memory()[0] - base
+        flush()
+    finally:
+        tracemalloc.stop()
+    return {'peak_memory': peak, 'bytes_per_op': retained / float(buffered_ops)}
+
+
+def compare(results, baseline, tolerance):
+    """returns list of regression messages of results against baseline"""
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        for metric, higher_is_better in sorted(COMPARED_METRICS.items()):
+            if metric not in metrics or not baseline.get(name, {}).get(metric):
+                continue
+            old, new = baseline[name][metric], metrics[metric]
+            change = (new - old) / float(old)
+            if (higher_is_better and change < -tolerance) or \
+                    (not higher_is_better and change > tolerance):
+                regressions.append('{} {}: {:.6g} -> {:.6g} ({:+.1%})'.format(
+                    name, metric, old, new, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run, default all of: {}'.format(
+                            ', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--ops', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--memory-ops', type=int, default=10000,
+                        help='ops buffered to measure bytes_per_op')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated seconds per bulk_write')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability of a write error per op, failed ops '
+                             'are retried with a RetryPolicy')
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=1,
+                        help='producer threads, only thread safe scenarios run '
+                             'with more than one')
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+    names = args.scenarios or sorted(SCENARIOS)
+    if args.threads > 1:
+        names = [name for name in names
+                 if getattr(SCENARIOS[name], 'thread_safe', False)]
+
+    results = {}
+    for name in names:
+        results[name] = run_scenario(SCENARIOS[name], args)
+        metrics = results[name]
+        print('{:<24} {:>12.0f} ops/s  p50 {:.6f}s  p99 {:.6f}s  peak {} B  {} B/op'.format(
+            name, metrics['ops_per_sec'], metrics['flush_p50'], metrics['flush_p99'],
+            metrics.get('peak_memory', '-'),
+            '{:.0f}'.format(metrics['bytes_per_op']) if 'bytes_per_op' in metrics else '-'))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
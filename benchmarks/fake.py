@@ -0,0 +1,151 @@
+from pymongo.errors import BulkWriteError, AutoReconnect
+from pymongo.operations import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.results import BulkWriteResult
+from bson import BSON
+from moquag.backends import BulkWriteBackend
+from collections import deque
+from time import sleep, time
+import threading
+import random
+
+
+class FakeDatabase(object):
+
+    def __init__(self, mongo, name):
+        self.mongo = mongo
+        self.name = name
+
+    def __getitem__(self, name):
+        return FakeCollection(self.mongo, self.name, name)
+
+
+class FakeCollection(object):
+
+    def __init__(self, mongo, db_name, name):
+        """In-process stand in for a pymongo Collection, only bulk_write and
+        with_options are implemented. Behaviour is configured on `mongo`.
+        """
+        self.mongo = mongo
+        self.database = FakeDatabase(mongo, db_name)
+        self.name = name
+        self.write_concern = None
+
+    def with_options(self, write_concern=None, **kwargs):
+        collection = FakeCollection(self.mongo, self.database.name, self.name)
+        collection.write_concern = write_concern
+        return collection
+
+    def bulk_write(self, requests, ordered=True, bypass_document_validation=False):
+        mongo = self.mongo
+        if mongo.latency or mongo.jitter:
+            sleep(mongo.latency + mongo.random.uniform(0, mongo.jitter))
+        if mongo.random.random() < mongo.connection_error_rate:
+            raise AutoReconnect('fake connection error')
+        result = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0,
+                  'nRemoved': 0, 'upserted': [], 'writeErrors': [],
+                  'writeConcernErrors': []}
+        for index, request in enumerate(requests):
+            if mongo.encode:
+                # the driver encodes every document sent
+                for document in get_request_documents(request):
+                    BSON.encode(document)
+            if mongo.random.random() < mongo.error_rate:
+                code = mongo.random.choice(mongo.error_codes)
+                result['writeErrors'].append({'index': index, 'code': code,
+                                              'errmsg': 'fake error {}'.format(code)})
+                if ordered:
+                    break
+                continue
+            if isinstance(request, InsertOne):
+                result['nInserted'] += 1
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                result['nRemoved'] += 1
+            elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                result['nMatched'] += 1
+                result['nModified'] += 1
+        mongo.record(len(requests))
+        mongo.recent_writes.append({
+            'db': self.database.name, 'collection': self.name, 'ops': len(requests),
+            'ordered': ordered, 'bypass_document_validation': bypass_document_validation,
+            'write_concern': self.write_concern and self.write_concern.document})
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+
+def get_request_documents(request):
+    documents = []
+    for attribute in ('_filter', '_doc'):
+        document = getattr(request, attribute, None)
+        if document is not None:
+            documents.append(document)
+    return documents
+
+
+class FakeMongo(object):
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 connection_error_rate=0.0, error_codes=(91, 11000), seed=None,
+                 encode=True, backend=BulkWriteBackend):
+        """Fake MongoDB for benchmarks and tests, pass an instance as the
+        `backend` of MongoQueryAggregator, Bulk or BulkOperator, it can also
+        stand in for the MongoClient of a Bulk. Every backend it creates is
+        a real `backend` writing to a FakeCollection, and every send is
+        timed.
+        :Parameters:
+          - `latency` (optional): seconds every bulk_write takes.
+          - `jitter` (optional): max random seconds added to `latency`.
+          - `error_rate` (optional): probability of a write error per
+            operation, the code is picked from `error_codes`.
+          - `connection_error_rate` (optional): probability of an
+            AutoReconnect per bulk_write.
+          - `error_codes` (optional): codes of injected write errors,
+            default mixes a transient and a permanent one.
+          - `seed` (optional): seed of the random generator.
+          - `encode` (optional): BSON encode every request document as the
+            driver does.
+          - `backend` (optional): backend class writing to the
+            FakeCollections.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.connection_error_rate = connection_error_rate
+        self.error_codes = error_codes
+        self.random = random.Random(seed)
+        self.encode = encode
+        self.backend = backend
+        self.flush_latencies = []
+        self.bulk_writes = 0
+        self.written_ops = 0
+        # options of the last bulk_writes
+        self.recent_writes = deque(maxlen=1000)
+        self.__lock = threading.Lock()
+
+    def __call__(self, collection, ordered=False, bypass_document_validation=False):
+        fake_collection = FakeCollection(self, collection.database.name, collection.name)
+        backend = self.backend(fake_collection, ordered, bypass_document_validation)
+        send = backend.send
+
+        def timed_send(operations, write_concern=None):
+            started = time()
+            try:
+                return send(operations, write_concern)
+            finally:
+                self.record_latency(time() - started)
+
+        backend.send = timed_send
+        return backend
+
+    def __getitem__(self, db_name):
+        return FakeDatabase(self, db_name)
+
+    def record(self, ops):
+        with self.__lock:
+            self.bulk_writes += 1
+            self.written_ops += ops
+
+    def record_latency(self, seconds):
+        with self.__lock:
+            self.flush_latencies.append(seconds)
+
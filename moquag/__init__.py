@@ -1 +1,5 @@
-from .main import MongoQueryAggregator
\ No newline at end of file
+from .main import MongoQueryAggregator
+from .retry import RetryPolicy, SpoolDeadLetter
+from .backpressure import BufferFullError
+from .adaptive import AdaptiveBatchController
+from .policies import WritePolicy, WritePolicyRegistry
@@ -0,0 +1,124 @@
+from time import time
+import threading
+
+
+class CollectionTuning(object):
+
+    def __init__(self, batch_size, interval):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.latency = None
+        self.op_latency = None
+        self.op_rate = None
+        self.last_flush_time = None
+
+
+class AdaptiveBatchController(object):
+
+    def __init__(self, target_latency=0.1, min_batch_size=100,
+                 max_batch_size=100000, min_interval=0.01, max_interval=None,
+                 flush_load=0.1, smoothing=0.3):
+        """Tunes batch size and flush interval of every collection from the
+        latency and op rate of its flushes, pass it as `batch_controller` of
+        MongoQueryAggregator.
+        The batch size moves towards the number of operations a flush can
+        send within `target_latency`, by at most a factor 2 per flush, so hot
+        collections get batches as big as the target allows. A collection
+        whose op rate fills batches faster than flushes of `flush_load` of
+        its time can send them gets bigger batches, beyond the target. The
+        flush interval is the time keeping flushes of a collection below
+        `flush_load` of its time, so collections with cheap flushes, which
+        rarely fill a batch, are flushed after a short delay.
+        :Parameters:
+          - `target_latency` (optional): seconds a flush should take.
+            Default is ``0.1``.
+          - `min_batch_size`, `max_batch_size` (optional): bounds of batch
+            sizes. Default is ``100`` and ``100000``.
+          - `min_interval`, `max_interval` (optional): bounds of flush
+            intervals in seconds, `max_interval` is set to the interval of
+            the aggregator if ``None``. Default is ``0.01`` and ``None``.
+          - `flush_load` (optional): fraction of time a collection may spend
+            flushing. Default is ``0.1``.
+          - `smoothing` (optional): weight of the newest flush in the moving
+            averages of latencies and op rates. Default is ``0.3``.
+        """
+        self.target_latency = target_latency
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.flush_load = flush_load
+        self.smoothing = smoothing
+        self.__collections = {}
+        self.__lock = threading.Lock()
+
+    def __clamp(self, value, lower, upper):
+        if upper is not None:
+            value = min(value, upper)
+        return max(value, lower)
+
+    def __average(self, average, value):
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def __get_tuning(self, key, batch_size, interval):
+        tuning = self.__collections.get(key)
+        if tuning is None:
+            tuning = CollectionTuning(
+                int(self.__clamp(batch_size, self.min_batch_size, self.max_batch_size)),
+                self.__clamp(interval, self.min_interval, self.max_interval))
+            self.__collections[key] = tuning
+        return tuning
+
+    def get_limits(self, db_name, collection, batch_size, interval):
+        """returns (batch_size, interval) of a collection, `batch_size` and
+        `interval` are the initial values of a new one
+        """
+        with self.__lock:
+            tuning = self.__get_tuning((db_name, collection), batch_size, interval)
+            return tuning.batch_size, tuning.interval
+
+    def record_flush(self, db_name, collection, seconds, enqueued, ops,
+                     size=None, result=None):
+        """Adapt the limits of a collection to a flush, same arguments as
+        FlushMetrics.record_flush, failed flushes are ignored
+        """
+        if result is None or not ops:
+            return
+        now = time()
+        with self.__lock:
+            tuning = self.__collections.get((db_name, collection))
+            if tuning is None:
+                return
+            tuning.latency = self.__average(tuning.latency, seconds)
+            tuning.op_latency = self.__average(tuning.op_latency, seconds / float(ops))
+            if tuning.last_flush_time is not None and now > tuning.last_flush_time:
+                tuning.op_rate = self.__average(
+                    tuning.op_rate, enqueued / (now - tuning.last_flush_time))
+            tuning.last_flush_time = now
+            if tuning.op_latency > 0:
+                desired = self.target_latency / tuning.op_latency
+                if tuning.op_rate is not None:
+                    # batches filled at op_rate are flushed every
+                    # batch_size / op_rate seconds, each taking latency
+                    desired = max(desired, tuning.op_rate * tuning.latency / self.flush_load)
+                factor = self.__clamp(desired / tuning.batch_size, 0.5, 2.0)
+                tuning.batch_size = int(self.__clamp(tuning.batch_size * factor,
+                                                     self.min_batch_size,
+                                                     self.max_batch_size))
+            tuning.interval = self.__clamp(tuning.latency / self.flush_load,
+                                           self.min_interval, self.max_interval)
+
+    def get_stats(self):
+        """returns dict keyed by (db_name, collection) of dicts with the
+        current batch_size and interval, and the averaged latency, op_latency
+        and op_rate
+        """
+        with self.__lock:
+            return dict((key, {'batch_size': tuning.batch_size,
+                               'interval': tuning.interval,
+                               'latency': tuning.latency,
+                               'op_latency': tuning.op_latency,
+                               'op_rate': tuning.op_rate})
+                        for key, tuning in self.__collections.items())
@@ -0,0 +1,281 @@
+from pymongo.errors import BulkWriteError
+from pymongo.operations import InsertOne
+from collections import Counter
+from time import time
+import asyncio
+import traceback
+import sys
+from .main import get_result_counter, update_results
+from .operations import BulkWriteOperation, to_request
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+
+class AsyncBulkOperator(object):
+
+    def __init__(self, collection, ordered=False,
+                 bypass_document_validation=False):
+        """Initialize a new AsyncBulkOperator, it buffers operations as
+        :mod:`pymongo.operations` requests and sends them with an awaitable
+        ``collection.bulk_write``.
+        :Parameters:
+          - `collection`: A motor collection or any object having a
+            coroutine ``bulk_write(requests, ordered, bypass_document_validation)``.
+          - `ordered` (optional): If ``True`` operations are executed serially
+            and execution aborts on the first error.
+          - `bypass_document_validation`: (optional) If ``True``, allows the
+            write to opt-out of document level validation.
+        """
+        self.collection = collection
+        self.ordered = ordered
+        self.bypass_document_validation = bypass_document_validation
+        self.requests = []
+        self.find_count = 0
+        self.insert_count = 0
+        self.total_ops = 0
+
+    def find(self, selector):
+        """Specify selection criteria for bulk operations.
+        :Returns:
+          - A :class:`BulkWriteOperation` instance
+        """
+        self.find_count += 1
+        self.total_ops += 1
+        return BulkWriteOperation(selector, self.__add_operation)
+
+    def __add_operation(self, op, selector, document, upsert):
+        self.requests.append(to_request(op, selector, document, upsert))
+
+    def insert(self, document):
+        """Insert a single document."""
+        self.insert_count += 1
+        self.total_ops += 1
+        self.requests.append(InsertOne(document))
+
+    async def execute(self):
+        """Send all buffered requests with a single bulk_write, returns an
+        empty Counter if no requests are buffered."""
+        if not self.requests:
+            return Counter()
+        ret = await self.collection.bulk_write(
+            self.requests, ordered=self.ordered,
+            bypass_document_validation=self.bypass_document_validation)
+        return get_result_counter(ret.bulk_api_result)
+
+    def __str__(self):
+        s = '"BOFind": {}, "BOInsert": {}'
+        return s.format(self.find_count, self.insert_count)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get_buffered_query_count(self):
+        """
+        returns count of queries buffered in AsyncBulkOperator
+        """
+        return {'find': self.find_count, 'insert': self.insert_count}
+
+
+class AsyncBulk(object):
+
+    def __init__(self, conn, db_name, results, max_ops_limit, spawn, ordered=True):
+        self.__conn = conn
+        self.__bulks = {}
+        self.__spawn = spawn
+        self.db_name = db_name
+        self.ordered = ordered
+        self.max_ops_limit = max_ops_limit
+        self.results = results
+
+    def __next__(self):
+        raise TypeError("'AsyncBulk' object is not iterable")
+
+    def __str__(self):
+        return '{"AsyncBulkOperatorInstanceForDatabase": "{}"'.format(self.db_name)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def update_results(self, collection, curr_result):
+        update_results(self.results, (self.db_name, collection), curr_result)
+
+    def __new_bulk_operator(self, collection):
+        coll = self.__conn[self.db_name][collection]
+        return AsyncBulkOperator(coll, self.ordered)
+
+    def __getattr__(self, collection):
+        if collection not in self.__bulks:
+            self.__bulks[collection] = self.__new_bulk_operator(collection)
+        elif self.__bulks[collection].total_ops >= self.max_ops_limit:
+            bulk_op = self.__bulks[collection]
+            self.__bulks[collection] = self.__new_bulk_operator(collection)
+            self.__spawn(self.execute_bulk_operator(collection, bulk_op))
+        return self.__bulks[collection]
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+    async def execute_bulk_operator(self, collection, bulk_op):
+        """Execute a AsyncBulkOperator of this db and add its result to results
+        """
+        try:
+            curr_result = await bulk_op.execute()
+            # empty AsyncBulkOperators have nothing to count
+            if curr_result:
+                self.update_results(collection, curr_result)
+        except BulkWriteError as bwe:
+            sys.stderr.write(str(bwe.details))
+
+    async def execute(self):
+        """Call this to flush the existing cached operations at db level
+        """
+        await asyncio.gather(*[self.execute_bulk_operator(coll, self.__bulks[coll])
+                               for coll in list(self.__bulks)])
+
+    def get_buffered_query_count(self):
+        """
+        returns dict with key as coll, db_name and value as dict in format of
+        {'insert': count, 'find': count}
+        """
+        buffered_query_count = {}
+        for collection in self.__bulks:
+            query_count_dict = self.__bulks[collection].get_buffered_query_count()
+            buffered_query_count[(collection, self.db_name)] = query_count_dict
+        return buffered_query_count
+
+
+class AsyncMongoQueryAggregator(object):
+
+    def __init__(self, mongodb_settings, interval, max_ops_limit, client=None):
+        """Initialize a new AsyncMongoQueryAggregator, same interface as
+        MongoQueryAggregator except execute is a coroutine.
+        Enqueueing never blocks the event loop, flushes triggered by
+        `interval` or `max_ops_limit` run as tasks on the running loop.
+        :Parameters:
+          - `interval`: A :Integer:`seconds`.
+          - `mongodb_settings` :dict: mongdb Settings passed to
+            AsyncIOMotorClient.
+          - `max_ops_limit`: A :Integer: max number of operation a Bulk can hold for a collection
+            crossing this limit it will execute already cached operations
+          - `client` (optional): an async client to use instead of creating
+            AsyncIOMotorClient, ``client[db_name][collection]`` must have a
+            coroutine ``bulk_write``.
+        """
+        self.__conn = client
+        self.__dbs = {}
+        self.__tasks = set()
+        self.__periodic_task = None
+        self.__interval = interval
+        self.mongodb_settings = mongodb_settings
+        self.max_ops_limit = max_ops_limit
+        self.last_execution_time = time()
+        self.results = {}
+
+    def __str__(self):
+        return '{"seconds": {}}'.format(self.__interval)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __connection(self):
+        if not self.__conn:
+            if AsyncIOMotorClient is None:
+                raise ImportError('motor is required when no client is given')
+            self.__conn = AsyncIOMotorClient(**self.mongodb_settings)
+        return self.__conn
+
+    def __spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+        return task
+
+    def __getattr__(self, db_name):
+        if self.__periodic_task is None and self.__interval + self.last_execution_time <= time():
+            # flush runs as a task, enqueueing caller is never blocked
+            self.last_execution_time = time()
+            self.__spawn(self.execute())
+
+        if db_name not in self.__dbs:
+            self.__dbs[db_name] = AsyncBulk(self.__connection(), db_name, self.results,
+                                            self.max_ops_limit, self.__spawn)
+        return self.__dbs[db_name]
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+    async def execute(self):
+        """Call this to flush the existing cached operations
+        """
+        dbs, self.__dbs = self.__dbs, {}
+        db_names = list(dbs)
+        rets = await asyncio.gather(*[dbs[db_name].execute() for db_name in db_names],
+                                    return_exceptions=True)
+        for db_name, ret in zip(db_names, rets):
+            if isinstance(ret, Exception):
+                lines = traceback.format_exception(type(ret), ret, ret.__traceback__)
+                traceback_log = ''.join(line for line in lines)
+                sys.stderr.write('For DB [ {} ]\n\tError:\n {}'.format(db_name, traceback_log))
+        self.last_execution_time = time()
+
+    async def __run_periodic(self):
+        while True:
+            timeout = self.last_execution_time + self.__interval - time()
+            if timeout > 0:
+                await asyncio.sleep(timeout)
+            await self.execute()
+
+    def start(self):
+        """Start periodic flushing every `interval` on the running loop"""
+        if self.__periodic_task is None:
+            self.__periodic_task = asyncio.ensure_future(self.__run_periodic())
+        return self.__periodic_task
+
+    async def stop(self, flush=True):
+        """Stop periodic flushing and wait for spawned flushes to finish.
+        :Parameters:
+          - `flush` (optional): If ``True`` flush all buffered operations.
+        """
+        task, self.__periodic_task = self.__periodic_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.__tasks:
+            await asyncio.gather(*list(self.__tasks), return_exceptions=True)
+        if flush:
+            await self.execute()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.stop()
+
+    def get_results(self):
+        return self.results
+
+    def get_and_reset_results(self):
+        """this function returns current results and resets results"""
+        results = self.results
+        self.results = {}
+        for bulk in self.__dbs.values():
+            bulk.results = self.results
+        return results
+
+    def get_buffered_query_count(self):
+        """
+        this function will return count of all queries for each database, collection
+        it will return dict with key as (collection, db_name)
+        and value will be dict having keys insert and find with value as there count
+        """
+        buffered_query_count = {}
+        for db_name in list(self.__dbs):
+            buffered_query_count.update(self.__dbs[db_name].get_buffered_query_count())
+        return buffered_query_count
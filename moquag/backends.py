@@ -0,0 +1,177 @@
+from pymongo.write_concern import WriteConcern
+from bson import BSON
+from bson.raw_bson import RawBSONDocument
+from array import array
+from collections import deque
+from .operations import to_request
+
+
+class BulkWriteBackend(object):
+
+    def __init__(self, collection, ordered=False,
+                 bypass_document_validation=False):
+        """Default backend of BulkOperator, it buffers operations as
+        ``(op, selector, document, upsert)`` tuples and sends them as
+        lightweight :mod:`pymongo.operations` requests with
+        ``collection.bulk_write``.
+        A backend has to implement insert, add, __len__, pop_oldest, detach,
+        send and execute.
+        :Parameters:
+          - `collection`: A :class:`~pymongo.collection.Collection` instance.
+          - `ordered` (optional): If ``True`` operations are executed serially
+            and execution aborts on the first error.
+          - `bypass_document_validation`: (optional) If ``True``, allows the
+            write to opt-out of document level validation.
+        """
+        self.collection = collection
+        self.ordered = ordered
+        self.bypass_document_validation = bypass_document_validation
+        # a deque, the drop_oldest policy pops the oldest operation
+        self.operations = deque()
+
+    def __len__(self):
+        return len(self.operations)
+
+    def insert(self, document):
+        """Add an insert of `document`"""
+        self.operations.append(('insert', document, None, False))
+
+    def add(self, op, selector, document, upsert):
+        """Add an operation recorded by BulkWriteOperation"""
+        self.operations.append((op, selector, document, upsert))
+
+    def pop_oldest(self):
+        """Remove and return the oldest buffered operation, None if empty"""
+        if self.operations:
+            return self.operations.popleft()
+        return None
+
+    def detach(self):
+        """returns all buffered operations and empties the buffer"""
+        operations, self.operations = list(self.operations), deque()
+        return operations
+
+    def send(self, operations, write_concern=None):
+        """Send `operations` with a single bulk_write and return the raw
+        bulk api result, same shape as BulkOperationBuilder.execute.
+        :Parameters:
+          - operations: list of operations returned by detach.
+          - write_concern (optional): dict of write concern options.
+        """
+        collection = self.collection
+        if write_concern:
+            collection = collection.with_options(
+                write_concern=WriteConcern(**write_concern))
+        requests = [to_request(*operation) for operation in operations]
+        ret = collection.bulk_write(
+            requests, ordered=self.ordered,
+            bypass_document_validation=self.bypass_document_validation)
+        if not ret.acknowledged:
+            # unacknowledged writes have no result to report
+            return {}
+        return ret.bulk_api_result
+
+    def execute(self, write_concern=None):
+        """Send all buffered operations, see send"""
+        return self.send(self.detach(), write_concern)
+
+
+class EncodedBulkWriteBackend(BulkWriteBackend):
+
+    encodes_operations = True
+
+    def __init__(self, collection, ordered=False,
+                 bypass_document_validation=False):
+        """Backend BSON encoding every operation once when it is enqueued,
+        in the producer thread, into one contiguous buffer, instead of
+        holding the documents until the flush. Operations are sent as
+        :class:`~bson.raw_bson.RawBSONDocument` the driver writes without
+        encoding them again, and their sizes are known without extra work.
+        Inserted documents get no ``_id`` from the driver, the server adds
+        it. Same parameters as :class:`BulkWriteBackend`.
+        """
+        super(EncodedBulkWriteBackend, self).__init__(
+            collection, ordered, bypass_document_validation)
+        self.__reset()
+
+    def __reset(self):
+        self.buffer = bytearray()
+        self.__ops = []
+        self.__upserts = array('b')
+        # start, selector length and document length (-1 if None) of ops
+        self.__offsets = array('q')
+        self.__base = 0
+        # ops before __head were popped, their bytes end at __popped_end
+        self.__head = 0
+        self.__popped_end = 0
+
+    def __len__(self):
+        return len(self.__ops) - self.__head
+
+    def encode(self, op, selector, document=None, upsert=False):
+        """returns (encoded operation, size in bytes) to be passed to
+        add_encoded, for inserts `selector` is the document
+        """
+        encoded_selector = BSON.encode(selector)
+        encoded_document = None if document is None else BSON.encode(document)
+        size = len(encoded_selector)
+        if encoded_document is not None:
+            size += len(encoded_document)
+        return (op, encoded_selector, encoded_document, upsert), size
+
+    def add_encoded(self, encoded):
+        """Add an operation returned by encode"""
+        op, encoded_selector, encoded_document, upsert = encoded
+        self.__ops.append(op)
+        self.__upserts.append(bool(upsert))
+        self.__offsets.extend((self.__base + len(self.buffer), len(encoded_selector),
+                               -1 if encoded_document is None else len(encoded_document)))
+        self.buffer += encoded_selector
+        if encoded_document is not None:
+            self.buffer += encoded_document
+
+    def insert(self, document):
+        """Encode and add an insert of `document`"""
+        self.add_encoded(self.encode('insert', document)[0])
+
+    def add(self, op, selector, document, upsert):
+        """Encode and add an operation"""
+        self.add_encoded(self.encode(op, selector, document, upsert)[0])
+
+    def __get_operation(self, index, buffer):
+        start, selector_length, document_length = self.__offsets[3 * index:3 * index + 3]
+        start -= self.__base
+        selector = RawBSONDocument(bytes(buffer[start:start + selector_length]))
+        document, end = None, start + selector_length
+        if document_length >= 0:
+            document = RawBSONDocument(bytes(buffer[end:end + document_length]))
+            end += document_length
+        return (self.__ops[index], selector, document, bool(self.__upserts[index])), end
+
+    def pop_oldest(self):
+        """Remove and return the oldest buffered operation, None if empty"""
+        if self.__head == len(self.__ops):
+            return None
+        operation, self.__popped_end = self.__get_operation(self.__head, self.buffer)
+        self.__head += 1
+        if 2 * self.__head >= len(self.__ops):
+            # popped ops are compacted once they are half of the buffer
+            head, end = self.__head, self.__popped_end
+            del self.buffer[:end]
+            self.__base += end
+            del self.__ops[:head]
+            del self.__upserts[:head]
+            del self.__offsets[:3 * head]
+            self.__head = self.__popped_end = 0
+        return operation
+
+    def detach(self):
+        """returns all buffered operations as ``(op, selector, document,
+        upsert)`` tuples of RawBSONDocuments and empties the buffer
+        """
+        buffer = memoryview(self.buffer)
+        operations = [self.__get_operation(index, buffer)[0]
+                      for index in range(self.__head, len(self.__ops))]
+        buffer.release()
+        self.__reset()
+        return operations
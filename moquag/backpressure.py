@@ -0,0 +1,98 @@
+from collections import Counter
+from time import time
+import threading
+
+BLOCK = 'block'
+FLUSH = 'flush'
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+OVERFLOW_POLICIES = (BLOCK, FLUSH, DROP_NEWEST, DROP_OLDEST)
+
+
+class BufferFullError(Exception):
+    """Raised when a producer blocked by the block overflow policy timed out"""
+
+
+class BufferLimiter(object):
+
+    def __init__(self, max_ops=None, max_bytes=None, policy=FLUSH,
+                 block_timeout=None):
+        """Global cap on operations buffered by a MongoQueryAggregator across
+        all databases and collections.
+        :Parameters:
+          - `max_ops` (optional): max number of buffered operations.
+          - `max_bytes` (optional): max encoded BSON bytes of buffered
+            operations.
+          - `policy` (optional): what happens once the cap is reached
+              - ``'block'``: producer waits for a flush to free space, at
+                most `block_timeout` seconds then BufferFullError is raised
+              - ``'flush'``: producer flushes the aggregator synchronously
+              - ``'drop_newest'``: the new operation is dropped
+              - ``'drop_oldest'``: the oldest operation buffered for the same
+                collection is dropped, the new one if it has none
+          - `block_timeout` (optional): seconds a producer is blocked,
+            ``None`` waits forever.
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('policy must be one of {}'.format(OVERFLOW_POLICIES))
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.buffered_ops = 0
+        self.buffered_bytes = 0
+        self.stats = Counter()
+        self.__condition = threading.Condition(threading.Lock())
+
+    def is_full(self):
+        """returns True if the cap on buffered ops or bytes is reached"""
+        return ((self.max_ops is not None and self.buffered_ops >= self.max_ops) or
+                (self.max_bytes is not None and self.buffered_bytes >= self.max_bytes))
+
+    def acquire(self, ops, size):
+        """Account `ops` operations of `size` bytes as buffered"""
+        with self.__condition:
+            self.buffered_ops += ops
+            self.buffered_bytes += size
+
+    def release(self, ops, size):
+        """Account `ops` operations of `size` bytes as flushed or dropped,
+        wakes up blocked producers
+        """
+        with self.__condition:
+            self.buffered_ops -= ops
+            self.buffered_bytes -= size
+            self.__condition.notify_all()
+
+    def record(self, event, count=1):
+        """Increment counter of a backpressure event"""
+        with self.__condition:
+            self.stats[event] += count
+
+    def wait(self):
+        """Block until the buffer is no more full, raises BufferFullError
+        after block_timeout seconds
+        """
+        deadline = None
+        if self.block_timeout is not None:
+            deadline = time() + self.block_timeout
+        with self.__condition:
+            self.stats['blocked'] += 1
+            while self.is_full():
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time()
+                    if timeout <= 0:
+                        self.stats['block_timeouts'] += 1
+                        raise BufferFullError(
+                            'buffer full: {} ops, {} bytes'.format(
+                                self.buffered_ops, self.buffered_bytes))
+                self.__condition.wait(timeout)
+
+    def get_stats(self):
+        """returns dict of current buffered ops and bytes and event counters"""
+        with self.__condition:
+            stats = dict(self.stats)
+            stats['buffered_ops'] = self.buffered_ops
+            stats['buffered_bytes'] = self.buffered_bytes
+        return stats
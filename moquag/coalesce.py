@@ -0,0 +1,169 @@
+from collections import OrderedDict
+from bson import BSON
+
+MERGEABLE_OPERATORS = ('$set', '$inc', '$addToSet')
+# operations sent in the update runs of a bulk_write, in the order given
+UPDATE_OPS = ('update', 'update_one', 'replace_one')
+FOLDABLE_DELETES = ('remove', 'remove_one')
+
+
+def can_coalesce(op, update):
+    """returns True if operation `op` is an update and every operator of
+    `update` can be merged
+    """
+    return (op in ('update', 'update_one') and bool(update) and
+            all(operator in MERGEABLE_OPERATORS for operator in update))
+
+
+def get_delete_field(op, selector):
+    """returns the field of a delete which can be folded into a ``$in``
+    delete, `selector` must be a single equality on a field, for
+    ``remove_one`` on ``_id`` only so a single document is removed. returns
+    ``None`` if it can not be folded.
+    """
+    if op not in FOLDABLE_DELETES or len(selector) != 1:
+        return None
+    field, value = next(iter(selector.items()))
+    if field.startswith('$') or isinstance(value, (dict, list)):
+        return None
+    if op == 'remove_one' and field != '_id':
+        return None
+    return field
+
+
+def _paths_conflict(path, other):
+    return (path == other or path.startswith(other + '.') or
+            other.startswith(path + '.'))
+
+
+def _add_to_set_values(value):
+    if isinstance(value, dict) and '$each' in value:
+        return list(value['$each'])
+    return [value]
+
+
+class UpdateCoalescer(object):
+
+    def __init__(self):
+        """Buffer of updates for an unordered bulk, updates with an identical
+        selector are merged into a single update:
+          - ``$set`` keys are last write wins
+          - ``$inc`` deltas are summed
+          - ``$addToSet`` values are unioned
+        Only the last update of a selector is open to merges, an update
+        which can not be merged into it closes it, so updates of a selector
+        are never reordered. Closed updates are returned to be sent as they
+        are, before the updates buffered after them.
+        """
+        self.__open = OrderedDict()
+        self.folded_count = 0
+
+    def __len__(self):
+        return len(self.__open)
+
+    def add(self, op, selector, update, upsert=False):
+        """Buffer an update, `op` and `update` must pass can_coalesce.
+        :Returns:
+          - ``(folded, closed)``, `folded` is ``True`` if the update was
+            merged into the open update of `selector`, `closed` is the
+            ``(op, selector, update, upsert)`` closed by it, else ``None``
+        """
+        key = BSON.encode(selector)
+        entry = self.__open.get(key)
+        if entry is not None and entry[0] == op and entry[3] == upsert and \
+                self.__merge(entry[2], update):
+            self.folded_count += 1
+            return True, None
+        self.__open[key] = (op, selector, self.__copy(update), upsert)
+        return False, entry
+
+    def close(self, selector):
+        """returns the open ``(op, selector, update, upsert)`` of `selector`
+        removed from the buffer, ``None`` if it has none. Called before an
+        update of `selector` which is not coalesced is buffered.
+        """
+        if not self.__open:
+            return None
+        return self.__open.pop(BSON.encode(selector), None)
+
+    def __copy(self, update):
+        merged = {}
+        for op, fields in update.items():
+            if op == '$addToSet':
+                merged[op] = dict((field, {'$each': _add_to_set_values(value)})
+                                  for field, value in fields.items())
+            else:
+                merged[op] = dict(fields)
+        return merged
+
+    def __merge(self, merged, update):
+        for op, fields in update.items():
+            for field, value in fields.items():
+                for other_op, other_fields in merged.items():
+                    for other_field in other_fields:
+                        if not _paths_conflict(field, other_field):
+                            continue
+                        if other_op != op or field != other_field:
+                            return False
+                        if op == '$inc' and not isinstance(value, (int, float)):
+                            return False
+        for op, fields in update.items():
+            target = merged.setdefault(op, {})
+            for field, value in fields.items():
+                if op == '$addToSet':
+                    each = target.setdefault(field, {'$each': []})['$each']
+                    for item in _add_to_set_values(value):
+                        if item not in each:
+                            each.append(item)
+                elif op == '$inc' and field in target:
+                    target[field] += value
+                else:
+                    target[field] = value
+        return True
+
+    def drain(self):
+        """returns list of the open (op, selector, update, upsert) and empties
+        the buffer
+        """
+        ops = list(self.__open.values())
+        self.__open = OrderedDict()
+        return ops
+
+
+class DeleteCoalescer(object):
+
+    def __init__(self, chunk_size=1000):
+        """Buffer of deletes for an unordered bulk, single equality deletes
+        on the same field are folded into ``{field: {'$in': values}}``
+        deletes of at most `chunk_size` values.
+        """
+        self.chunk_size = chunk_size
+        self.__values = OrderedDict()
+        self.folded_count = 0
+
+    def __len__(self):
+        return sum(-(-len(values) // self.chunk_size)
+                   for values in self.__values.values())
+
+    def add(self, field, value):
+        """Buffer a delete of the documents having `value` in `field`.
+        :Returns:
+          - ``True`` if the delete was folded into an already buffered one
+        """
+        values = self.__values.setdefault(field, [])
+        values.append(value)
+        if (len(values) - 1) % self.chunk_size == 0:
+            # first value of a new chunk
+            return False
+        self.folded_count += 1
+        return True
+
+    def drain(self):
+        """returns list of (op, selector, document, upsert) and empties the buffer"""
+        ops = []
+        for field, values in self.__values.items():
+            for index in range(0, len(values), self.chunk_size):
+                ops.append(('remove', {field: {'$in': values[index:index + self.chunk_size]}},
+                            None, False))
+        self.__values = OrderedDict()
+        return ops
@@ -0,0 +1,100 @@
+from collections import OrderedDict, Counter
+from bson import BSON
+import threading
+
+
+def get_selector_key(selector):
+    """returns hashable key of a selector, its items if hashable or else its
+    BSON encoding
+    """
+    try:
+        key = tuple(selector.items())
+        hash(key)
+        return key
+    except TypeError:
+        return BSON.encode(selector)
+
+
+class CounterHandle(object):
+
+    __slots__ = ('store', 'db_name', 'collection', 'selector')
+
+    def __init__(self, store, db_name, collection, selector):
+        """Counters of the document matching `selector`, returned by
+        MongoQueryAggregator.counter
+        """
+        self.store = store
+        self.db_name = db_name
+        self.collection = collection
+        self.selector = selector
+
+    def incr(self, field, count=1):
+        """Add `count` to `field`"""
+        self.store.incr(self.db_name, self.collection, self.selector, {field: count})
+
+    def incr_many(self, counts):
+        """Add every count of the dict `counts` to its field"""
+        self.store.incr(self.db_name, self.collection, self.selector, counts)
+
+
+class CounterStore(object):
+
+    def __init__(self, emit, max_keys=100000):
+        """Running totals of ``$inc`` counters keyed by collection and
+        selector, emitted as a single upsert ``update_one`` per key. The
+        least recently incremented keys are emitted when more than
+        `max_keys` are held, so memory stays bounded.
+        :Parameters:
+          - `emit`: callable receiving ``(db_name, collection, selector,
+            update)`` for every emitted key.
+          - `max_keys` (optional): max number of keys held. Default is
+            ``100000``.
+        """
+        self.emit = emit
+        self.max_keys = max_keys
+        self.increments = 0
+        self.emitted = 0
+        self.evictions = 0
+        self.__totals = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__totals)
+
+    def incr(self, db_name, collection, selector, counts):
+        """Add `counts` to the totals of selector in db_name.collection"""
+        key = (db_name, collection, get_selector_key(selector))
+        evicted = []
+        with self.__lock:
+            self.increments += 1
+            entry = self.__totals.pop(key, None)
+            if entry is None:
+                entry = (dict(selector), Counter())
+            # re-insertion marks the key as the most recently used
+            self.__totals[key] = entry
+            entry[1].update(counts)
+            while len(self.__totals) > self.max_keys:
+                evicted.append(self.__totals.popitem(last=False))
+            self.evictions += len(evicted)
+        self.__emit(evicted)
+
+    def __emit(self, entries):
+        if not entries:
+            return
+        with self.__lock:
+            self.emitted += len(entries)
+        for (db_name, collection, _), (selector, totals) in entries:
+            self.emit(db_name, collection, selector, {'$inc': dict(totals)})
+
+    def flush(self):
+        """Emit the totals of every key and empty the store"""
+        with self.__lock:
+            entries, self.__totals = list(self.__totals.items()), OrderedDict()
+        self.__emit(entries)
+
+    def get_stats(self):
+        """returns dict with counts of keys held, increments, emitted
+        upserts and evictions
+        """
+        return {'keys': len(self.__totals), 'increments': self.increments,
+                'emitted': self.emitted, 'evictions': self.evictions}
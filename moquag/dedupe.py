@@ -0,0 +1,183 @@
+from bson import BSON, ObjectId
+from hashlib import sha1
+from math import ceil, log
+import struct
+import threading
+
+MISSING = object()
+DUPLICATE = object()
+# str of Python 3, unicode of Python 2
+TEXT_TYPE = type(u'')
+
+
+def get_field(document, path):
+    """returns value of dotted `path` in `document`, MISSING if absent"""
+    value = document
+    for part in path.split('.'):
+        try:
+            value = value[part]
+        except (KeyError, TypeError, IndexError):
+            return MISSING
+    return value
+
+
+def encode_key(value):
+    """returns bytes identifying the BSON value of an idempotency key,
+    prefixed by its BSON type, common types of keys are not BSON encoded
+    """
+    value_type = type(value)
+    if value_type is ObjectId:
+        return b'\x07' + value.binary
+    if value_type is TEXT_TYPE:
+        return b'\x02' + value.encode('utf-8')
+    if value_type is int:
+        return b'\x12' + str(value).encode('ascii')
+    return BSON.encode({'k': value})
+
+
+class RotatingBloomFilter(object):
+
+    def __init__(self, capacity, error_rate=1e-6):
+        """Bounded probabilistic set of the idempotency keys of earlier
+        flush windows. Two generations of at most `capacity` keys are kept,
+        once the newer one is full the older one is forgotten, so memory is
+        fixed and a key is remembered for at least `capacity` more keys.
+        A false positive drops a new insert, with a probability of up to
+        twice `error_rate` per lookup.
+        :Parameters:
+          - `capacity`: keys held by a generation.
+          - `error_rate` (optional): false positive rate of a generation.
+            Default is ``1e-6``.
+        """
+        self.capacity = capacity
+        self.bit_count = max(8, int(ceil(-capacity * log(error_rate) / log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.bit_count / float(capacity) * log(2))))
+        self.count = 0
+        self.__current = bytearray((self.bit_count + 7) // 8)
+        self.__previous = bytearray(len(self.__current))
+        self.__lock = threading.Lock()
+
+    def __get_hashes(self, key):
+        # double hashing of one digest, see Kirsch and Mitzenmacher
+        first, second = struct.unpack('<QQ', sha1(key).digest()[:16])
+        return first, second | 1
+
+    def __contains__(self, key):
+        first, second = self.__get_hashes(key)
+        bit_count = self.bit_count
+        for bits in (self.__current, self.__previous):
+            # probes stop at the first clear bit, most new keys need one
+            position = first
+            for _ in range(self.hash_count):
+                bit = position % bit_count
+                if not bits[bit >> 3] & (1 << (bit & 7)):
+                    break
+                position += second
+            else:
+                return True
+        return False
+
+    def add(self, key):
+        """Remember `key`, bytes returned by encode_key"""
+        first, second = self.__get_hashes(key)
+        with self.__lock:
+            if self.count >= self.capacity:
+                self.__previous = self.__current
+                self.__current = bytearray(len(self.__previous))
+                self.count = 0
+            bits = self.__current
+            for index in range(self.hash_count):
+                bit = (first + index * second) % self.bit_count
+                bits[bit >> 3] |= 1 << (bit & 7)
+            self.count += 1
+
+
+class DedupeFilters(object):
+
+    def __init__(self, capacity, error_rate=1e-6):
+        """:class:`RotatingBloomFilter` of every deduplicated collection of
+        an aggregator, created on first use with `capacity` and `error_rate`
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.__filters = {}
+        self.__lock = threading.Lock()
+
+    def get(self, db_name, collection):
+        """returns the filter of db_name.collection"""
+        key = (db_name, collection)
+        bloom_filter = self.__filters.get(key)
+        if bloom_filter is None:
+            with self.__lock:
+                bloom_filter = self.__filters.get(key)
+                if bloom_filter is None:
+                    bloom_filter = self.__filters[key] = RotatingBloomFilter(
+                        self.capacity, self.error_rate)
+        return bloom_filter
+
+
+class InsertDeduplicator(object):
+
+    def __init__(self, key='_id', bloom_filter=None):
+        """Drops inserts of a flush window whose idempotency key was already
+        buffered in the window, or, with `bloom_filter`, executed in an
+        earlier one. Inserts without the key are never dropped.
+        :Parameters:
+          - `key` (optional): dotted field of the idempotency key. Default
+            is ``'_id'``.
+          - `bloom_filter` (optional): A :class:`RotatingBloomFilter` shared
+            by the windows of the collection. Default is ``None``.
+        """
+        self.key = key
+        self.bloom_filter = bloom_filter
+        self.seen = set()
+        self.encoded = []
+        self.dropped_count = 0
+
+    def get_key(self, document):
+        """returns DUPLICATE if `document` is a duplicate to drop, else its
+        key to record once the insert is buffered, None without a key
+        """
+        value = get_field(document, self.key)
+        if value is MISSING:
+            return None
+        encoded = None
+        try:
+            seen_key = (type(value), value)
+            hash(seen_key)
+        except TypeError:
+            seen_key = encoded = encode_key(value)
+        if seen_key in self.seen:
+            self.dropped_count += 1
+            return DUPLICATE
+        if self.bloom_filter is not None:
+            encoded = encoded or encode_key(value)
+            if encoded in self.bloom_filter:
+                self.dropped_count += 1
+                return DUPLICATE
+        return seen_key, encoded
+
+    def record(self, key):
+        """Record `key` returned by get_key in the window, inserts dropped
+        by the limiter are not recorded so their retries are not duplicates
+        """
+        seen_key, encoded = key
+        if self.bloom_filter is not None:
+            self.encoded.append(encoded)
+        self.seen.add(seen_key)
+
+    def detach(self):
+        """returns (encoded keys, dropped count) of the window and starts a
+        new one, the keys are passed to commit once the window is executed
+        """
+        window = (self.encoded, self.dropped_count)
+        self.seen = set()
+        self.encoded = []
+        self.dropped_count = 0
+        return window
+
+    def commit(self, encoded):
+        """Remember keys of an executed window in the filter"""
+        if self.bloom_filter is not None:
+            for key in encoded:
+                self.bloom_filter.add(key)
@@ -0,0 +1,319 @@
+"""Funnel mode, producer processes pass their operations over a Unix socket
+to one process holding the MongoQueryAggregator, so batches are built across
+all producers and a single MongoClient pool is used.
+
+Run the aggregating process with:
+
+    $ python -m moquag.funnel /tmp/moquag.sock --uri mongodb://localhost:27017
+
+and use a FunnelClient in every worker process:
+
+    client = FunnelClient('/tmp/moquag.sock')
+    client.db.coll.insert({'name': 'x'})
+    client.db.coll.find({'name': 'x'}).upsert().update_one({'$inc': {'n': 1}})
+"""
+from bson import BSON, decode_file_iter
+from bson.errors import InvalidBSON
+from time import time
+from .operations import BulkWriteOperation, check_operation
+from .scheduler import PeriodicCaller
+import threading
+import weakref
+import atexit
+import socket
+import sys
+import os
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+FLUSH_OP = 'flush'
+
+
+def encode_record(db_name, collection, op, selector=None, document=None, upsert=False):
+    """returns BSON record of an operation, same fields as spool records"""
+    record = {'db': db_name, 'coll': collection, 'op': op, 's': selector, 'u': upsert}
+    if document is not None:
+        record['d'] = document
+    return BSON.encode(record)
+
+
+class FunnelCollection(object):
+
+    def __init__(self, client, db_name, name):
+        self.__client = client
+        self.__db_name = db_name
+        self.__name = name
+
+    def __add_operation(self, op, selector, document, upsert):
+        # a malformed operation fails here instead of on the server
+        check_operation(op, selector, document)
+        self.__client.send(encode_record(self.__db_name, self.__name, op,
+                                         selector, document, upsert))
+
+    def insert(self, document):
+        """Send an insert of `document` to the funnel server"""
+        self.__add_operation('insert', document, None, False)
+
+    def find(self, selector):
+        """returns BulkWriteOperation for `selector`, its operations are
+        sent to the funnel server
+        """
+        return BulkWriteOperation(selector, self.__add_operation)
+
+
+class FunnelDatabase(object):
+
+    def __init__(self, client, name):
+        self.__client = client
+        self.__name = name
+
+    def __getattr__(self, collection):
+        return FunnelCollection(self.__client, self.__name, collection)
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+
+class FunnelClient(object):
+
+    def __init__(self, path, buffer_size=65536, flush_interval=0.1,
+                 max_pending_bytes=16 * 1024 * 1024):
+        """Thin producer of funnel mode, same interface as
+        MongoQueryAggregator for inserts and find chains. Operations are
+        BSON encoded into a local buffer written to the server socket once it
+        holds `buffer_size` bytes or `flush_interval` seconds passed, by a
+        daemon thread if no more operations are sent, and at exit. Safe to
+        create before forking, every process connects on its own.
+        :Parameters:
+          - `path`: path of the Unix socket of the FunnelServer.
+          - `buffer_size` (optional): bytes buffered before a write, ``0``
+            writes every operation. Default is ``65536``.
+          - `flush_interval` (optional): max seconds an operation stays in
+            the local buffer, ``None`` only writes it with later operations.
+            Default is ``0.1``.
+          - `max_pending_bytes` (optional): bytes kept while the server is
+            unreachable, buffered operations are dropped and counted in
+            `dropped_bytes` beyond it. Default is 16 MiB.
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_pending_bytes = max_pending_bytes
+        self.dropped_bytes = 0
+        self.__buffer = bytearray()
+        self.__socket = None
+        self.__pid = os.getpid()
+        self.__last_flush = time()
+        self.__lock = threading.Lock()
+        # started by the first send of every process
+        self.__flusher = None
+        self_ref = weakref.ref(self)
+        atexit.register(lambda: self_ref() is not None and self_ref().flush())
+
+    def __getattr__(self, db_name):
+        return FunnelDatabase(self, db_name)
+
+    def __getitem__(self, name):
+        return self.__getattr__(name)
+
+    def __connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    def __check_fork(self):
+        # operations buffered by the parent are flushed by the parent
+        if self.__pid != os.getpid():
+            self.__pid = os.getpid()
+            self.__buffer = bytearray()
+            self.__socket = None
+            # threads are not forked
+            self.__flusher = None
+
+    def __write(self):
+        if not self.__buffer:
+            return
+        try:
+            if self.__socket is None:
+                self.__socket = self.__connect()
+            self.__socket.sendall(self.__buffer)
+            self.__buffer = bytearray()
+        except (socket.error, OSError) as e:
+            if self.__socket is not None:
+                self.__socket.close()
+            self.__socket = None
+            sys.stderr.write('FunnelClient {}: {}\n'.format(self.path, e))
+            if len(self.__buffer) > self.max_pending_bytes:
+                self.dropped_bytes += len(self.__buffer)
+                self.__buffer = bytearray()
+        self.__last_flush = time()
+
+    def send(self, record):
+        """Buffer an encoded record and write the buffer if it is due"""
+        with self.__lock:
+            self.__check_fork()
+            self.__buffer += record
+            if self.flush_interval is None:
+                if len(self.__buffer) >= self.buffer_size:
+                    self.__write()
+                return
+            if self.__flusher is None:
+                self.__flusher = PeriodicCaller(self, 'flush', self.flush_interval,
+                                                'moquag-funnel-flusher')
+                self.__flusher.start()
+            if len(self.__buffer) >= self.buffer_size or \
+                    self.__last_flush + self.flush_interval <= time():
+                self.__write()
+
+    def flush(self):
+        """Write all buffered operations to the server"""
+        with self.__lock:
+            self.__check_fork()
+            self.__write()
+
+    def execute(self):
+        """Write all buffered operations and ask the server to flush its
+        aggregator
+        """
+        with self.__lock:
+            self.__check_fork()
+            self.__buffer += encode_record(None, None, FLUSH_OP)
+            self.__write()
+
+    def close(self):
+        """Flush and close the connection"""
+        with self.__lock:
+            flusher, self.__flusher = self.__flusher, None
+        if flusher is not None:
+            flusher.stop()
+        self.flush()
+        with self.__lock:
+            if self.__socket is not None:
+                self.__socket.close()
+                self.__socket = None
+
+
+class FunnelRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        funnel = self.server.funnel
+        try:
+            for record in decode_file_iter(self.rfile):
+                try:
+                    funnel.apply(record)
+                except Exception as e:
+                    # one bad record does not lose the following ones
+                    funnel.reject(record, e)
+        except InvalidBSON:
+            # connection closed in the middle of a record
+            pass
+
+
+class FunnelUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class FunnelServer(object):
+
+    def __init__(self, aggregator, path):
+        """Aggregating side of funnel mode, every operation received from
+        FunnelClients on the Unix socket `path` is buffered in `aggregator`.
+        Every client is served by its own thread, they are serialized by a
+        lock unless `aggregator` is thread safe, see the thread_safe option
+        of MongoQueryAggregator. An existing socket file at `path` is
+        replaced. Records the aggregator refuses are written to stderr and
+        counted in `rejected`.
+        """
+        self.aggregator = aggregator
+        self.path = path
+        self.received = 0
+        self.rejected = 0
+        self.__lock = threading.Lock()
+        self.__received_lock = threading.Lock()
+        self.__thread = None
+        if os.path.exists(path):
+            os.remove(path)
+        self.__server = FunnelUnixServer(path, FunnelRequestHandler)
+        self.__server.funnel = self
+
+    def apply(self, record):
+        """Buffer an operation record in the aggregator"""
+        self.__apply(record)
+        with self.__received_lock:
+            self.received += 1
+
+    def reject(self, record, error):
+        """Count and log a record that could not be applied"""
+        with self.__received_lock:
+            self.rejected += 1
+        sys.stderr.write('FunnelServer {}: rejected {} on {}.{}: {!r}\n'.format(
+            self.path, record.get('op'), record.get('db'), record.get('coll'), error))
+
+    def __apply(self, record):
+        if self.aggregator.locks is None:
+            with self.__lock:
+                self.__apply_unlocked(record)
+        else:
+            self.__apply_unlocked(record)
+
+    def __apply_unlocked(self, record):
+        if record['op'] == FLUSH_OP:
+            self.aggregator.execute()
+            return
+        self.aggregator.enqueue(record['db'], record['coll'], record['op'],
+                                record['s'], record.get('d'), record['u'])
+
+    def serve_forever(self):
+        """Handle clients until stop is called"""
+        self.__server.serve_forever()
+
+    def start(self):
+        """Handle clients in a daemon thread"""
+        self.__thread = threading.Thread(target=self.serve_forever,
+                                         name='moquag-funnel-server')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, flush=True):
+        """Stop serving started by start, remove the socket file and flush
+        the aggregator
+        """
+        if self.__thread is not None:
+            self.__server.shutdown()
+            self.__thread.join()
+            self.__thread = None
+        self.__server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if flush:
+            self.__apply({'op': FLUSH_OP})
+
+
+def main(argv=None):
+    import argparse
+    from .main import MongoQueryAggregator
+    parser = argparse.ArgumentParser(description='moquag funnel server')
+    parser.add_argument('socket', help='path of the Unix socket')
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--max-ops-limit', type=int, default=10000)
+    args = parser.parse_args(argv)
+    aggregator = MongoQueryAggregator({'host': args.uri}, args.interval,
+                                      args.max_ops_limit, background_flush=True,
+                                      thread_safe=True)
+    server = FunnelServer(aggregator, args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        aggregator.stop_scheduler()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+from pymongo.errors import BulkWriteError, WriteError
+import threading
+import sys
+
+_event_lock = threading.Lock()
+
+
+class WriteFuture(object):
+
+    __slots__ = ('__done', '__result', '__error', '__callbacks', '__event')
+
+    def __init__(self):
+        """Outcome of a single buffered operation, resolved when its bulk is
+        executed. The result is the ``_id`` of the document inserted by an
+        upsert, ``None`` for other successful operations. A failed operation
+        raises its :class:`~pymongo.errors.WriteError`, or the error which
+        failed the whole bulk.
+        """
+        self.__done = False
+        self.__result = None
+        self.__error = None
+        self.__callbacks = None
+        self.__event = None
+
+    def done(self):
+        """returns True once the operation was executed or failed"""
+        return self.__done
+
+    def __wait(self, timeout):
+        if self.__done:
+            return
+        with _event_lock:
+            if self.__event is None and not self.__done:
+                self.__event = threading.Event()
+            event = self.__event
+        if event is not None and not event.wait(timeout):
+            raise RuntimeError('operation not executed within {} seconds'.format(timeout))
+
+    def result(self, timeout=None):
+        """returns the upserted ``_id`` or ``None``, waits at most `timeout`
+        seconds for the flush, raises the error of a failed operation
+        """
+        self.__wait(timeout)
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+    def exception(self, timeout=None):
+        """returns the error of a failed operation, ``None`` on success"""
+        self.__wait(timeout)
+        return self.__error
+
+    def add_done_callback(self, callback):
+        """Call `callback` with this future once it is resolved, immediately
+        if it already is
+        """
+        with _event_lock:
+            if not self.__done:
+                if self.__callbacks is None:
+                    self.__callbacks = []
+                self.__callbacks.append(callback)
+                return
+        # resolved meanwhile, called outside the lock as it may add callbacks
+        callback(self)
+
+    def __resolve(self, result, error):
+        # a callback is either added before this or called by add_done_callback
+        with _event_lock:
+            self.__result = result
+            self.__error = error
+            self.__done = True
+            event = self.__event
+            callbacks, self.__callbacks = self.__callbacks, None
+        if event is not None:
+            event.set()
+        for callback in callbacks or ():
+            try:
+                callback(self)
+            except Exception as e:
+                sys.stderr.write('WriteFuture callback {}: {}\n'.format(callback, e))
+
+    def set_result(self, result):
+        self.__resolve(result, None)
+
+    def set_exception(self, error):
+        self.__resolve(None, error)
+
+
+def new_future(callback=None):
+    """returns a :class:`WriteFuture` with `callback` added if given"""
+    future = WriteFuture()
+    if callback is not None:
+        future.add_done_callback(callback)
+    return future
+
+
+def resolve_futures(futures, ret, ordered=False, error=None):
+    """Resolve ``(index, future)`` pairs of executed operations from the bulk
+    api result `ret`, with `error` set by a BulkWriteError. Operations of an
+    ordered bulk after its first failed one were not executed and fail with
+    `error`.
+    """
+    upserted = dict((upsert['index'], upsert['_id']) for upsert in ret.get('upserted', []))
+    write_errors = dict((write_error['index'], write_error)
+                        for write_error in ret.get('writeErrors', []))
+    aborted_index = None
+    if ordered and error is not None and write_errors:
+        aborted_index = min(write_errors)
+    for index, future in futures:
+        write_error = write_errors.get(index)
+        if write_error is not None:
+            future.set_exception(WriteError(write_error.get('errmsg'),
+                                            write_error.get('code'), write_error))
+        elif aborted_index is not None and index > aborted_index:
+            future.set_exception(error)
+        else:
+            future.set_result(upserted.get(index))
+
+
+def fail_futures(futures, error, ordered=False):
+    """Resolve ``(index, future)`` pairs of a bulk which raised `error`,
+    per operation for a BulkWriteError
+    """
+    if isinstance(error, BulkWriteError):
+        resolve_futures(futures, error.details, ordered, error)
+        return
+    for _, future in futures:
+        future.set_exception(error)
@@ -0,0 +1,104 @@
+from time import time
+import threading
+
+DEFAULT_LANE = 'default'
+LANE_OPTIONS = ('interval', 'max_ops_limit', 'priority')
+
+
+class PriorityLane(object):
+
+    def __init__(self, name, interval, max_ops_limit, priority=0):
+        """Buffers of an aggregator with their own flush deadline and batch
+        limit, e.g. a lane of user-facing writes flushed within milliseconds
+        in small batches next to a default lane batching analytics writes.
+        :Parameters:
+          - `name`: name of the lane.
+          - `interval`: max seconds operations are buffered in the lane.
+          - `max_ops_limit`: operations of a collection buffered before the
+            collection is flushed.
+          - `priority` (optional): lanes with a higher priority are flushed
+            first, then lanes with a shorter interval. Default is ``0``.
+        """
+        self.name = name
+        self.interval = interval
+        self.max_ops_limit = max_ops_limit
+        self.priority = priority
+        self.dbs = {}
+        self.scheduler = None
+        self.last_execution_time = time()
+        # earliest time a collection with an interval of its own is due
+        self.next_deadline = None
+        # held while the lane is flushed, flushes of other lanes do not wait
+        self.lock = threading.RLock()
+
+    def get_rank(self):
+        """returns sort key of the lane, lanes flushed first sort first"""
+        return (-self.priority, self.interval)
+
+    def is_due(self, now=None):
+        """returns True once the interval of the lane has elapsed"""
+        return self.last_execution_time + self.interval <= (now or time())
+
+    def schedule(self, deadline):
+        """Bring `next_deadline` forward to `deadline`, the time a collection
+        of the lane is due by its own interval, and wake the scheduler of the
+        lane to wait for it
+        """
+        if self.next_deadline is None or deadline < self.next_deadline:
+            self.next_deadline = deadline
+            if self.scheduler is not None:
+                self.scheduler.reschedule()
+
+    def has_due_collections(self, now=None):
+        """returns True once `next_deadline` has passed"""
+        return self.next_deadline is not None and self.next_deadline <= (now or time())
+
+
+def check_lanes(lanes):
+    """Raise ValueError if `lanes` passed to new_lanes name the default lane
+    or have unknown options
+    """
+    for name, options in (lanes or {}).items():
+        if name == DEFAULT_LANE:
+            raise ValueError('lane {} is set by interval and max_ops_limit'.format(name))
+        unknown = set(options) - set(LANE_OPTIONS)
+        if unknown:
+            raise ValueError('unknown options {} of lane {}'.format(sorted(unknown), name))
+
+
+def new_lanes(lanes, interval, max_ops_limit):
+    """returns list of :class:`PriorityLane` in flush order, the default lane
+    with `interval` and `max_ops_limit` and one per entry of `lanes`, a dict
+    of lane name to dict of its options, missing options are inherited from
+    the default lane
+    """
+    created = [PriorityLane(DEFAULT_LANE, interval, max_ops_limit)]
+    for name, options in (lanes or {}).items():
+        if name != DEFAULT_LANE:
+            created.append(PriorityLane(name, options.get('interval', interval),
+                                        options.get('max_ops_limit', max_ops_limit),
+                                        options.get('priority', 0)))
+    # stable sort keeps the default lane first among equal lanes
+    created.sort(key=lambda lane: lane.get_rank())
+    return created
+
+
+class LaneView(object):
+
+    def __init__(self, lane, get_bulk):
+        """Databases of an aggregator seen through a lane,
+        ``aggregator.lane('realtime').db.coll`` buffers operations in the
+        lane the way ``aggregator.db.coll`` does in the default lane.
+        :Parameters:
+          - `lane`: the :class:`PriorityLane`.
+          - `get_bulk`: callable receiving a database name, returns the Bulk
+            of the database in the lane.
+        """
+        self.lane = lane
+        self.__get_bulk = get_bulk
+
+    def __getattr__(self, db_name):
+        return self.__get_bulk(db_name)
+
+    def __getitem__(self, db_name):
+        return self.__get_bulk(db_name)
@@ -0,0 +1,52 @@
+from bson import ObjectId
+from datetime import datetime
+from numbers import Number
+
+from moquag.dedupe import TEXT_TYPE
+
+# inserts, then updates, then deletes, each sent as one homogeneous run
+OP_GROUPS = {
+    'insert': 0,
+    'update_one': 1,
+    'update': 1,
+    'replace_one': 1,
+    'remove_one': 2,
+    'remove': 2
+}
+# values are only compared with values of the same rank, text before bytes
+# so unicode keys of Python 2 are sorted too
+SORTABLE_TYPES = (Number, TEXT_TYPE, bytes, ObjectId, datetime)
+
+
+def get_sort_value(value):
+    """returns sort key of `value`, values are ordered by type then value,
+    values of other types, e.g. ``$in`` conditions, sort last
+    """
+    for rank, types in enumerate(SORTABLE_TYPES):
+        if isinstance(value, types):
+            return (rank, value)
+    return (len(SORTABLE_TYPES), 0)
+
+
+def get_locality_order(operations, sort_key):
+    """returns positions of `operations` in the order to send them, grouped
+    by kind of operation and sorted by the value of `sort_key` in their
+    selector, in the document for inserts falling back to its ``_id``.
+    Operations which can not be sorted keep their order within their group.
+    """
+    def get_key(position):
+        op, selector = operations[position][:2]
+        if op == 'insert' and sort_key not in selector:
+            value = selector.get('_id')
+        else:
+            value = selector.get(sort_key)
+        return (OP_GROUPS.get(op, len(OP_GROUPS)), get_sort_value(value))
+
+    positions = list(range(len(operations)))
+    try:
+        positions.sort(key=get_key)
+    except TypeError:
+        # e.g. naive and aware datetimes, operations are only grouped
+        positions.sort(key=lambda position: OP_GROUPS.get(operations[position][0],
+                                                          len(OP_GROUPS)))
+    return positions
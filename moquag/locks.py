@@ -0,0 +1,18 @@
+import threading
+
+
+class LockStripes(object):
+
+    def __init__(self, count=64):
+        """Fixed set of locks shared by the BulkOperators of an aggregator,
+        each collection uses the lock its (db_name, collection) hashes to, so
+        producers writing to different collections rarely wait on each other
+        while memory stays bounded for any number of collections.
+        :Parameters:
+          - `count` (optional): number of locks. Default is ``64``.
+        """
+        self.locks = [threading.Lock() for _ in range(count)]
+
+    def get(self, db_name, collection):
+        """returns the lock of db_name.collection"""
+        return self.locks[hash((db_name, collection)) % len(self.locks)]
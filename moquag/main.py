@@ -1,16 +1,76 @@
 from pymongo.errors import BulkWriteError
-from pymongo.bulk import BulkOperationBuilder
+from bson import ObjectId
 import traceback
-from pymongo import MongoClient
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from time import time
+import threading
 import sys
+import os
+from .scheduler import FlushScheduler
+from .coalesce import (UPDATE_OPS, UpdateCoalescer, DeleteCoalescer, can_coalesce,
+                       get_delete_field)
+from .operations import (BulkWriteOperation, check_operation, get_operation_size,
+                         get_remove_selectors)
+from .backends import BulkWriteBackend
+from .spool import Spool
+from .backpressure import BufferFullError, BufferLimiter, BLOCK, FLUSH, DROP_NEWEST, DROP_OLDEST
+from .metrics import FlushMetrics, render_prometheus
+from .policies import WritePolicyRegistry
+from .writer import CollectionWriter
+from .counters import CounterStore, CounterHandle
+from .overlay import PendingWriteOverlay
+from .futures import new_future, resolve_futures, fail_futures
+from .retry import TRANSIENT_ERROR_CODES, get_retry_errors
+from .locks import LockStripes
+from .routing import ClusterRouter
+from .lanes import DEFAULT_LANE, LaneView, check_lanes, new_lanes
+from .locality import get_locality_order
+from .dedupe import DUPLICATE, DedupeFilters, InsertDeduplicator
 
-class BulkOperator(BulkOperationBuilder):
+NO_OPS_RESULT = {'ops': 'No ops found'}
+
+
+def get_result_counter(ret):
+    """Convert result of a bulk execution to Counter, write errors are
+    counted and written to stderr, upserted ids are dropped
+    """
+    result_counter = {}
+    for key in ret:
+        if key in ['writeConcernErrors', 'writeErrors']:
+            if len(ret[key]) > 0:
+                result_counter[key] = len(ret[key])
+                sys.stderr.write('{}:\n\t{}'.format(key, ret[key]))
+        elif key != 'upserted':
+            result_counter[key] = ret[key]
+    return Counter(result_counter)
+
+
+def get_count_name(op):
+    """returns name of the BulkOperator counter of operations `op`"""
+    if op == 'insert':
+        return 'insert_count'
+    if op in ('remove', 'remove_one'):
+        return 'remove_count'
+    return 'find_count'
+
+
+def update_results(results, results_key, curr_result):
+    """Add Counter `curr_result` to the Counter of `results_key` in `results`"""
+    results.setdefault(results_key, Counter())
+    results[results_key] += curr_result
+
+
+class BulkOperator(object):
 
     def __init__(self, collection, ordered=False,
-                 bypass_document_validation=False):
-        """Initialize a new BulkOperator which extends BulkOperationBuilder.
+                 bypass_document_validation=False, coalesce=False,
+                 track_bytes=False, backend=BulkWriteBackend, spool=None,
+                 retry_policy=None, limiter=None, metrics=None,
+                 delete_chunk_size=1000, overlay=None, lock=None, redirect=None,
+                 sort_key=None, dedupe_key=None, dedupe_filter=None, max_bytes=None):
+        """Initialize a new BulkOperator, operations are buffered in a
+        backend, by default as requests sent with ``collection.bulk_write``.
         :Parameters:
           - `collection`: A :class:`~pymongo.collection.Collection` instance.
           - `ordered` (optional): If ``True`` all operations will be executed
@@ -22,64 +82,566 @@ class BulkOperator(BulkOperationBuilder):
           - `bypass_document_validation`: (optional) If ``True``, allows the
             write to opt-out of document level validation. Default is
             ``False``.
+          - `coalesce` (optional): If ``True`` compatible ``$set``, ``$inc``
+            and ``$addToSet`` updates on an identical selector are merged
+            into a single update, until an update of the selector which can
+            not be merged, so updates of a selector keep their order, and
+            single equality deletes on a field are folded into ``$in``
+            deletes, ``remove_one`` on ``_id`` only. Only for unordered
+            bulks. Default is ``False``.
+          - `track_bytes` (optional): If ``True`` the encoded BSON size of
+            every operation is added to `total_bytes` as it is enqueued.
+            Default is ``False``.
+          - `backend` (optional): class or callable creating the backend
+            from (collection, ordered, bypass_document_validation), it has
+            to implement the interface of :class:`BulkWriteBackend`, or of
+            :class:`EncodedBulkWriteBackend` if its `encodes_operations` is
+            ``True``.
+          - `spool` (optional): A :class:`Spool`, if given every operation is
+            recorded in a spool segment before it is buffered and the
+            segment is deleted once the operations are sent. After a
+            BulkWriteError it keeps only the operations which failed
+            transiently or were not executed, after other errors all of
+            them. Inserted documents get an ``_id`` when recorded so replays
+            are idempotent.
+          - `retry_policy` (optional): A :class:`RetryPolicy`, if given
+            transiently failed operations are buffered again, in `redirect`
+            if given, and sent ahead of newer operations by the first
+            execute after their backoff. Operations it gives up on are dead
+            lettered, or raised as BulkWriteError.
+          - `limiter` (optional): A :class:`BufferLimiter` shared by all
+            BulkOperators of an aggregator, every buffered operation is
+            accounted in it and the drop overflow policies are applied here.
+          - `metrics` (optional): A :class:`FlushMetrics` every execution
+            is recorded in.
+          - `delete_chunk_size` (optional): max values of a folded ``$in``
+            delete. Default is ``1000``.
+          - `overlay` (optional): A :class:`PendingWriteOverlay`, every
+            operation is indexed in it until executed. Inserted documents
+            get an ``_id`` so they can be looked up.
+          - `lock` (optional): lock held while an operation is buffered and
+            while operations are detached at execute, for producers on
+            several threads. Default is ``None``.
+          - `redirect` (optional): callable returning the BulkOperator
+            operations are passed to once this one is sealed, required with
+            `lock` or `max_bytes`.
+          - `sort_key` (optional): field of selectors, e.g. the indexed
+            ``'id'``, operations are sorted by at execute so the server
+            writes neighbouring index entries together. Inserts, updates and
+            removes are grouped in runs of one kind, inserts are sorted by
+            the field or their ``_id``. Only for unordered bulks. Default is
+            ``None`` which sends operations in the order they were added.
+          - `dedupe_key` (optional): dotted field of inserted documents, e.g.
+            ``'_id'``, an insert whose value of the field was already
+            inserted since the last execute is dropped, its future resolves
+            to ``None``. Dropped inserts are counted as ``nDeduplicated`` in
+            results. Default is ``None``.
+          - `dedupe_filter` (optional): A :class:`RotatingBloomFilter` of the
+            collection with `dedupe_key`, inserts whose key was executed by
+            an earlier BulkOperator are dropped too. Default is ``None``.
+          - `max_bytes` (optional): max encoded BSON size of the buffered
+            operations, requires `track_bytes`. An operation which would
+            cross it seals this BulkOperator and is passed to `redirect`,
+            unless it is the first one. Default is ``None``.
         .. note:: `bypass_document_validation` requires server version
           **>= 3.2**
         .. versionchanged:: 3.2
           Added bypass_document_validation support
         """
-        super(BulkOperator, self).__init__(collection, ordered)
+        if coalesce and ordered:
+            raise ValueError('coalesce is only supported for unordered bulks')
+        if sort_key is not None and ordered:
+            raise ValueError('sort_key is only supported for unordered bulks')
+        self.collection = collection
+        self.ordered = ordered
+        self.backend = backend(collection, ordered, bypass_document_validation)
         self.find_count = 0
         self.insert_count = 0
+        self.remove_count = 0
         self.execute_count = 0
         self.total_ops = 0
+        self.total_bytes = 0
+        # backends encoding operations on enqueue report sizes for free
+        self.encodes = getattr(self.backend, 'encodes_operations', False)
+        self.track_bytes = track_bytes or self.encodes
+        self.coalescer = UpdateCoalescer() if coalesce else None
+        self.delete_coalescer = DeleteCoalescer(delete_chunk_size) if coalesce else None
+        self.sort_key = sort_key
+        self.deduplicator = None
+        if dedupe_key is not None:
+            self.deduplicator = InsertDeduplicator(dedupe_key, dedupe_filter)
+        self.spool = spool
+        self.spool_segment = None
+        self.retry_policy = retry_policy
+        self.limiter = limiter
+        self.metrics = metrics
+        self.pending = None
+        if overlay is not None:
+            self.pending = overlay.open(collection.database.name, collection.name)
+        self.lock = lock
+        self.redirect = redirect
+        self.max_bytes = max_bytes
+        self.sealed = False
+        self.created_time = time()
+        self.__acquired_ops = 0
+        self.__acquired_bytes = 0
+        # (position, future) of operations whose outcome was asked for,
+        # created on the first one
+        self.__futures = None
+        self.__dropped = 0
+        # (future, error) of operations dropped on enqueue, resolved once
+        # the lock is released
+        self.__resolved = None
+        # (operation, future, retry state) of operations to send again
+        self.__retries = None
+
+    def __add_future(self, future):
+        # position of the operation in the list detached at execute
+        if self.__futures is None:
+            self.__futures = deque()
+        self.__futures.append((len(self.backend) + self.__dropped, future))
+
+    def __resolve_later(self, future, error=None):
+        if self.__resolved is None:
+            self.__resolved = []
+        self.__resolved.append((future, error))
+
+    def __admit(self, size):
+        # returns False if the operation has to be dropped
+        limiter = self.limiter
+        if limiter.is_full() and limiter.policy in (DROP_NEWEST, DROP_OLDEST):
+            if limiter.policy == DROP_NEWEST or not self.__drop_oldest():
+                limiter.record(DROP_NEWEST)
+                return False
+            limiter.record(DROP_OLDEST)
+        limiter.acquire(1, size)
+        self.__acquired_ops += 1
+        self.__acquired_bytes += size
+        return True
+
+    def __drop_oldest(self):
+        operation = self.backend.pop_oldest()
+        if operation is None:
+            return False
+        if self.__futures and self.__futures[0][0] == self.__dropped:
+            self.__resolve_later(self.__futures.popleft()[1],
+                                 BufferFullError('operation dropped by the drop_oldest policy'))
+        self.__dropped += 1
+        size = get_operation_size(operation[1], operation[2]) if self.track_bytes else 0
+        count = get_count_name(operation[0])
+        setattr(self, count, getattr(self, count) - 1)
+        self.total_ops -= 1
+        self.total_bytes -= size
+        self.__release_limiter(1, size)
+        return True
+
+    def __release_limiter(self, ops, size):
+        self.__acquired_ops -= ops
+        self.__acquired_bytes -= size
+        self.limiter.release(ops, size)
+
+    def __spool_operation(self, op, selector, document=None, upsert=False):
+        if self.spool_segment is None:
+            self.spool_segment = self.spool.open_segment(
+                self.collection.database.name, self.collection.name)
+        self.spool_segment.append(op, selector, document, upsert)
+
+    def __release_spool_segment(self, segment, operations, error=None, retried=()):
+        # the segment keeps the operations to replay on startup, retried
+        # ones are spooled again where they are buffered
+        if segment is None:
+            return
+        if error is None:
+            segment.remove()
+        elif isinstance(error, BulkWriteError):
+            # applied and permanently failed operations are not replayed
+            replayed = get_retry_errors(error.details.get('writeErrors', []),
+                                        len(operations), self.ordered, self.__is_replayed)
+            replayed = [position for position in sorted(replayed) if position not in retried]
+            if replayed:
+                segment.rewrite([operations[position] for position in replayed])
+            else:
+                segment.remove()
+        else:
+            # unknown which operations were applied, all are replayed
+            segment.close()
 
-    def find(self, *args):
+    def __is_replayed(self, error):
+        # errors without a code are operations never executed
+        if 'code' not in error:
+            return True
+        if self.retry_policy is not None:
+            return self.retry_policy.is_transient(error)
+        return error['code'] in TRANSIENT_ERROR_CODES
+
+    def __requeue(self, entries):
+        # buffers again (operation, future, retry state) of an execution
+        if self.lock is None:
+            added = not self.sealed and self.__add_retries(entries)
+        else:
+            with self.lock:
+                added = not self.sealed and self.__add_retries(entries)
+        if not added:
+            self.redirect().__requeue(entries)
+
+    def __add_retries(self, entries):
+        if self.__retries is None:
+            self.__retries = []
+        for operation, future, state in entries:
+            op, selector, document, upsert = operation
+            size = get_operation_size(selector, document) if self.track_bytes else 0
+            if self.limiter is not None:
+                # admitted on enqueue, never dropped
+                self.limiter.acquire(1, size)
+                self.__acquired_ops += 1
+                self.__acquired_bytes += size
+            if self.spool is not None:
+                self.__spool_operation(op, selector, document, upsert)
+            if self.pending is not None:
+                self.pending.record(op, selector, document, upsert)
+            count = get_count_name(op)
+            setattr(self, count, getattr(self, count) + 1)
+            self.total_ops += 1
+            self.total_bytes += size
+            self.__retries.append((operation, future, state))
+        return True
+
+    def find(self, selector, future=False, callback=None):
         """Specify selection criteria for bulk operations.
         :Parameters:
           - `selector` (dict): the selection criteria for update
             and remove operations.
+          - `future` (optional): If ``True`` the update and remove calls
+            return a :class:`WriteFuture` of the operation. Default is
+            ``False``.
+          - `callback` (optional): callable receiving the
+            :class:`WriteFuture` of the operation once it is executed.
         :Returns:
           - A :class:`BulkWriteOperation` instance, used to add
             update and remove operations to this bulk operation.
         """
-        self.find_count += 1
-        self.total_ops += 1
-        return super(BulkOperator, self).find(*args)
+        if not future and callback is None:
+            return BulkWriteOperation(selector, self.__add_find_operation)
+
+        def add_operation(op, selector, document, upsert):
+            future = new_future(callback)
+            self.__enqueue(get_count_name(op), op, selector, document, upsert, future)
+            return future
+        return BulkWriteOperation(selector, add_operation)
+
+    def __add_find_operation(self, op, selector, document, upsert):
+        self.__enqueue(get_count_name(op), op, selector, document, upsert, None)
 
-    def insert(self, *args):
+    def add(self, op, selector, document=None, upsert=False, future=False,
+            callback=None):
+        """Add an operation given as ``(op, selector, document, upsert)``,
+        same as ``find(selector)`` followed by the `op` call, for inserts
+        `selector` is the document. returns :class:`WriteFuture` of the
+        operation if `future` is ``True`` or a `callback` is given.
+        """
+        future = new_future(callback) if future or callback is not None else None
+        if op == 'insert':
+            self.__enqueue('insert_count', op, selector, None, False, future)
+        else:
+            self.__enqueue(get_count_name(op), op, selector, document, upsert, future)
+        return future
+
+    def insert(self, document, future=False, callback=None):
         """Insert a single document.
         :Parameters:
           - `document` (dict): the document to insert
+          - `future` (optional): If ``True`` return a :class:`WriteFuture`
+            of the insert. Default is ``False``.
+          - `callback` (optional): callable receiving the
+            :class:`WriteFuture` of the insert once it is executed.
         .. seealso:: :ref:`writes-and-ids`
         """
-        self.insert_count += 1
+        future = new_future(callback) if future or callback is not None else None
+        self.__enqueue('insert_count', 'insert', document, None, False, future)
+        return future
+
+    def remove(self, selector, future=False, callback=None):
+        """Remove all documents matching `selector`, returns
+        :class:`WriteFuture` of the remove if `future` is ``True`` or a
+        `callback` is given.
+        """
+        future = new_future(callback) if future or callback is not None else None
+        self.__enqueue('remove_count', 'remove', selector, None, False, future)
+        return future
+
+    def remove_one(self, selector, future=False, callback=None):
+        """Remove a single document matching `selector`, same arguments as
+        remove.
+        """
+        future = new_future(callback) if future or callback is not None else None
+        self.__enqueue('remove_count', 'remove_one', selector, None, False, future)
+        return future
+
+    def delete_many(self, filter, future=False, callback=None):
+        """Remove all documents matching `filter`, same as remove, named as
+        :meth:`~pymongo.collection.Collection.delete_many`.
+        """
+        return self.remove(filter, future, callback)
+
+    def remove_many(self, selectors):
+        """Remove all documents matching every selector of `selectors`, an
+        iterable of selectors.
+        """
+        for selector in get_remove_selectors(selectors):
+            self.remove(selector)
+
+    def seal(self):
+        """Stop buffering in this BulkOperator once it is detached for
+        execution, later operations are passed to `redirect`. Call it
+        holding `lock`.
+        """
+        self.sealed = True
+
+    def __enqueue(self, count, op, selector, document, upsert, future):
+        check_operation(op, selector, document)
+        if self.lock is None:
+            added = not self.sealed and \
+                self.__add_operation(count, op, selector, document, upsert, future)
+            resolved, self.__resolved = self.__resolved, None
+        else:
+            with self.lock:
+                added = not self.sealed and \
+                    self.__add_operation(count, op, selector, document, upsert, future)
+                resolved, self.__resolved = self.__resolved, None
+        if resolved:
+            # callbacks of dropped operations may enqueue, the lock is free
+            for dropped_future, error in resolved:
+                if error is None:
+                    dropped_future.set_result(None)
+                else:
+                    dropped_future.set_exception(error)
+        if not added:
+            # detached by a flush or full, the operation goes to the current
+            # BulkOperator
+            self.redirect().__enqueue(count, op, selector, document, upsert, future)
+
+    def __add_operation(self, count, op, selector, document, upsert, future):
+        # `count` is the counter attribute of the operation, operations with
+        # a future are sent as they are so their outcome is their own.
+        # returns False if this BulkOperator is sealed, full of bytes
+        coalesce = delete_field = encoded = dedupe_key = None
+        if op == 'insert':
+            if self.deduplicator is not None:
+                dedupe_key = self.deduplicator.get_key(selector)
+                if dedupe_key is DUPLICATE:
+                    if future is not None:
+                        self.__resolve_later(future)
+                    return True
+            if (self.spool is not None or self.pending is not None) and '_id' not in selector:
+                selector['_id'] = ObjectId()
+        elif future is None:
+            coalesce = self.coalescer is not None and can_coalesce(op, document)
+            if self.delete_coalescer is not None and not coalesce:
+                delete_field = get_delete_field(op, selector)
+        if self.encodes and not coalesce and delete_field is None:
+            encoded, size = self.backend.encode(op, selector, document, upsert)
+        else:
+            size = get_operation_size(selector, document) if self.track_bytes else 0
+        if self.max_bytes is not None and self.total_ops and \
+                self.total_bytes + size > self.max_bytes:
+            self.sealed = True
+            return False
+        if self.limiter is not None and not self.__admit(size):
+            if future is not None:
+                self.__resolve_later(future, BufferFullError('operation dropped, buffer is full'))
+            return True
+        if dedupe_key is not None:
+            self.deduplicator.record(dedupe_key)
+        if self.spool is not None:
+            self.__spool_operation(op, selector, document, upsert)
+        if self.pending is not None:
+            self.pending.record(op, selector, document, upsert)
+        setattr(self, count, getattr(self, count) + 1)
+        self.total_bytes += size
+        if coalesce:
+            folded, closed = self.coalescer.add(op, selector, document, upsert)
+            if closed is not None:
+                self.backend.add(*closed)
+            if not folded:
+                self.total_ops += 1
+            return True
+        if delete_field is not None:
+            # a folded delete still buffers its value, max_ops_limit bounds them
+            self.delete_coalescer.add(delete_field, selector[delete_field])
+            self.total_ops += 1
+            return True
         self.total_ops += 1
-        return super(BulkOperator, self).insert(*args)
+        if self.coalescer is not None and op in UPDATE_OPS:
+            # a merged update of the selector is sent before this one
+            closed = self.coalescer.close(selector)
+            if closed is not None:
+                self.backend.add(*closed)
+        if future is not None:
+            self.__add_future(future)
+        if encoded is not None:
+            self.backend.add_encoded(encoded)
+        elif op == 'insert':
+            self.backend.insert(selector)
+        else:
+            self.backend.add(op, selector, document, upsert)
+        return True
 
-    def execute(self, *args):
+    def execute(self, write_concern=None):
         """Execute all provided operations.
         :Parameters:
           - write_concern (optional): the write concern for this bulk
             execution.
         """
-        if self.total_ops > 0:
-            ret = super(BulkOperator, self).execute(*args)
-            result_counter = {}
-            for key in ret:
-                if key in ['writeConcernErrors', 'writeErrors']:
-                    if len(ret[key]) > 0:
-                        result_counter[key] = len(ret[key])
-                        sys.stderr.write('{}:\n\t{}'.format(key, ret[key]))
-                elif key != 'upserted':
-                    result_counter[key] = ret[key]
-            return Counter(result_counter)
+        if self.lock is None:
+            detached = self.__detach()
         else:
-            return {'ops': 'No ops found'}
+            with self.lock:
+                detached = self.__detach()
+        (operations, futures, states, requeued, acquired_ops, acquired_bytes,
+         deduplicated, segment, pending) = detached
+        try:
+            if not operations:
+                if requeued:
+                    self.__get_requeue_target().__requeue(requeued)
+                self.__release_spool_segment(segment, operations)
+                if deduplicated is not None and deduplicated[1]:
+                    # every insert of the window was a duplicate
+                    return Counter({'nDeduplicated': deduplicated[1]})
+                return dict(NO_OPS_RESULT)
+            started, ret, retried = time(), None, ()
+            try:
+                if self.retry_policy is None:
+                    ret = self.backend.send(operations, write_concern)
+                else:
+                    ret, retries = self.retry_policy.send(self.backend, operations,
+                                                          write_concern, states)
+                    if retries:
+                        retried = dict(retries)
+                        futures = self.__get_retried(operations, futures, retries, requeued)
+                    if requeued:
+                        # sent again by a later execute, never waited for here
+                        self.__get_requeue_target().__requeue(requeued)
+                    if self.retry_policy.dead_letter is None and ret['writeErrors']:
+                        # given up operations are reported like failures of a
+                        # bulk_write without retries, never dropped silently
+                        raise BulkWriteError(ret)
+            except Exception as e:
+                self.__release_spool_segment(segment, operations, e, retried)
+                if futures:
+                    # errors of a retried batch list every failed operation
+                    fail_futures(futures, e, self.ordered and self.retry_policy is None)
+                raise
+            finally:
+                if self.metrics is not None:
+                    self.__record_metrics(time() - started, len(operations), ret)
+            self.__release_spool_segment(segment, operations)
+            if deduplicated is not None:
+                self.deduplicator.commit(deduplicated[0])
+            if futures:
+                resolve_futures(futures, ret)
+        finally:
+            if self.limiter is not None:
+                self.__release_limiter(acquired_ops, acquired_bytes)
+            if pending is not None:
+                pending.close()
+        result_counter = get_result_counter(ret)
+        if self.coalescer is not None:
+            folded_count = self.coalescer.folded_count + self.delete_coalescer.folded_count
+            if folded_count:
+                result_counter['nCoalesced'] = folded_count
+        if deduplicated is not None and deduplicated[1]:
+            result_counter['nDeduplicated'] = deduplicated[1]
+        return result_counter
+
+    def __get_retried(self, operations, futures, retries, requeued):
+        # returns futures of the operations not retried, entries of the
+        # retried ones are appended to requeued
+        retried_futures = dict(futures) if futures else {}
+        for position, state in retries:
+            requeued.append((operations[position], retried_futures.pop(position, None), state))
+        if futures:
+            futures = [(position, future) for position, future in futures
+                       if position in retried_futures]
+        return futures
+
+    def __get_requeue_target(self):
+        # retried operations go to the BulkOperator buffering new operations
+        return self if self.redirect is None else self.redirect()
+
+    def __detach(self):
+        # returns the operations to send, their futures, their retry states,
+        # entries of the retries which are not due, the limiter totals to
+        # release, the keys and dropped count of the deduplicator, the spool
+        # segment and the pending writes of the operations
+        self.execute_count += 1
+        if self.coalescer is not None:
+            for operation in self.coalescer.drain():
+                self.backend.add(*operation)
+        if self.delete_coalescer is not None:
+            for operation in self.delete_coalescer.drain():
+                self.backend.add(*operation)
+        futures, self.__futures = self.__futures, None
+        if futures:
+            futures = [(position - self.__dropped, future) for position, future in futures]
+        self.__dropped = 0
+        operations = self.backend.detach() if len(self.backend) else []
+        states = None
+        requeued = []
+        retries, self.__retries = self.__retries, None
+        if retries:
+            operations, futures, states, requeued = self.__merge_retries(
+                retries, operations, futures)
+        if self.sort_key is not None and len(operations) > 1:
+            order = get_locality_order(operations, self.sort_key)
+            operations = [operations[position] for position in order]
+            if states is not None:
+                states = [states[position] for position in order]
+            if futures:
+                sent_positions = dict((position, index) for index, position in enumerate(order))
+                futures = [(sent_positions[position], future) for position, future in futures]
+        deduplicated = None
+        if self.deduplicator is not None:
+            deduplicated = self.deduplicator.detach()
+        segment, self.spool_segment = self.spool_segment, None
+        pending = self.pending
+        if pending is not None:
+            # operations buffered again are indexed apart from the sent ones
+            self.pending = pending.overlay.open(pending.db_name, pending.collection)
+        return (operations, futures, states, requeued, self.__acquired_ops,
+                self.__acquired_bytes, deduplicated, segment, pending)
+
+    def __merge_retries(self, retries, operations, futures):
+        # returns operations with the due retries first, their futures and
+        # retry states, and entries of the retries which are not due
+        now = time()
+        due = [entry for entry in retries if entry[2] is None or entry[2][2] <= now]
+        if self.ordered and len(due) < len(retries):
+            # an ordered bulk waits for the retry ahead of its operations
+            buffered_futures = dict(futures) if futures else {}
+            requeued = retries + [(operation, buffered_futures.get(position), None)
+                                  for position, operation in enumerate(operations)]
+            return [], None, None, requeued
+        requeued = [entry for entry in retries if entry[2] is not None and entry[2][2] > now]
+        states = [entry[2] for entry in due] + [None] * len(operations)
+        retry_futures = [(position, entry[1]) for position, entry in enumerate(due)
+                         if entry[1] is not None]
+        if futures or retry_futures:
+            futures = retry_futures + [(position + len(due), future)
+                                       for position, future in futures or ()]
+        return [entry[0] for entry in due] + operations, futures, states, requeued
+
+    def __record_metrics(self, seconds, ops, ret):
+        size = self.total_bytes if self.track_bytes else None
+        self.metrics.record_flush(self.collection.database.name, self.collection.name,
+                                  seconds,
+                                  self.find_count + self.insert_count + self.remove_count,
+                                  ops, size, ret)
 
     def __str__(self):
         """The name of this :class:`Database`."""
-        s = '"BOFind": {}, "BOInsert": {}, "BOExecute":{}'
-        return s.format(self.find_count, self.insert_count, self.execute_count)
+        s = '"BOFind": {}, "BOInsert": {}, "BORemove": {}, "BOExecute":{}'
+        return s.format(self.find_count, self.insert_count, self.remove_count,
+                        self.execute_count)
 
     def __repr__(self):
         """The name of this :class:`Database`."""
@@ -91,19 +653,50 @@ class BulkOperator(BulkOperationBuilder):
         """
         buffered_count_dict = {
             'find': self.find_count,
-            'insert': self.insert_count
+            'insert': self.insert_count,
+            'remove': self.remove_count
         }
         return buffered_count_dict
 
 class Bulk:
 
-    def __init__(self, conn, db_name, results, max_ops_limit, ordered=True):
+    def __init__(self, conn, db_name, results, max_ops_limit, ordered=True,
+                 scheduler=None, coalesce=False, max_batch_bytes=None,
+                 backend=BulkWriteBackend, spool=None, retry_policy=None,
+                 limiter=None, metrics=None, controller=None, interval=None,
+                 write_policies=None, delete_chunk_size=1000, overlay=None,
+                 locks=None, sort_key=None, dedupe_key=None, dedupe_filters=None,
+                 current=None, schedule=None):
         self.__conn = conn
         self.__bulks = {}
+        self.__policies = {}
         self.db_name = db_name
         self.ordered = ordered
         self.max_ops_limit = max_ops_limit
         self.results = results
+        self.scheduler = scheduler
+        self.coalesce = coalesce
+        self.max_batch_bytes = max_batch_bytes
+        self.backend = backend
+        self.spool = spool
+        self.retry_policy = retry_policy
+        self.limiter = limiter
+        self.metrics = metrics
+        self.controller = controller
+        self.interval = interval
+        self.write_policies = write_policies
+        self.delete_chunk_size = delete_chunk_size
+        self.overlay = overlay
+        self.locks = locks
+        self.sort_key = sort_key
+        self.dedupe_key = dedupe_key
+        self.dedupe_filters = dedupe_filters
+        # returns the Bulk of db_name buffering new operations, operations
+        # retried after this one is flushed and dropped go there
+        self.current = current
+        # called with the time a new BulkOperator is due by the interval of
+        # its collection, so it is flushed without more writes
+        self.schedule = schedule
 
     def __next__(self):
         raise TypeError("'Bulk' object is not iterable")
@@ -118,34 +711,235 @@ class Bulk:
 
     def update_results(self, collection, curr_result):
         results_key = (self.db_name, collection)
-        self.results.setdefault(results_key, Counter())
-        self.results[results_key] += curr_result
+        if self.locks is None:
+            update_results(self.results, results_key, curr_result)
+            return
+        with self.locks.get(self.db_name, collection):
+            update_results(self.results, results_key, curr_result)
+
+    def get_policy(self, collection):
+        """returns dict of ordered, write_concern, max_ops_limit, interval,
+        bypass_document_validation, sort_key and dedupe_key of `collection`,
+        from the options of this Bulk overridden by matching write policies.
+        interval is ``None`` unless a policy sets it.
+        """
+        policy = self.__policies.get(collection)
+        if policy is None:
+            policy = {'ordered': self.ordered, 'write_concern': None,
+                      'max_ops_limit': self.max_ops_limit, 'interval': None,
+                      'bypass_document_validation': False, 'sort_key': self.sort_key,
+                      'dedupe_key': self.dedupe_key}
+            if self.write_policies is not None:
+                policy.update(self.write_policies.resolve(self.db_name, collection))
+            self.__policies[collection] = policy
+        return policy
+
+    def __new_bulk_operator(self, collection):
+        coll = self.__conn[self.db_name][collection]
+        policy = self.get_policy(collection)
+        # registers the collection in the controller so its flushes are tuned
+        interval = self.get_limits(collection)[1]
+        track_bytes = (self.max_batch_bytes is not None or
+                       (self.limiter is not None and self.limiter.max_bytes is not None))
+        lock = None
+        if self.locks is not None:
+            lock = self.locks.get(self.db_name, collection)
+        if self.current is None:
+            redirect = lambda: self.__getattr__(collection)
+        else:
+            redirect = lambda: self.current()[collection]
+        # ordered policies of a coalescing or sorting aggregator are not
+        # coalesced or sorted
+        sort_key = None if policy['ordered'] else policy['sort_key']
+        dedupe_filter = None
+        if policy['dedupe_key'] is not None and self.dedupe_filters is not None:
+            dedupe_filter = self.dedupe_filters.get(self.db_name, collection)
+        bulk_op = BulkOperator(coll, policy['ordered'], policy['bypass_document_validation'],
+                               coalesce=self.coalesce and not policy['ordered'],
+                               track_bytes=track_bytes, backend=self.backend,
+                               spool=self.spool, retry_policy=self.retry_policy,
+                               limiter=self.limiter, metrics=self.metrics,
+                               delete_chunk_size=self.delete_chunk_size,
+                               overlay=self.overlay, lock=lock, redirect=redirect,
+                               sort_key=sort_key, dedupe_key=policy['dedupe_key'],
+                               dedupe_filter=dedupe_filter, max_bytes=self.max_batch_bytes)
+        if interval is not None and self.schedule is not None:
+            self.schedule(bulk_op.created_time + interval)
+        return bulk_op
+
+    def get_limits(self, collection):
+        """returns (max_ops_limit, interval) of `collection`, from its write
+        policy and the controller tuning it, interval is ``None`` unless one
+        of them sets it
+        """
+        policy = self.get_policy(collection)
+        max_ops_limit, interval = policy['max_ops_limit'], policy['interval']
+        if self.controller is not None:
+            max_ops_limit, interval = self.controller.get_limits(
+                self.db_name, collection, max_ops_limit, interval or self.interval)
+        return max_ops_limit, interval
+
+    def is_full(self, bulk_op, collection=None):
+        """returns True if bulk_op reached max_ops_limit, or was sealed by an
+        operation which would cross max_batch_bytes. The write policy of
+        `collection` and the controller tuning it apply, and their interval
+        if set.
+        """
+        max_ops_limit, interval = self.max_ops_limit, None
+        if collection is not None:
+            max_ops_limit, interval = self.get_limits(collection)
+        if interval is not None and bulk_op.total_ops and \
+                bulk_op.created_time + interval <= time():
+            return True
+        return bulk_op.sealed or bulk_op.total_ops >= max_ops_limit
+
+    def flush_due(self, now=None):
+        """Flush the BulkOperators of collections whose own interval, set by
+        a write policy or the controller, has passed, and drop empty ones so
+        the next write schedules a new deadline. returns the time the next
+        one is due, ``None`` if none is waiting
+        """
+        now = now or time()
+        next_deadline = None
+        for collection in list(self.__bulks):
+            bulk_op = self.__bulks.get(collection)
+            if bulk_op is None:
+                continue
+            interval = self.get_limits(collection)[1]
+            if interval is None:
+                continue
+            deadline = bulk_op.created_time + interval
+            if bulk_op.total_ops and deadline > now:
+                if next_deadline is None or deadline < next_deadline:
+                    next_deadline = deadline
+                continue
+            bulk_op = self.detach(collection)
+            if bulk_op is not None and bulk_op.total_ops:
+                self.__flush_full(collection, bulk_op)
+        return next_deadline
 
     def __getattr__(self, collection):
+        if self.locks is not None:
+            return self.__get_locked(collection)
         if collection not in self.__bulks:
-            coll = self.__conn[self.db_name][collection]
-            self.__bulks[collection] = BulkOperator(coll, self.ordered)
-        elif self.__bulks[collection].total_ops >= self.max_ops_limit:
-            curr_result = Counter(self.__bulks[collection].execute())
-            self.update_results(collection, curr_result)
-            coll = self.__conn[self.db_name][collection]
-            self.__bulks[collection] = BulkOperator(coll, self.ordered)
+            self.__bulks[collection] = self.__new_bulk_operator(collection)
+        elif self.is_full(self.__bulks[collection], collection):
+            bulk_op = self.__bulks[collection]
+            self.__bulks[collection] = self.__new_bulk_operator(collection)
+            self.__flush_full(collection, bulk_op)
 
         return self.__bulks[collection]
 
+    def __flush_full(self, collection, bulk_op):
+        if self.scheduler is not None:
+            # producer gets a fresh BulkOperator, full one is flushed
+            # by the scheduler thread
+            self.scheduler.submit(self, collection, bulk_op)
+        else:
+            self.execute_bulk_operator(collection, bulk_op)
+
+    def __get_locked(self, collection):
+        # same as __getattr__ under the lock of the collection, a full
+        # BulkOperator is sealed before it is replaced and flushed
+        full_op = None
+        with self.locks.get(self.db_name, collection):
+            bulk_op = self.__bulks.get(collection)
+            if bulk_op is None:
+                bulk_op = self.__bulks[collection] = self.__new_bulk_operator(collection)
+            elif self.is_full(bulk_op, collection):
+                full_op = bulk_op
+                full_op.seal()
+                bulk_op = self.__bulks[collection] = self.__new_bulk_operator(collection)
+        if full_op is not None:
+            self.__flush_full(collection, full_op)
+        return bulk_op
+
+    def detach(self, collection):
+        """returns the BulkOperator of `collection` sealed and removed from
+        this Bulk, None if it has none, the next operation gets a new one
+        """
+        if self.locks is None:
+            return self.__bulks.pop(collection, None)
+        with self.locks.get(self.db_name, collection):
+            bulk_op = self.__bulks.pop(collection, None)
+            if bulk_op is not None:
+                bulk_op.seal()
+        return bulk_op
+
+    def __get_operators(self):
+        # BulkOperators to execute, detached if producers of other threads
+        # keep using this Bulk
+        if self.locks is None:
+            return list(self.__bulks.items())
+        operators = [(coll, self.detach(coll)) for coll in list(self.__bulks)]
+        return [(coll, bulk_op) for coll, bulk_op in operators if bulk_op is not None]
+
     def __getitem__(self, name):
         return self.__getattr__(name)
 
-    def execute(self):
-        """Call this to flush the existing cached operations at db level
+    def execute_bulk_operator(self, collection, bulk_op):
+        """Execute a BulkOperator of this db and add its result to results
+        """
+        write_concern = self.get_policy(collection)['write_concern']
+        self.__add_result(collection, bulk_op.execute(write_concern))
+
+    def __add_result(self, collection, ret):
+        # empty BulkOperators have nothing to count
+        if ret != NO_OPS_RESULT:
+            self.update_results(collection, Counter(ret))
+
+    def submit(self, executor):
+        """Submit every cached BulkOperator of this db to `executor`,
+        returns list of (collection, future) to be passed to collect
+        """
+        return [(coll, executor.submit(bulk_op.execute,
+                                       self.get_policy(coll)['write_concern']))
+                for coll, bulk_op in self.__get_operators()]
+
+    def collect(self, futures):
+        """Wait for futures returned by submit and add their results to
+        results, the first error other than BulkWriteError is raised once
+        every future is collected
+        """
+        errors = []
+        for coll, future in futures:
+            try:
+                self.__add_result(coll, future.result())
+            except BulkWriteError as bwe:
+                sys.stderr.write(str(bwe.details))
+            except Exception:
+                errors.append((coll, sys.exc_info()))
+        self.__raise_errors(errors)
+
+    def execute(self, executor=None):
+        """Call this to flush the existing cached operations at db level,
+        every collection is executed even if another one fails, the first
+        error other than BulkWriteError is raised once all are executed
+        :Parameters:
+          - `executor` (optional): A :class:`concurrent.futures.Executor`,
+            if given all collections are flushed in parallel on it.
         """
-        for coll in list(self.__bulks):
+        if executor is not None:
+            return self.collect(self.submit(executor))
+        errors = []
+        for coll, bulk_op in self.__get_operators():
             try:
-                bulkOp = self.__bulks[coll]
-                curr_result = Counter(bulkOp.execute())
-                self.update_results(coll, curr_result)
+                self.execute_bulk_operator(coll, bulk_op)
             except BulkWriteError as bwe:
                 sys.stderr.write(str(bwe.details))
+            except Exception:
+                errors.append((coll, sys.exc_info()))
+        self.__raise_errors(errors)
+
+    def __raise_errors(self, errors):
+        # errors after the first one are only written to stderr
+        for coll, exc_info in errors[1:]:
+            traceback_log = ''.join(traceback.format_exception(*exc_info))
+            sys.stderr.write('For DB [ {} ] collection [ {} ]\n\tError:\n {}'.format(
+                self.db_name, coll, traceback_log))
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0][1]
+            raise exc_value
 
     def get_buffered_query_count(self):
         """
@@ -153,28 +947,218 @@ class Bulk:
         {'insert': count, 'find': count}
         """
         buffered_query_count = {}
-        for collection in self.__bulks:
-            query_count_dict = self.__bulks[collection].get_buffered_query_count()
+        for collection, bulk_op in list(self.__bulks.items()):
+            query_count_dict = bulk_op.get_buffered_query_count()
             buffered_query_count[(collection, self.db_name)] = query_count_dict
         return buffered_query_count
 
 class MongoQueryAggregator:
 
-    def __init__(self, mongodb_settings, interval, max_ops_limit):
+    # set once __init__ created every attribute, lookups of missing ones
+    # would go to __getattr__
+    __initialized = False
+
+    def __init__(self, mongodb_settings, interval, max_ops_limit,
+                 background_flush=False, max_workers=None, ordered=True,
+                 coalesce=False, max_batch_bytes=None, backend=BulkWriteBackend,
+                 spool_dir=None, spool_fsync_interval=1.0, retry_policy=None,
+                 max_buffered_ops=None, max_buffered_bytes=None,
+                 overflow_policy=FLUSH, block_timeout=None, batch_controller=None,
+                 write_policies=None, max_counter_keys=100000,
+                 delete_chunk_size=1000, read_overlay=False, thread_safe=False,
+                 clusters=None, routes=None, lanes=None, sort_key=None,
+                 dedupe_key=None, dedupe_filter_capacity=None, dedupe_error_rate=1e-6):
         """Initialize a new MongoQueryAggregator.
         :Parameters:
           - `interval`: A :Integer:`seconds`.
-          - `mongodb_settings` :dict: mongdb Settings.
+          - `mongodb_settings` :dict: mongdb Settings, of the default
+            cluster if `clusters` are given.
           - `max_ops_limit`: A :Integer: max number of operation a Bulk can hold for a collection
             crossing this limit it will execute already cached operations
+          - `background_flush` (optional): If ``True`` start a
+            :class:`FlushScheduler` thread which flushes every `interval`
+            and executes collections crossing `max_ops_limit`, so producers
+            never pay for a flush. The flush thread races the producers, so
+            it implies `thread_safe`. Default is ``False``.
+          - `max_workers` (optional): A :Integer: max number of collections
+            flushed concurrently by execute, across all databases. Default
+            is ``None`` which flushes collections one after another.
+          - `ordered` (optional): If ``False`` bulks are unordered, the
+            server may apply operations in any order. Default is ``True``.
+          - `coalesce` (optional): If ``True`` merge compatible updates on an
+            identical selector and fold single equality deletes into ``$in``
+            deletes before flushing, requires ``ordered=False``. Folded away
+            operations are counted as ``nCoalesced`` in results. Default is
+            ``False``.
+          - `delete_chunk_size` (optional): max values of a ``$in`` delete
+            folded by `coalesce`. Default is ``1000``.
+          - `sort_key` (optional): indexed field of selectors, e.g. ``'id'``,
+            every batch is sorted by before it is sent, inserts by the field
+            or their ``_id``, with inserts, updates and removes grouped in
+            runs of one kind for fewer commands, requires ``ordered=False``.
+            Write policies can set it per collection. Default is ``None``.
+          - `dedupe_key` (optional): dotted field of inserted documents used
+            as idempotency key, e.g. ``'_id'``, inserts repeating the key of
+            an insert buffered since the last flush of the collection are
+            dropped before they are sent and counted as ``nDeduplicated`` in
+            results. Write policies can set it per collection. Default is
+            ``None``.
+          - `dedupe_filter_capacity` (optional): keys of executed inserts
+            remembered per deduplicated collection by a
+            :class:`RotatingBloomFilter`, so duplicates of earlier flushes
+            are dropped too. Default is ``None`` which only deduplicates
+            within a flush.
+          - `dedupe_error_rate` (optional): false positive rate of the
+            filters, a false positive drops a new insert. Default is
+            ``1e-6``.
+          - `read_overlay` (optional): If ``True`` buffered operations are
+            indexed in a :class:`PendingWriteOverlay` so :meth:`find_one`
+            merges them into the stored document instead of flushing.
+            Default is ``False``.
+          - `thread_safe` (optional): If ``True`` producers may share the
+            aggregator across threads, the buffer of every collection is
+            guarded by one of a set of :class:`LockStripes` so threads
+            writing to different collections do not wait on each other. A
+            flush seals the buffers it sends, operations added to a sealed
+            buffer through a held reference go to the current one. Always on
+            with `background_flush` or once :meth:`start_scheduler` is
+            called. Default is ``False``.
+          - `clusters` (optional): dict of cluster name to mongodb settings,
+            every cluster gets its own MongoClient. The databases of each
+            cluster are flushed on a thread of the cluster, with a pool of
+            `max_workers` of its own if set, so a slow cluster does not delay
+            the writes of the others. Flushes of the :class:`FlushScheduler`
+            do not wait for slow clusters. The name ``'default'`` is the
+            cluster of `mongodb_settings`. Default is ``None``.
+          - `routes` (optional): dict of database name pattern to cluster
+            name, see :class:`ClusterRouter`, databases matching no route
+            use `mongodb_settings`. Default is ``None``.
+          - `lanes` (optional): dict of lane name to dict of `interval`,
+            `max_ops_limit` and `priority` of a :class:`PriorityLane`, e.g.
+            ``{'realtime': {'interval': 0.005, 'max_ops_limit': 50,
+            'priority': 1}}``. Operations written through :meth:`lane` are
+            buffered in the lane and flushed by its own deadline and batch
+            limit, other operations are in the ``'default'`` lane of
+            `interval` and `max_ops_limit`. execute flushes lanes of higher
+            priority first, each lane has its own flush threads so it never
+            waits behind a batch of another lane. Options left out are the
+            ones of the default lane. Default is ``None``.
+          - `max_batch_bytes` (optional): A :Integer: max encoded BSON size
+            in bytes a Bulk can hold for a collection, cached operations are
+            executed before an operation which would cross it is buffered.
+            Default is ``None`` which does not track sizes.
+          - `backend` (optional): backend used by every BulkOperator to
+            buffer and send operations. Default is :class:`BulkWriteBackend`.
+          - `spool_dir` (optional): directory of a durable :class:`Spool`,
+            every operation is written there before it is buffered and
+            removed once executed. Spooled operations left by a previous
+            process are replayed here. Default is ``None``.
+          - `spool_fsync_interval` (optional): seconds between group
+            committed fsyncs of the spool. Default is ``1.0``.
+          - `retry_policy` (optional): A :class:`RetryPolicy` retrying
+            transient failures of flushes with backoff and dead lettering
+            permanent ones, retried and dead lettered operations are counted
+            as ``nRetried`` and ``nDeadLettered`` in results. Retried
+            operations are buffered again and sent by the first flush of
+            their collection after their backoff, no flush waits for them.
+            Failures it gives up on without a dead letter are reported to
+            stderr. Default is ``None`` which reports failures to stderr.
+          - `max_buffered_ops` (optional): A :Integer: cap on operations
+            buffered across all databases and collections. Default is ``None``.
+          - `max_buffered_bytes` (optional): A :Integer: cap on encoded BSON
+            bytes buffered across all databases and collections. Default is
+            ``None``.
+          - `overflow_policy` (optional): applied once a cap is reached, one
+            of ``'block'``, ``'flush'``, ``'drop_newest'`` or ``'drop_oldest'``,
+            see :class:`BufferLimiter`. ``'block'`` waits for the background
+            flush and behaves like ``'flush'`` without `background_flush`.
+            Default is ``'flush'``.
+          - `block_timeout` (optional): seconds a producer is blocked by the
+            ``'block'`` policy before BufferFullError is raised. Default is
+            ``None`` which waits forever.
+          - `batch_controller` (optional): An :class:`AdaptiveBatchController`
+            tuning batch size and flush interval of every collection from
+            its flushes, `max_ops_limit` and `interval` are the initial
+            values and `interval` still flushes everything. A collection is
+            flushed once its interval passes, by the scheduler with
+            `background_flush`, else by the next lookup on the aggregator,
+            whichever collection it is for. Default is ``None``.
+          - `write_policies` (optional): A :class:`WritePolicyRegistry` or a
+            dict of pattern to :class:`WritePolicy`, setting ordered, write
+            concern, max_ops_limit, interval, bypass_document_validation,
+            sort_key and dedupe_key of the matching databases and
+            collections, e.g.
+            ``{'analytics': {'ordered': False, 'write_concern': {'w': 1}},
+            'billing.*': {'write_concern': {'w': 'majority'}}}``. A policy
+            interval can only flush sooner than `interval`, it is a deadline
+            of the collection like a tuned interval of `batch_controller`.
+            Default is ``None``.
+          - `max_counter_keys` (optional): max selectors whose totals are
+            held by :meth:`counter`, the least recently incremented are sent
+            beyond it. Default is ``100000``.
+        .. note:: the caps are checked when a database is looked up on the
+          aggregator, keep ``aggregator.db.coll`` lookups per operation
+          instead of holding Bulk or BulkOperator references.
         """
-        self.__conn = None
-        self.__dbs = {}
+        # arguments are checked before any state is set
+        if coalesce and ordered:
+            raise ValueError('coalesce is only supported with ordered=False')
+        if sort_key is not None and ordered:
+            raise ValueError('sort_key is only supported with ordered=False')
+        check_lanes(lanes)
+        router = ClusterRouter(mongodb_settings, clusters, routes)
+        limiter = None
+        if max_buffered_ops is not None or max_buffered_bytes is not None:
+            limiter = BufferLimiter(max_buffered_ops, max_buffered_bytes,
+                                    overflow_policy, block_timeout)
+        if isinstance(write_policies, dict):
+            write_policies = WritePolicyRegistry(write_policies)
         self.__interval = interval
+        self.__scheduler = None
+        self.__execute_lock = threading.RLock()
+        self.__dbs_lock = threading.Lock()
+        self.__max_workers = max_workers
+        self.__executors = {}
+        self.__writers = {}
+        self.__lanes = new_lanes(lanes, interval, max_ops_limit)
+        self.__lanes_by_name = dict((lane.name, lane) for lane in self.__lanes)
+        self.__default = self.__lanes_by_name[DEFAULT_LANE]
+        self.__views = {}
         self.mongodb_settings = mongodb_settings
+        self.router = router
         self.max_ops_limit = max_ops_limit
+        self.ordered = ordered
+        self.coalesce = coalesce
+        self.delete_chunk_size = delete_chunk_size
+        self.sort_key = sort_key
+        self.dedupe_key = dedupe_key
+        self.dedupe_filters = None
+        if dedupe_filter_capacity:
+            self.dedupe_filters = DedupeFilters(dedupe_filter_capacity, dedupe_error_rate)
+        self.overlay = PendingWriteOverlay() if read_overlay else None
+        # a background flush detaches buffers producers are appending to
+        self.locks = LockStripes() if thread_safe or background_flush else None
+        self.max_batch_bytes = max_batch_bytes
+        self.backend = backend
+        self.spool = None
+        self.retry_policy = retry_policy
+        self.limiter = limiter
+        self.metrics = FlushMetrics()
+        self.batch_controller = batch_controller
+        self.write_policies = write_policies
+        self.counters = CounterStore(self.__emit_counter, max_counter_keys)
+        if batch_controller is not None:
+            if batch_controller.max_interval is None:
+                batch_controller.max_interval = interval
+            self.metrics.listeners.append(batch_controller.record_flush)
         self.last_execution_time = time()
         self.results = {}
+        self.__initialized = True
+        if spool_dir is not None:
+            self.spool = Spool(spool_dir, spool_fsync_interval)
+            self.replay_spool()
+        if background_flush:
+            self.start_scheduler()
 
     def __str__(self):
         """Interval for batching:`seconds`."""
@@ -184,40 +1168,383 @@ class MongoQueryAggregator:
         """Interval for batching:`seconds`."""
         return self.__str__()
 
-    def __connection(self):
-        if not self.__conn:
-            self.mongodb_settings['connect'] = False
-            self.__conn = MongoClient(**self.mongodb_settings)
-        return self.__conn
+    def __connection(self, db_name):
+        return self.router.get_database_client(db_name)
 
     def __getattr__(self, db_name):
-        if self.__interval + self.last_execution_time <= time():
+        if self.__scheduler is None:
+            self.__check_deadlines()
+        if self.limiter is not None and self.limiter.is_full():
+            self.__apply_backpressure()
+        return self.__get_bulk(db_name)
+
+    def __check_deadlines(self):
+        now = time()
+        if self.__interval + self.last_execution_time <= now:
             self.execute()
+            return
+        if self.__default.has_due_collections(now):
+            self.__flush_due(self.__default, now)
+        if len(self.__lanes) == 1:
+            return
+        for lane in self.__lanes:
+            if lane is self.__default:
+                continue
+            if lane.is_due(now):
+                self.execute_lane(lane.name)
+            elif lane.has_due_collections(now):
+                self.__flush_due(lane, now)
+
+    def flush_due(self, name=None):
+        """Flush the collections of lane `name`, default lane if ``None``,
+        whose own interval has passed, see the write_policies and
+        batch_controller options
+        """
+        self.__flush_due(self.__default if name is None else self.__get_lane(name), time())
+
+    def get_next_deadline(self, name=None):
+        """returns the time a collection of lane `name`, default lane if
+        ``None``, is due by its own interval, ``None`` if none is waiting
+        """
+        lane = self.__default if name is None else self.__get_lane(name)
+        return lane.next_deadline
+
+    def __flush_due(self, lane, now):
+        # deadlines of collections not due are scheduled again, those of
+        # BulkOperators created meanwhile are scheduled on creation
+        lane.next_deadline = None
+        for bulk in list(lane.dbs.values()):
+            deadline = bulk.flush_due(now)
+            if deadline is not None:
+                lane.schedule(deadline)
+
+    def __get_bulk(self, db_name, lane=None):
+        if lane is None:
+            lane = self.__default
+        bulk = lane.dbs.get(db_name)
+        if bulk is not None:
+            return bulk
+        if self.locks is None:
+            return self.__new_bulk(db_name, lane)
+        with self.__dbs_lock:
+            bulk = lane.dbs.get(db_name)
+            if bulk is None:
+                bulk = self.__new_bulk(db_name, lane)
+        return bulk
 
-        if db_name not in self.__dbs:
-            self.__dbs[db_name] = Bulk(self.__connection(), db_name, self.results, self.max_ops_limit)
-        return self.__dbs[db_name]
+    def __new_bulk(self, db_name, lane):
+        bulk = lane.dbs[db_name] = Bulk(self.__connection(db_name), db_name, self.results,
+                                        lane.max_ops_limit, self.ordered,
+                                        scheduler=lane.scheduler, coalesce=self.coalesce,
+                                        max_batch_bytes=self.max_batch_bytes,
+                                        backend=self.backend, spool=self.spool,
+                                        retry_policy=self.retry_policy,
+                                        limiter=self.limiter, metrics=self.metrics,
+                                        controller=self.batch_controller,
+                                        interval=lane.interval,
+                                        write_policies=self.write_policies,
+                                        delete_chunk_size=self.delete_chunk_size,
+                                        overlay=self.overlay, locks=self.locks,
+                                        sort_key=self.sort_key,
+                                        dedupe_key=self.dedupe_key,
+                                        dedupe_filters=self.dedupe_filters,
+                                        current=lambda: self.__get_bulk(db_name, lane),
+                                        schedule=lane.schedule)
+        return bulk
+
+    def lane(self, name):
+        """returns :class:`LaneView` of lane `name`, its databases buffer
+        operations in the lane, e.g.
+        ``aggregator.lane('realtime').users.sessions.insert(document)``
+        """
+        view = self.__views.get(name)
+        if view is None:
+            lane = self.__get_lane(name)
+            view = self.__views[name] = LaneView(
+                lane, lambda db_name: self.__get_lane_bulk(lane, db_name))
+        return view
+
+    def __get_lane(self, name):
+        lane = self.__lanes_by_name.get(name)
+        if lane is None:
+            raise ValueError('unknown lane {}'.format(name))
+        return lane
+
+    def __get_lane_bulk(self, lane, db_name):
+        if lane is self.__default:
+            return self.__getattr__(db_name)
+        if lane.scheduler is None:
+            self.__check_deadlines()
+        if self.limiter is not None and self.limiter.is_full():
+            self.__apply_backpressure()
+        return self.__get_bulk(db_name, lane)
 
     def __getitem__(self, name):
         return self.__getattr__(name)
 
+    def __apply_backpressure(self):
+        if self.limiter.policy == BLOCK and self.__scheduler is not None:
+            self.__scheduler.request_flush()
+            self.limiter.wait()
+        elif self.limiter.policy in (BLOCK, FLUSH):
+            self.limiter.record(FLUSH)
+            self.execute()
+
+    def get_backpressure_stats(self):
+        """returns dict with currently buffered_ops and buffered_bytes and
+        counters of backpressure events: blocked, block_timeouts, flush,
+        drop_newest and drop_oldest, empty if no cap is configured
+        """
+        if self.limiter is None:
+            return {}
+        return self.limiter.get_stats()
+
+    def get_metrics(self):
+        """returns snapshot dict of flush metrics: uptime, enqueued (ops of
+        finished flushes), enqueue_rate, buffered_ops, pending_flushes, seconds_since_last_flush
+        and under `collections`, keyed by (db_name, collection), counters of
+        flushes, errors, enqueued, ops, bytes, retries, dead_lettered and
+        write_errors with latency, ops_per_flush and bytes_per_flush
+        histograms. Bytes are only known with max_batch_bytes or
+        max_buffered_bytes set.
+        """
+        buffered_ops = sum(sum(counts.values())
+                           for counts in self.get_buffered_query_count().values())
+        pending_flushes = sum(lane.scheduler.get_pending_count() for lane in self.__lanes
+                              if lane.scheduler is not None)
+        return self.metrics.snapshot(buffered_ops, pending_flushes,
+                                     self.last_execution_time)
+
+    def get_metrics_text(self):
+        """returns get_metrics in the Prometheus text exposition format"""
+        return render_prometheus(self.get_metrics())
+
     def execute(self):
-        """Call this to flush the existing cached operations
+        """Call this to flush the existing cached operations, of lanes with
+        a higher priority first
         """
-        for db_name in list(self.__dbs):
+        with self.__execute_lock:
+            self.counters.flush()
+            for lane in self.__lanes:
+                self.__execute_lane(lane)
+            self.last_execution_time = time()
+
+    def execute_lane(self, name):
+        """Flush the cached operations of lane `name` only"""
+        lane = self.__get_lane(name)
+        if lane is self.__default:
+            # the default lane also holds the counters
+            with self.__execute_lock:
+                self.counters.flush()
+                self.__execute_lane(lane)
+            return
+        self.__execute_lane(lane)
+
+    def __execute_lane(self, lane):
+        with lane.lock:
+            # every BulkOperator is flushed, new ones schedule their deadline
+            lane.next_deadline = None
+            if self.locks is None:
+                # detach buffered dbs first so new operations go to fresh Bulks
+                dbs, lane.dbs = lane.dbs, {}
+            else:
+                # Bulks are shared by producers, every Bulk detaches its
+                # BulkOperators under their lock
+                dbs = dict(lane.dbs)
+            if self.__executors is None:
+                # finalizing, the workers of the executors may be gone
+                self.__execute_sequential(dbs, list(dbs))
+            elif len(self.router.clusters) > 1:
+                self.__execute_clusters(dbs, lane)
+            elif self.__max_workers:
+                self.__execute_parallel(dbs, self.__get_executor(lane, parallel=True), list(dbs))
+            else:
+                self.__execute_sequential(dbs, list(dbs))
+            lane.last_execution_time = time()
+
+    def __get_executor(self, lane, cluster=None, parallel=False):
+        # executors are per lane so a lane is never queued behind the
+        # flush of another one, called under the lock of the lane. A cluster
+        # has a single thread, and with max_workers a pool of its own
+        key = (lane.name, cluster, parallel)
+        executor = self.__executors.get(key)
+        if executor is None:
+            max_workers = self.__max_workers if parallel else 1
+            executor = self.__executors[key] = ThreadPoolExecutor(max_workers=max_workers)
+        return executor
+
+    def __execute_sequential(self, dbs, db_names):
+        for db_name in db_names:
             try:
-                self.__dbs[db_name].execute()
+                dbs[db_name].execute()
             except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-                traceback_log = ''.join(line for line in lines)
-                sys.stderr.write('For DB [ {} ]\n\tError:\n {}'.format(db_name, traceback_log))
-        self.__dbs = {}
-        self.last_execution_time = time()
+                self.__log_db_error(db_name)
+
+    def __execute_clusters(self, dbs, lane):
+        # dbs of a cluster are flushed on the thread of the cluster, in order
+        # or on its pool with max_workers, clusters are flushed concurrently.
+        # Background flushes do not wait for them, a slow cluster would hold
+        # back the next flush of every other one
+        db_names = {}
+        for db_name in list(dbs):
+            db_names.setdefault(self.router.get_cluster(db_name), []).append(db_name)
+        futures = []
+        for cluster, names in db_names.items():
+            executor = self.__get_executor(lane, cluster)
+            if self.__max_workers:
+                futures.append(executor.submit(self.__execute_parallel, dbs,
+                                               self.__get_executor(lane, cluster, True), names))
+            else:
+                futures.append(executor.submit(self.__execute_sequential, dbs, names))
+        if isinstance(threading.current_thread(), FlushScheduler):
+            return
+        for future in futures:
+            future.result()
+
+    def __execute_parallel(self, dbs, executor, db_names):
+        # submit every collection of every db before waiting on any of them
+        submitted = []
+        for db_name in db_names:
+            try:
+                submitted.append((db_name, dbs[db_name].submit(executor)))
+            except Exception as e:
+                self.__log_db_error(db_name)
+        for db_name, futures in submitted:
+            try:
+                dbs[db_name].collect(futures)
+            except Exception as e:
+                self.__log_db_error(db_name)
+
+    def __log_db_error(self, db_name):
+        exc_type, exc_value, exc_traceback = sys.exc_info()
+        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+        traceback_log = ''.join(line for line in lines)
+        sys.stderr.write('For DB [ {} ]\n\tError:\n {}'.format(db_name, traceback_log))
+
+    def counter(self, db_name, collection, selector):
+        """returns :class:`CounterHandle` of the document matching `selector`
+        in db_name.collection, its increments are summed in memory and sent
+        as one upsert ``{'$inc': totals}`` per selector and flush.
+        """
+        if self.__scheduler is None:
+            self.__check_deadlines()
+        return CounterHandle(self.counters, db_name, collection, selector)
+
+    def __emit_counter(self, db_name, collection, selector, update):
+        # skips the interval check of __getattr__, counters are also emitted
+        # by execute
+        self.__get_bulk(db_name)[collection].add('update_one', selector, update, True)
+
+    def collection(self, db_name, collection, check_every=100):
+        """returns the cached :class:`CollectionWriter` of db_name.collection,
+        a handle enqueueing with less overhead than ``aggregator.db.coll``,
+        interval, backpressure and batch limits are checked every
+        `check_every` operations.
+        """
+        writer = self.__writers.get((db_name, collection))
+        if writer is None:
+            writer = CollectionWriter(self, db_name, collection, check_every)
+            self.__writers[(db_name, collection)] = writer
+        return writer
+
+    def find_one(self, db_name, collection, selector):
+        """returns the document of db_name.collection matching `selector`
+        including the buffered writes. With `read_overlay` inserts, removes,
+        replacements and ``$set`` updates buffered on an identical equality
+        selector are merged into the stored document, or answer without a
+        read when they set the whole document. Other buffered writes of the
+        collection, or no overlay, flush the aggregator before the read.
+        """
+        coll = self.__connection(db_name)[db_name][collection]
+        if self.overlay is None:
+            self.execute()
+            return coll.find_one(selector)
+        return self.overlay.find_one(db_name, collection, selector,
+                                     lambda: coll.find_one(selector), self.execute)
+
+    def enqueue(self, db_name, collection, op, selector, document=None, upsert=False,
+                future=False, callback=None, lane=None):
+        """Buffer an operation given as ``(op, selector, document, upsert)``,
+        the format used by the spool and the funnel, for inserts `selector`
+        is the document. returns :class:`WriteFuture` of the operation if
+        `future` is ``True`` or a `callback` is given, it is resolved once the
+        operation is executed, callbacks run on the flushing thread. The
+        operation is buffered in `lane` if given, else in the default lane.
+        """
+        bulk = self[db_name] if lane is None else self.lane(lane)[db_name]
+        return bulk[collection].add(op, selector, document, upsert, future, callback)
+
+    def replay_spool(self):
+        """Buffer again all operations found in the spool, they are spooled
+        in new segments before the old segments are deleted
+        """
+        paths = self.spool.get_segment_paths()
+        for path in paths:
+            db_name, collection, records = self.spool.read_segment(path)
+            for record in records:
+                self.enqueue(db_name, collection, record['op'], record['s'],
+                             record.get('d'), record['u'])
+        self.spool.sync()
+        for path in paths:
+            os.remove(path)
+
+    def start_scheduler(self):
+        """Start a background FlushScheduler thread for this aggregator,
+        returns the running scheduler
+        """
+        if self.__scheduler is None:
+            if self.locks is None:
+                # Bulks created without locks are flushed and dropped, the
+                # next ones seal their buffers before the scheduler sends them
+                self.execute()
+                self.locks = LockStripes()
+            # every other lane gets its own thread flushing it by its interval
+            for lane in self.__lanes:
+                if lane is self.__default:
+                    lane.scheduler = FlushScheduler(self, self.__interval)
+                else:
+                    lane.scheduler = FlushScheduler(self, lane.interval, lane)
+                for bulk in list(lane.dbs.values()):
+                    bulk.scheduler = lane.scheduler
+            self.__scheduler = self.__default.scheduler
+            for lane in self.__lanes:
+                lane.scheduler.start()
+        return self.__scheduler
+
+    def stop_scheduler(self, flush=True, timeout=None):
+        """Stop the background FlushScheduler and wait for it to join.
+        :Parameters:
+          - `flush` (optional): If ``True`` flush all buffered operations
+            after the scheduler is stopped.
+          - `timeout` (optional): seconds to wait for the thread to join.
+        """
+        if self.__scheduler is None:
+            return
+        self.__scheduler = None
+        schedulers = []
+        for lane in self.__lanes:
+            schedulers.append(lane.scheduler)
+            lane.scheduler = None
+            for bulk in list(lane.dbs.values()):
+                bulk.scheduler = None
+        # lanes of higher priority are flushed first
+        for scheduler in schedulers:
+            scheduler.stop(flush=flush, timeout=timeout)
 
     def __del__(self):
         """execute all pending queries on deleting instance of MongoQueryAggregator"""
+        if not self.__initialized:
+            # __init__ raised on its arguments, nothing was buffered
+            return
+        self.stop_scheduler(flush=False)
+        # a collected cycle clears the weakrefs of its executors first, which
+        # stops their workers, so the last flush runs on this thread
+        executors, self.__executors = self.__executors, None
+        for executor in executors.values():
+            executor.shutdown(wait=False)
         self.execute()
+        if self.spool is not None:
+            self.spool.close()
 
     def get_results(self):
         return self.results
@@ -226,8 +1553,9 @@ class MongoQueryAggregator:
         """this function returns current results and resets results"""
         results = self.results
         self.results = {}
-        for db_name, bulkOp in self.__dbs.iteritems():
-            bulkOp.results = self.results
+        for lane in self.__lanes:
+            for bulkOp in list(lane.dbs.values()):
+                bulkOp.results = self.results
         return results
 
     def get_buffered_query_count(self):
@@ -237,7 +1565,12 @@ class MongoQueryAggregator:
         and value will be dict having keys insert and find with value as there count
         """
         buffered_query_count = {}
-        for db_name in list(self.__dbs):
-            query_count = self.__dbs[db_name].get_buffered_query_count()
-            buffered_query_count.update(query_count)
+        for lane in self.__lanes:
+            for bulk in list(lane.dbs.values()):
+                for key, query_count in bulk.get_buffered_query_count().items():
+                    if key in buffered_query_count:
+                        # same collection buffered in several lanes
+                        query_count = dict((op, count + buffered_query_count[key].get(op, 0))
+                                           for op, count in query_count.items())
+                    buffered_query_count[key] = query_count
         return buffered_query_count
@@ -0,0 +1,219 @@
+from bisect import bisect_left
+from collections import deque
+from time import time
+import threading
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+OPS_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+BYTES_BUCKETS = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20,
+                 1 << 22, 1 << 24, 48000000)
+
+# seconds enqueue_rate is averaged over, from one sample per second
+RATE_WINDOW = 60
+
+COUNTER_KEYS = ('flushes', 'errors', 'enqueued', 'ops', 'bytes', 'retries',
+                'dead_lettered', 'write_errors')
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        """Fixed bucket histogram, memory does not grow with observations.
+        :Parameters:
+          - `buckets`: sorted upper bounds, an implicit +Inf bucket is added.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """returns dict with cumulative `buckets` as list of (upper bound,
+        count), `sum` and `count`
+        """
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class CollectionMetrics(object):
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.ops_per_flush = Histogram(OPS_BUCKETS)
+        self.bytes_per_flush = Histogram(BYTES_BUCKETS)
+        self.counters = dict((key, 0) for key in COUNTER_KEYS)
+        self.last_flush_time = None
+
+    def snapshot(self, now):
+        snapshot = dict(self.counters)
+        snapshot['latency'] = self.latency.snapshot()
+        snapshot['ops_per_flush'] = self.ops_per_flush.snapshot()
+        snapshot['bytes_per_flush'] = self.bytes_per_flush.snapshot()
+        snapshot['seconds_since_last_flush'] = None
+        if self.last_flush_time is not None:
+            snapshot['seconds_since_last_flush'] = now - self.last_flush_time
+        return snapshot
+
+
+class FlushMetrics(object):
+
+    def __init__(self):
+        """Flush instrumentation of a MongoQueryAggregator. Nothing is
+        recorded while operations are enqueued, every BulkOperator reports
+        once per flush, so the enqueue path has no extra cost. Memory is
+        bounded by the number of collections written to. Callables in
+        `listeners` are called with the arguments of every record_flush.
+        """
+        self.start_time = time()
+        self.__collections = {}
+        self.__lock = threading.Lock()
+        self.__enqueued = 0
+        # (time, enqueued) at most one per second, written by flushes only so
+        # snapshots of several readers do not disturb each other
+        self.__samples = deque([(self.start_time, 0)], maxlen=RATE_WINDOW + 1)
+        self.listeners = []
+
+    def record_flush(self, db_name, collection, seconds, enqueued, ops,
+                     size=None, result=None):
+        """Record a flush of `ops` operations, `enqueued` before coalescing,
+        which took `seconds`. `size` is the encoded size in bytes if tracked
+        and `result` the bulk api result, None if the flush failed.
+        """
+        with self.__lock:
+            metrics = self.__collections.get((db_name, collection))
+            if metrics is None:
+                metrics = self.__collections[(db_name, collection)] = CollectionMetrics()
+            counters = metrics.counters
+            counters['flushes'] += 1
+            counters['enqueued'] += enqueued
+            counters['ops'] += ops
+            metrics.latency.observe(seconds)
+            metrics.ops_per_flush.observe(ops)
+            if size is not None:
+                counters['bytes'] += size
+                metrics.bytes_per_flush.observe(size)
+            if result is None:
+                counters['errors'] += 1
+            else:
+                counters['retries'] += result.get('nRetried', 0)
+                counters['dead_lettered'] += result.get('nDeadLettered', 0)
+                counters['write_errors'] += len(result.get('writeErrors', []))
+            metrics.last_flush_time = now = time()
+            self.__enqueued += enqueued
+            if now - self.__samples[-1][0] >= 1:
+                self.__samples.append((now, self.__enqueued))
+        for listener in self.listeners:
+            listener(db_name, collection, seconds, enqueued, ops, size, result)
+
+    def snapshot(self, buffered_ops=0, pending_flushes=0, last_execution_time=None):
+        """returns dict of all metrics, per collection ones are under
+        `collections` keyed by (db_name, collection). `enqueued` counts the
+        operations of finished flushes, it never decreases, `enqueue_rate`
+        is their number per second over the last `RATE_WINDOW` seconds.
+        Reading a snapshot changes no state.
+        """
+        now = time()
+        with self.__lock:
+            collections = dict((key, metrics.snapshot(now))
+                               for key, metrics in self.__collections.items())
+            enqueued = self.__enqueued
+            samples = list(self.__samples)
+        # oldest sample within the window, the latest one if flushes stopped
+        sample_time, sample_enqueued = samples[-1]
+        for sample in samples:
+            if sample[0] >= now - RATE_WINDOW:
+                sample_time, sample_enqueued = sample
+                break
+        snapshot = {
+            'uptime': now - self.start_time,
+            'enqueued': enqueued,
+            'enqueue_rate': (enqueued - sample_enqueued) / max(now - sample_time, 1e-9),
+            'buffered_ops': buffered_ops,
+            'pending_flushes': pending_flushes,
+            'seconds_since_last_flush': None,
+            'collections': collections,
+        }
+        if last_execution_time is not None:
+            snapshot['seconds_since_last_flush'] = now - last_execution_time
+        return snapshot
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(snapshot, prefix='moquag'):
+    """Render a FlushMetrics snapshot in the Prometheus text exposition
+    format
+    """
+    lines = []
+
+    def add_metric(name, kind, help_text, samples):
+        name = '{}_{}'.format(prefix, name)
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for suffix, labels, value in samples:
+            label_text = ','.join('{}="{}"'.format(key, _escape(label))
+                                  for key, label in labels)
+            if label_text:
+                label_text = '{' + label_text + '}'
+            lines.append('{}{}{} {}'.format(name, suffix, label_text, _format_value(value)))
+
+    collections = sorted(snapshot['collections'].items())
+
+    def histogram_samples(key):
+        samples = []
+        for (db_name, collection), metrics in collections:
+            labels = (('db', db_name), ('collection', collection))
+            histogram = metrics[key]
+            for bound, count in histogram['buckets']:
+                samples.append(('_bucket', labels + (('le', _format_value(bound)),), count))
+            samples.append(('_sum', labels, histogram['sum']))
+            samples.append(('_count', labels, histogram['count']))
+        return samples
+
+    def counter_samples(key):
+        return [('', (('db', db_name), ('collection', collection)), metrics[key])
+                for (db_name, collection), metrics in collections]
+
+    add_metric('flush_duration_seconds', 'histogram', 'Duration of bulk flushes.',
+               histogram_samples('latency'))
+    add_metric('flush_ops', 'histogram', 'Operations sent per bulk flush.',
+               histogram_samples('ops_per_flush'))
+    add_metric('flush_bytes', 'histogram', 'Encoded bytes sent per bulk flush.',
+               histogram_samples('bytes_per_flush'))
+    for key, help_text in (
+            ('flushes', 'Bulk flushes.'),
+            ('errors', 'Bulk flushes which raised an error.'),
+            ('enqueued', 'Operations enqueued and flushed.'),
+            ('ops', 'Operations sent after coalescing.'),
+            ('bytes', 'Encoded bytes sent, if sizes are tracked.'),
+            ('retries', 'Operations retried.'),
+            ('dead_lettered', 'Operations given up on.'),
+            ('write_errors', 'Write errors reported by flushes.')):
+        add_metric('{}_total'.format(key), 'counter', help_text, counter_samples(key))
+    add_metric('enqueued_ops_total', 'counter', 'Operations enqueued and flushed.',
+               [('', (), snapshot['enqueued'])])
+    add_metric('buffered_ops', 'gauge', 'Operations currently buffered.',
+               [('', (), snapshot['buffered_ops'])])
+    add_metric('pending_flushes', 'gauge', 'BulkOperators waiting for the scheduler.',
+               [('', (), snapshot['pending_flushes'])])
+    if snapshot['seconds_since_last_flush'] is not None:
+        add_metric('seconds_since_last_flush', 'gauge', 'Seconds since the last flush.',
+                   [('', (), snapshot['seconds_since_last_flush'])])
+    return '\n'.join(lines) + '\n'
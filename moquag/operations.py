@@ -0,0 +1,155 @@
+from pymongo.common import (validate_is_document_type, validate_is_mapping,
+                            validate_ok_for_replace, validate_ok_for_update)
+from pymongo.operations import (InsertOne, UpdateOne, UpdateMany, ReplaceOne,
+                                DeleteOne, DeleteMany)
+from bson import BSON
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+REQUEST_CLASSES = {
+    'insert': InsertOne,
+    'update_one': UpdateOne,
+    'update': UpdateMany,
+    'replace_one': ReplaceOne,
+    'remove_one': DeleteOne,
+    'remove': DeleteMany
+}
+
+
+def to_request(op, selector, document=None, upsert=False):
+    """returns :mod:`pymongo.operations` request for an operation recorded
+    by :class:`BulkWriteOperation`, for ``'insert'`` `selector` is the
+    document to insert
+    """
+    request_class = REQUEST_CLASSES[op]
+    if document is None:
+        return request_class(selector)
+    return request_class(selector, document, upsert=upsert)
+
+
+def check_operation(op, selector, document=None):
+    """Raise TypeError or ValueError if the request of an operation would
+    be rejected by pymongo, same checks as :mod:`pymongo.operations`, so a
+    malformed operation fails when it is enqueued instead of failing the
+    bulk_write of its whole batch
+    """
+    # dicts skip the slower checks against the abstract mapping types
+    if op == 'insert':
+        if type(selector) is not dict:
+            validate_is_document_type('document', selector)
+        return
+    if type(selector) is not dict:
+        validate_is_mapping('filter', selector)
+    if op in ('update_one', 'update'):
+        validate_ok_for_update(document)
+    elif op == 'replace_one':
+        validate_ok_for_replace(document)
+
+
+def get_remove_selectors(selectors):
+    """returns list of the selectors of a remove_many, TypeError is raised
+    before any is buffered if `selectors` is one selector or holds anything
+    but selectors
+    """
+    if isinstance(selectors, Mapping):
+        raise TypeError('selectors must be an iterable of selectors, '
+                        'delete_many takes a single filter')
+    selectors = list(selectors)
+    for selector in selectors:
+        check_operation('remove', selector)
+    return selectors
+
+
+def get_operation_size(*documents):
+    """returns encoded BSON size in bytes of the documents of an operation,
+    ``None`` documents are skipped
+    """
+    return sum(len(BSON.encode(document)) for document in documents
+               if document is not None)
+
+
+class BulkUpsertOperation(object):
+
+    def __init__(self, selector, add_operation):
+        """Upsert variant of :class:`BulkWriteOperation`, every operation
+        recorded by it has ``upsert=True``.
+        """
+        self.__selector = selector
+        self.__add_operation = add_operation
+
+    def update_one(self, update):
+        """Update one document matching the selector, insert if none matches.
+        :Parameters:
+          - `update` (dict): the update operations to apply
+        """
+        return self.__add_operation('update_one', self.__selector, update, True)
+
+    def update(self, update):
+        """Update all documents matching the selector, insert if none matches.
+        :Parameters:
+          - `update` (dict): the update operations to apply
+        """
+        return self.__add_operation('update', self.__selector, update, True)
+
+    def replace_one(self, replacement):
+        """Replace one document matching the selector, insert if none matches.
+        :Parameters:
+          - `replacement` (dict): the replacement document
+        """
+        return self.__add_operation('replace_one', self.__selector, replacement, True)
+
+
+class BulkWriteOperation(object):
+
+    def __init__(self, selector, add_operation):
+        """Records update and remove operations for a selector, same interface
+        as the BulkWriteOperation returned by BulkOperationBuilder.find.
+        :Parameters:
+          - `selector` (dict): the selection criteria for update
+            and remove operations.
+          - `add_operation`: callable receiving ``(op, selector, document,
+            upsert)`` for every recorded operation, `op` is the name of the
+            method called and `document` is ``None`` for removes. Its return
+            value is returned by the method.
+        """
+        self.__selector = selector
+        self.__add_operation = add_operation
+
+    def update_one(self, update):
+        """Update one document matching the selector.
+        :Parameters:
+          - `update` (dict): the update operations to apply
+        """
+        return self.__add_operation('update_one', self.__selector, update, False)
+
+    def update(self, update):
+        """Update all documents matching the selector.
+        :Parameters:
+          - `update` (dict): the update operations to apply
+        """
+        return self.__add_operation('update', self.__selector, update, False)
+
+    def replace_one(self, replacement):
+        """Replace one document matching the selector.
+        :Parameters:
+          - `replacement` (dict): the replacement document
+        """
+        return self.__add_operation('replace_one', self.__selector, replacement, False)
+
+    def remove_one(self):
+        """Remove a single document matching the selector."""
+        return self.__add_operation('remove_one', self.__selector, None, False)
+
+    def remove(self):
+        """Remove all documents matching the selector."""
+        return self.__add_operation('remove', self.__selector, None, False)
+
+    def upsert(self):
+        """Specify that all chained update operations should be upserts.
+        :Returns:
+          - A :class:`BulkUpsertOperation` instance
+        """
+        return BulkUpsertOperation(self.__selector, self.__add_operation)
@@ -0,0 +1,219 @@
+from bson import BSON
+from bson.son import SON
+from copy import deepcopy
+import threading
+
+
+def get_equality_key(selector):
+    """returns hashable key of `selector` if it only has equality conditions,
+    the same for any order of its fields, else ``None``
+    """
+    items = sorted(selector.items(), key=lambda item: item[0])
+    for field, value in items:
+        if field.startswith('$'):
+            return None
+        if isinstance(value, dict) and any(key.startswith('$') for key in value):
+            return None
+    key = tuple(items)
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return BSON.encode(SON(items))
+
+
+def set_field(document, path, value):
+    """Set dotted `path` of `document` to `value`, returns False if a part
+    of the path is not a subdocument
+    """
+    parts = path.split('.')
+    target = document
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+        if not isinstance(target, dict):
+            return False
+    target[parts[-1]] = deepcopy(value)
+    return True
+
+
+def new_upserted(selector):
+    """returns the document an upsert of `selector` starts from"""
+    document = {}
+    for field, value in selector.items():
+        if not set_field(document, field, value):
+            return None
+    return document
+
+
+def is_mergeable(op, selector, document):
+    """returns True if the effect of an operation on a document can be
+    computed in memory
+    """
+    if op in ('update', 'update_one'):
+        return bool(document) and all(operator == '$set' for operator in document)
+    if op == 'remove_one':
+        return list(selector) == ['_id']
+    return op in ('insert', 'remove', 'replace_one')
+
+
+def is_establishing(op, upsert):
+    """returns True if the document is known after the operation, whether
+    it existed before or not
+    """
+    return op in ('insert', 'remove', 'remove_one') or (op == 'replace_one' and upsert)
+
+
+def apply_operation(document, op, selector, update, upsert):
+    """returns `document` after the mergeable operation, ``None`` if it does
+    not exist, raises ValueError if the result can not be computed
+    """
+    if op == 'insert':
+        return deepcopy(selector)
+    if op in ('remove', 'remove_one'):
+        return None
+    if op == 'replace_one':
+        if document is None and not upsert:
+            return None
+        replaced = new_upserted(selector) if document is None else {}
+        if replaced is None:
+            raise ValueError('selector of upsert can not be applied')
+        if document is not None and '_id' in document:
+            replaced['_id'] = document['_id']
+        replaced.update(deepcopy(update))
+        return replaced
+    if document is None:
+        if not upsert:
+            return None
+        document = new_upserted(selector)
+        if document is None:
+            raise ValueError('selector of upsert can not be applied')
+    for path, value in update['$set'].items():
+        if not set_field(document, path, value):
+            raise ValueError('$set of {} can not be applied'.format(path))
+    return document
+
+
+class PendingWrites(object):
+
+    def __init__(self, overlay, db_name, collection):
+        """Index of the operations buffered by one BulkOperator, keyed by
+        the equality key of their selector, ``_id`` for inserts. Operations
+        with other selectors are only counted in `unkeyed`, operations keyed
+        by other fields than ``_id`` alone in `not_by_id`.
+        """
+        self.overlay = overlay
+        self.db_name = db_name
+        self.collection = collection
+        self.operations = {}
+        self.unkeyed = 0
+        self.not_by_id = 0
+        self.registered = False
+
+    def record(self, op, selector, document=None, upsert=False):
+        """Index an operation buffered by the BulkOperator"""
+        if not self.registered:
+            self.overlay.register(self)
+        if op == 'insert':
+            key = get_equality_key({'_id': selector['_id']})
+        else:
+            key = get_equality_key(selector)
+            if list(selector) != ['_id']:
+                self.not_by_id += 1
+        if key is None:
+            self.unkeyed += 1
+        else:
+            self.operations.setdefault(key, []).append((op, selector, document, upsert))
+
+    def close(self):
+        """Drop all indexed operations once they are executed"""
+        self.overlay.unregister(self)
+        self.operations = {}
+        self.unkeyed = 0
+        self.not_by_id = 0
+
+
+class PendingWriteOverlay(object):
+
+    def __init__(self):
+        """Read-your-writes overlay of the operations buffered by the
+        BulkOperators of an aggregator, until they are executed.
+        Pending writes are matched to a lookup by an identical equality
+        selector, e.g. writes on ``{'_id': x}`` for a lookup of
+        ``{'_id': x}``. Writes on other selectors of the collection might
+        change which document matches, they are only ignored if lookup and
+        writes are all on ``_id`` alone, which is immutable.
+        """
+        self.__collections = {}
+        self.__lock = threading.Lock()
+
+    def open(self, db_name, collection):
+        """returns new :class:`PendingWrites` of a BulkOperator"""
+        return PendingWrites(self, db_name, collection)
+
+    def register(self, pending):
+        with self.__lock:
+            key = (pending.db_name, pending.collection)
+            self.__collections.setdefault(key, []).append(pending)
+            pending.registered = True
+
+    def unregister(self, pending):
+        with self.__lock:
+            key = (pending.db_name, pending.collection)
+            indexes = self.__collections.get(key, [])
+            if pending in indexes:
+                indexes.remove(pending)
+            if not indexes:
+                self.__collections.pop(key, None)
+            pending.registered = False
+
+    def get_operations(self, db_name, collection, selector):
+        """returns list of pending operations on `selector` oldest first,
+        ``None`` if pending writes of the collection might change the
+        result without being matched to the selector
+        """
+        with self.__lock:
+            indexes = list(self.__collections.get((db_name, collection), []))
+        if not indexes:
+            return []
+        key = get_equality_key(selector)
+        if key is None or any(pending.unkeyed for pending in indexes):
+            return None
+        if list(selector) == ['_id']:
+            if any(pending.not_by_id for pending in indexes):
+                return None
+        elif any(other != key for pending in indexes for other in pending.operations):
+            # e.g. inserts, or updates of the looked up fields
+            return None
+        operations = []
+        for pending in indexes:
+            operations.extend(pending.operations.get(key, ()))
+        return operations
+
+    def find_one(self, db_name, collection, selector, read, flush):
+        """returns the document matching `selector` with its pending writes
+        applied.
+        :Parameters:
+          - `read`: callable returning the document stored on the server.
+          - `flush`: callable executing the pending writes, called before
+            `read` when they can not be merged.
+        """
+        operations = self.get_operations(db_name, collection, selector)
+        if operations is None or not all(is_mergeable(*operation[:3])
+                                         for operation in operations):
+            flush()
+            return read()
+        start = 0
+        for index, (op, _, _, upsert) in enumerate(operations):
+            if is_establishing(op, upsert):
+                start = index + 1
+        try:
+            if start:
+                document = apply_operation(None, *operations[start - 1])
+            else:
+                document = read()
+            for operation in operations[start:]:
+                document = apply_operation(document, *operation)
+        except ValueError:
+            flush()
+            return read()
+        return document
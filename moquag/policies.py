@@ -0,0 +1,98 @@
+from fnmatch import fnmatchcase
+from itertools import count
+import threading
+
+POLICY_OPTIONS = ('ordered', 'write_concern', 'max_ops_limit', 'interval',
+                  'bypass_document_validation', 'sort_key', 'dedupe_key')
+
+
+class WritePolicy(object):
+
+    def __init__(self, ordered=None, write_concern=None, max_ops_limit=None,
+                 interval=None, bypass_document_validation=None, sort_key=None,
+                 dedupe_key=None):
+        """Write options of the collections matching a pattern of a
+        WritePolicyRegistry, options left ``None`` are inherited from less
+        specific policies and the aggregator.
+        :Parameters:
+          - `ordered` (optional): execute bulks of the collection ordered.
+          - `write_concern` (optional): dict of write concern options, e.g.
+            ``{'w': 'majority'}``.
+          - `max_ops_limit` (optional): operations buffered before a flush.
+          - `interval` (optional): max seconds operations are buffered,
+            the collection is flushed once it passes even without more
+            writes to it.
+          - `bypass_document_validation` (optional): opt-out of document
+            validation.
+          - `sort_key` (optional): field unordered bulks of the collection
+            are sorted by before they are sent.
+          - `dedupe_key` (optional): field of inserted documents duplicate
+            inserts are dropped by.
+        """
+        self.ordered = ordered
+        self.write_concern = write_concern
+        self.max_ops_limit = max_ops_limit
+        self.interval = interval
+        self.bypass_document_validation = bypass_document_validation
+        self.sort_key = sort_key
+        self.dedupe_key = dedupe_key
+
+    def get_options(self):
+        """returns dict of the options set by this policy"""
+        return dict((option, getattr(self, option)) for option in POLICY_OPTIONS
+                    if getattr(self, option) is not None)
+
+
+class WritePolicyRegistry(object):
+
+    def __init__(self, policies=None):
+        """Write policies keyed by ``'db'`` or ``'db.collection'`` patterns,
+        with :mod:`fnmatch` wildcards, e.g. ``'analytics'``, ``'billing.*'``
+        or ``'*.audit_*'``. All matching policies apply, collection patterns
+        over database patterns, exact patterns over wildcard ones and later
+        registrations over earlier ones.
+        :Parameters:
+          - `policies` (optional): dict of pattern to :class:`WritePolicy` or
+            dict of its options.
+        """
+        self.__policies = []
+        self.__cache = {}
+        self.__order = count()
+        self.__lock = threading.Lock()
+        for pattern, policy in (policies or {}).items():
+            self.register(pattern, policy)
+
+    def register(self, pattern, policy=None, **options):
+        """Add a policy for `pattern`, given as a :class:`WritePolicy`, a dict
+        of options or keyword options
+        """
+        if policy is None:
+            policy = WritePolicy(**options)
+        elif isinstance(policy, dict):
+            policy = WritePolicy(**policy)
+        db_pattern, _, collection_pattern = pattern.partition('.')
+        rank = (bool(collection_pattern),
+                not any(char in pattern for char in '*?['),
+                next(self.__order))
+        with self.__lock:
+            self.__policies.append((rank, db_pattern, collection_pattern or None, policy))
+            self.__policies.sort(key=lambda entry: entry[0])
+            self.__cache = {}
+
+    def resolve(self, db_name, collection):
+        """returns dict of options of all policies matching db_name.collection"""
+        key = (db_name, collection)
+        options = self.__cache.get(key)
+        if options is not None:
+            return options
+        options = {}
+        with self.__lock:
+            for _, db_pattern, collection_pattern, policy in self.__policies:
+                if not fnmatchcase(db_name, db_pattern):
+                    continue
+                if collection_pattern is not None and \
+                        not fnmatchcase(collection, collection_pattern):
+                    continue
+                options.update(policy.get_options())
+            self.__cache[key] = options
+        return options
@@ -0,0 +1,172 @@
+from pymongo.errors import BulkWriteError, ConnectionFailure
+from time import time
+import threading
+import random
+
+# network, not primary, shutdown and write concern timeout errors
+TRANSIENT_ERROR_CODES = frozenset([
+    6,      # HostUnreachable
+    7,      # HostNotFound
+    64,     # WriteConcernFailed
+    89,     # NetworkTimeout
+    91,     # ShutdownInProgress
+    189,    # PrimarySteppedDown
+    262,    # ExceededTimeLimit
+    9001,   # SocketException
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+    13436,  # NotPrimaryOrSecondary
+])
+
+RESULT_COUNT_KEYS = ('nInserted', 'nUpserted', 'nMatched', 'nModified', 'nRemoved')
+
+
+def get_retry_errors(write_errors, count, ordered, is_transient):
+    """returns dict of position to error of the operations of a batch of
+    `count` operations to send again, the ones whose writeError passes
+    `is_transient` and, for an ordered batch, the ones after its first
+    failed one which were never executed
+    """
+    retry_errors = dict((error['index'], error) for error in write_errors
+                        if is_transient(error))
+    if ordered and write_errors:
+        failed = set(error['index'] for error in write_errors)
+        for position in range(min(failed) + 1, count):
+            if position not in failed:
+                retry_errors[position] = {'index': position,
+                                          'errmsg': 'not executed, ordered bulk aborted'}
+    return retry_errors
+
+
+class RetryPolicy(object):
+
+    def __init__(self, max_retries=None, backoff=0.1, max_backoff=5.0,
+                 dead_letter=None, transient_error_codes=TRANSIENT_ERROR_CODES,
+                 retry_window=30.0):
+        """Retry handling for BulkOperator. Write errors are classified as
+        transient or permanent by their code, only the failed operations are
+        buffered again, to be sent by a later flush once an exponential
+        backoff with full jitter passed, until `retry_window` seconds after
+        their first send, long enough for a replica set to elect a new
+        primary. Nothing sleeps in the flushing thread. Permanent failures,
+        and transient ones left after `max_retries` or `retry_window`, are
+        passed to `dead_letter`, without one the flush raises BulkWriteError
+        listing them. For ordered bulks the operations after the failed one
+        were never executed, they are buffered again too.
+        :Parameters:
+          - `max_retries` (optional): max number of resends of an operation.
+            Default is ``None`` which bounds retries by `retry_window` only.
+          - `backoff` (optional): seconds of the first backoff, doubled on
+            every retry. Default is ``0.1``.
+          - `max_backoff` (optional): max seconds of a backoff. Default is
+            ``5.0``.
+          - `dead_letter` (optional): callable receiving ``(collection,
+            operation, error)`` for every operation given up on, `operation`
+            is an ``(op, selector, document, upsert)`` tuple. Default is
+            ``None``.
+          - `transient_error_codes` (optional): codes of retried errors.
+          - `retry_window` (optional): seconds after the first send transient
+            failures are retried for, ``None`` retries until `max_retries`.
+            Default is ``30.0``, the server selection timeout of pymongo.
+        """
+        if max_retries is None and retry_window is None:
+            raise ValueError('max_retries or retry_window is required')
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dead_letter = dead_letter
+        self.transient_error_codes = transient_error_codes
+        self.retry_window = retry_window
+
+    def is_transient(self, error):
+        """returns True if a writeError should be retried"""
+        return error.get('code') in self.transient_error_codes
+
+    def get_delay(self, attempt):
+        """returns seconds to wait before retry number `attempt` (from 0)"""
+        # the exponent is capped, a long window must not overflow the float
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** min(attempt, 32)))
+
+    def __give_up(self, backend, operation, error, result):
+        result['writeErrors'].append(error)
+        if self.dead_letter is not None:
+            result['nDeadLettered'] += 1
+            self.dead_letter(backend.collection, operation, error)
+
+    def __is_exhausted(self, attempt, deadline):
+        if self.max_retries is not None and attempt >= self.max_retries:
+            return True
+        return deadline is not None and time() >= deadline
+
+    def send(self, backend, operations, write_concern=None, states=None):
+        """Send `operations` once through `backend`, returns ``(result,
+        retries)``. `result` is a bulk api result listing in writeErrors the
+        operations given up on, `retries` lists ``(position, state)`` of the
+        operations to send again, where `state` is ``(attempt, deadline,
+        not_before)``: the number of the next retry, the end of the retry
+        window and the time the retry is due. `states` holds the state of
+        every operation which is already a retry, ``None`` for the others.
+        """
+        result = dict((key, 0) for key in RESULT_COUNT_KEYS)
+        result.update({'upserted': [], 'writeErrors': [], 'writeConcernErrors': [],
+                       'nRetried': 0, 'nDeadLettered': 0})
+        started = time()
+        retry_errors = {}
+        try:
+            ret = backend.send(operations, write_concern)
+        except BulkWriteError as bwe:
+            ret = bwe.details
+        except ConnectionFailure as exc:
+            # unknown which operations were applied, all are sent again
+            ret = {}
+            retry_errors = dict((position, {'index': position, 'errmsg': str(exc)})
+                                for position in range(len(operations)))
+        for key in RESULT_COUNT_KEYS:
+            result[key] += ret.get(key, 0)
+        result['upserted'].extend(ret.get('upserted', []))
+        result['writeConcernErrors'].extend(ret.get('writeConcernErrors', []))
+        write_errors = ret.get('writeErrors', [])
+        retry_errors.update(get_retry_errors(write_errors, len(operations),
+                                             backend.ordered, self.is_transient))
+        for error in write_errors:
+            if error['index'] not in retry_errors:
+                self.__give_up(backend, operations[error['index']], error, result)
+        retries = []
+        for position in sorted(retry_errors):
+            state = states[position] if states is not None else None
+            if state is None:
+                attempt, deadline = 0, None
+                if self.retry_window is not None:
+                    deadline = started + self.retry_window
+            else:
+                attempt, deadline = state[0], state[1]
+            if self.__is_exhausted(attempt, deadline):
+                self.__give_up(backend, operations[position], retry_errors[position], result)
+                continue
+            not_before = time() + self.get_delay(attempt)
+            if deadline is not None:
+                not_before = min(not_before, deadline)
+            retries.append((position, (attempt + 1, deadline, not_before)))
+        result['nRetried'] = len(retries)
+        return result, retries
+
+
+class SpoolDeadLetter(object):
+
+    def __init__(self, spool):
+        """Dead letter callable for RetryPolicy, operations given up on are
+        written to `spool`, one segment per collection. The spool directory
+        can later be replayed by an aggregator created with it as spool_dir.
+        """
+        self.spool = spool
+        self.__segments = {}
+        self.__lock = threading.Lock()
+
+    def __call__(self, collection, operation, error):
+        key = (collection.database.name, collection.name)
+        with self.__lock:
+            if key not in self.__segments:
+                self.__segments[key] = self.spool.open_segment(*key)
+            self.__segments[key].append(*operation)
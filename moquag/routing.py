@@ -0,0 +1,76 @@
+from fnmatch import fnmatchcase
+from pymongo import MongoClient
+import threading
+
+DEFAULT_CLUSTER = 'default'
+
+
+class ClusterRouter(object):
+
+    def __init__(self, mongodb_settings, clusters=None, routes=None):
+        """Routes databases to MongoDB clusters, one lazily connected
+        MongoClient, with its own connection pool, per cluster.
+        :Parameters:
+          - `mongodb_settings`: MongoClient settings of the ``'default'``
+            cluster, used by databases matching no route.
+          - `clusters` (optional): dict of cluster name to MongoClient
+            settings, ``'default'`` is reserved.
+          - `routes` (optional): dict of database name pattern, with
+            :mod:`fnmatch` wildcards, to cluster name, e.g.
+            ``{'tenant_eu_*': 'eu', 'billing': 'eu'}``. Exact patterns take
+            precedence over wildcard ones, then earlier routes.
+        """
+        if clusters and DEFAULT_CLUSTER in clusters:
+            raise ValueError('cluster {} is reserved for mongodb_settings'.format(DEFAULT_CLUSTER))
+        self.clusters = dict(clusters or {})
+        self.clusters[DEFAULT_CLUSTER] = mongodb_settings
+        self.__routes = []
+        self.__cache = {}
+        self.__clients = {}
+        self.__lock = threading.Lock()
+        for pattern, cluster in (routes or {}).items():
+            self.add_route(pattern, cluster)
+
+    def add_route(self, pattern, cluster):
+        """Route the databases matching `pattern` to `cluster`"""
+        if cluster not in self.clusters:
+            raise ValueError('unknown cluster {}'.format(cluster))
+        rank = (any(char in pattern for char in '*?['), len(self.__routes))
+        with self.__lock:
+            self.__routes.append((rank, pattern, cluster))
+            self.__routes.sort(key=lambda route: route[0])
+            self.__cache = {}
+
+    def get_cluster(self, db_name):
+        """returns name of the cluster of `db_name`"""
+        cluster = self.__cache.get(db_name)
+        if cluster is None:
+            cluster = DEFAULT_CLUSTER
+            for _, pattern, route_cluster in self.__routes:
+                if fnmatchcase(db_name, pattern):
+                    cluster = route_cluster
+                    break
+            self.__cache[db_name] = cluster
+        return cluster
+
+    def get_client(self, cluster=DEFAULT_CLUSTER):
+        """returns the MongoClient of `cluster`, created on first use"""
+        client = self.__clients.get(cluster)
+        if client is None:
+            with self.__lock:
+                client = self.__clients.get(cluster)
+                if client is None:
+                    settings = dict(self.clusters[cluster], connect=False)
+                    client = self.__clients[cluster] = MongoClient(**settings)
+        return client
+
+    def get_database_client(self, db_name):
+        """returns the MongoClient of the cluster of `db_name`"""
+        return self.get_client(self.get_cluster(db_name))
+
+    def close(self):
+        """Close the clients of all clusters"""
+        with self.__lock:
+            clients, self.__clients = self.__clients, {}
+        for client in clients.values():
+            client.close()
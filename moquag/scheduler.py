@@ -0,0 +1,181 @@
+from collections import deque
+from time import time
+import threading
+import traceback
+import weakref
+import sys
+
+
+class FlushScheduler(threading.Thread):
+
+    def __init__(self, aggregator, interval, lane=None):
+        """Initialize a new FlushScheduler, a daemon thread which flushes a
+        MongoQueryAggregator in background. Collections with an interval of
+        their own are flushed once it passes, without waiting for a write.
+        :Parameters:
+          - `aggregator`: A :class:`MongoQueryAggregator` instance, held by
+            weak reference so that the aggregator can still be collected.
+          - `interval`: A :Integer:`seconds` after which all buffered
+            operations are flushed.
+          - `lane` (optional): A :class:`PriorityLane`, if given only the
+            operations of the lane are flushed. Default is ``None``.
+        """
+        name = 'moquag-flush-scheduler'
+        if lane is not None:
+            name = '{}-{}'.format(name, lane.name)
+        super(FlushScheduler, self).__init__(name=name)
+        self.daemon = True
+        self.__aggregator = weakref.ref(aggregator)
+        self.__interval = interval
+        self.__lane = lane
+        self.__pending = deque()
+        self.__wakeup = threading.Event()
+        self.__stopped = threading.Event()
+        self.__flush_requested = False
+
+    def submit(self, bulk, collection, bulk_operator):
+        """Hand over a BulkOperator which crossed max_ops_limit, it will be
+        executed by the scheduler thread instead of the producer.
+        """
+        self.__pending.append((bulk, collection, bulk_operator))
+        self.__wakeup.set()
+
+    def request_flush(self):
+        """Ask the scheduler thread to flush the aggregator now"""
+        self.__flush_requested = True
+        self.__wakeup.set()
+
+    def reschedule(self):
+        """Wake the scheduler thread to wait for a collection deadline set
+        after it went to sleep
+        """
+        self.__wakeup.set()
+
+    def get_pending_count(self):
+        """returns count of BulkOperators waiting to be executed"""
+        return len(self.__pending)
+
+    def __drain(self):
+        while self.__pending:
+            bulk, collection, bulk_operator = self.__pending.popleft()
+            try:
+                bulk.execute_bulk_operator(collection, bulk_operator)
+            except Exception:
+                self.__log_error('For DB [ {} ] collection [ {} ]'.format(
+                    bulk.db_name, collection))
+
+    def __log_error(self, context):
+        traceback_log = traceback.format_exc()
+        sys.stderr.write('{}\n\tError:\n {}'.format(context, traceback_log))
+
+    def __get_last_execution_time(self, aggregator):
+        if self.__lane is None:
+            return aggregator.last_execution_time
+        return self.__lane.last_execution_time
+
+    def __get_next_deadline(self, aggregator):
+        # the interval of the lane or the earliest deadline of its collections
+        deadline = self.__get_last_execution_time(aggregator) + self.__interval
+        collection_deadline = aggregator.get_next_deadline(self.__get_lane_name())
+        if collection_deadline is not None:
+            deadline = min(deadline, collection_deadline)
+        return deadline
+
+    def __get_lane_name(self):
+        return None if self.__lane is None else self.__lane.name
+
+    def __execute(self, aggregator):
+        if self.__lane is None:
+            aggregator.execute()
+        else:
+            aggregator.execute_lane(self.__lane.name)
+
+    def __flush(self, aggregator):
+        try:
+            self.__execute(aggregator)
+        except Exception:
+            self.__log_error('FlushScheduler')
+
+    def __flush_due(self, aggregator):
+        try:
+            aggregator.flush_due(self.__get_lane_name())
+        except Exception:
+            self.__log_error('FlushScheduler')
+        # BulkOperators of due collections were submitted by the flush
+        self.__drain()
+
+    def run(self):
+        while not self.__stopped.is_set():
+            aggregator = self.__aggregator()
+            if aggregator is None:
+                return
+            timeout = self.__get_next_deadline(aggregator) - time()
+            del aggregator
+            if timeout > 0:
+                self.__wakeup.wait(timeout)
+            self.__wakeup.clear()
+            self.__drain()
+            aggregator = self.__aggregator()
+            if aggregator is None:
+                return
+            if self.__flush_requested or \
+                    self.__get_last_execution_time(aggregator) + self.__interval <= time():
+                self.__flush_requested = False
+                self.__flush(aggregator)
+            elif self.__get_next_deadline(aggregator) <= time():
+                self.__flush_due(aggregator)
+            del aggregator
+
+    def stop(self, flush=True, timeout=None):
+        """Stop the scheduler thread and wait for it to finish.
+        :Parameters:
+          - `flush` (optional): If ``True`` flush all buffered operations
+            once the thread has stopped.
+          - `timeout` (optional): seconds to wait for the thread to join.
+        """
+        self.__stopped.set()
+        self.__wakeup.set()
+        if self is not threading.current_thread():
+            self.join(timeout)
+        self.__drain()
+        aggregator = self.__aggregator()
+        if flush and aggregator is not None:
+            self.__execute(aggregator)
+
+
+class PeriodicCaller(threading.Thread):
+
+    def __init__(self, target, method, interval, name):
+        """Daemon thread calling a method of `target` every `interval`
+        seconds until stopped or until `target` is collected.
+        :Parameters:
+          - `target`: The object to call, held by weak reference so that it
+            can still be collected.
+          - `method`: A :String:`name` of the method of `target` to call.
+          - `interval`: A :Float:`seconds` between two calls.
+          - `name`: A :String:`name` of the thread.
+        """
+        super(PeriodicCaller, self).__init__(name=name)
+        self.daemon = True
+        self.__target = weakref.ref(target)
+        self.__method = method
+        self.__interval = interval
+        self.__stopped = threading.Event()
+
+    def run(self):
+        while not self.__stopped.wait(self.__interval):
+            target = self.__target()
+            if target is None:
+                return
+            try:
+                getattr(target, self.__method)()
+            except Exception:
+                traceback_log = traceback.format_exc()
+                sys.stderr.write('{}\n\tError:\n {}'.format(self.name, traceback_log))
+            del target
+
+    def stop(self):
+        """Stop the thread and wait for it to finish"""
+        self.__stopped.set()
+        if self is not threading.current_thread():
+            self.join()
@@ -0,0 +1,177 @@
+from bson import BSON, decode_file_iter
+from bson.errors import InvalidBSON
+from itertools import count
+from time import time
+from .scheduler import PeriodicCaller
+import threading
+import weakref
+import os
+
+try:
+    # skips the BSON instance of BSON.encode, pymongo >= 3.9
+    from bson import encode as encode_bson
+except ImportError:
+    encode_bson = BSON.encode
+
+SEGMENT_SUFFIX = '.spool'
+
+
+def encode_record(op, selector, document=None, upsert=False):
+    """returns the BSON record of an operation"""
+    record = {'op': op, 's': selector, 'u': upsert}
+    if document is not None:
+        record['d'] = document
+    return encode_bson(record)
+
+
+class SpoolSegment(object):
+
+    def __init__(self, path, db_name, collection, fsync_interval):
+        """Append-only file holding the operations of one BulkOperator, the
+        first record names the db and collection, every following record is
+        one operation. Records are BSON documents written to a buffered file
+        which is flushed and fsynced by the group commit every
+        `fsync_interval` seconds, by append or by the sync thread of the
+        :class:`Spool` once appends stop. Without `fsync_interval` every
+        record is written unbuffered so it survives a crash of the process.
+        """
+        self.path = path
+        self.db_name = db_name
+        self.collection = collection
+        self.__fsync_interval = fsync_interval
+        self.__file = open(path, 'ab', 0 if fsync_interval is None else -1)
+        self.__last_sync = time()
+        self.__dirty = False
+        # sync of the spool thread must not race close and remove
+        self.__lock = threading.Lock()
+        self.__file.write(BSON.encode({'db': db_name, 'coll': collection}))
+
+    def append(self, op, selector, document=None, upsert=False):
+        """Record an operation, for inserts `selector` is the document"""
+        self.__file.write(encode_record(op, selector, document, upsert))
+        self.__dirty = True
+        if self.__fsync_interval is not None and \
+                self.__last_sync + self.__fsync_interval <= time():
+            self.sync()
+
+    def sync(self):
+        """Write and fsync all records appended so far"""
+        with self.__lock:
+            self.__sync()
+
+    def __sync(self):
+        if self.__dirty and not self.__file.closed:
+            # cleared first, an append racing the fsync marks it again
+            self.__dirty = False
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+        self.__last_sync = time()
+
+    def close(self):
+        """Close the segment keeping its records on disk"""
+        with self.__lock:
+            if not self.__file.closed:
+                self.__sync()
+                self.__file.close()
+
+    def rewrite(self, operations):
+        """Close the segment and replace its records with `operations`,
+        ``(op, selector, document, upsert)`` tuples, e.g. the operations of
+        a partially failed batch which are still to be replayed
+        """
+        path = self.path + '.tmp'
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.close()
+            with open(path, 'wb') as segment_file:
+                segment_file.write(BSON.encode({'db': self.db_name, 'coll': self.collection}))
+                for operation in operations:
+                    segment_file.write(encode_record(*operation))
+                segment_file.flush()
+                os.fsync(segment_file.fileno())
+            # the old records are kept until the new ones are on disk
+            os.rename(path, self.path)
+
+    def remove(self):
+        """Close and delete the segment, its operations were executed"""
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Spool(object):
+
+    def __init__(self, directory, fsync_interval=1.0):
+        """Durable spool of buffered operations, one SpoolSegment file per
+        BulkOperator inside `directory`.
+        :Parameters:
+          - `directory`: path of the spool directory, created if missing.
+            It must not be shared by two aggregators.
+          - `fsync_interval` (optional): seconds between group committed
+            writes and fsyncs of the buffered records, ``0`` writes and
+            fsyncs every operation and ``None`` writes every operation
+            unbuffered and leaves flushing to disk to the OS. Records of a
+            burst are synced within the interval by a daemon thread, started
+            with the first segment. Default is ``1.0``.
+        """
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.__sequence = count()
+        self.__lock = threading.Lock()
+        self.__segments = weakref.WeakSet()
+        self.__syncer = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open_segment(self, db_name, collection):
+        """returns a new SpoolSegment for operations of db_name.collection"""
+        with self.__lock:
+            name = '{:016x}-{:08x}{}'.format(int(time() * 1e6), next(self.__sequence),
+                                             SEGMENT_SUFFIX)
+            segment = SpoolSegment(os.path.join(self.directory, name), db_name,
+                                   collection, self.fsync_interval)
+            self.__segments.add(segment)
+            if self.__syncer is None and self.fsync_interval:
+                self.__syncer = PeriodicCaller(self, 'sync', self.fsync_interval,
+                                              'moquag-spool-syncer')
+                self.__syncer.start()
+        return segment
+
+    def sync(self):
+        """fsync every open segment"""
+        with self.__lock:
+            segments = list(self.__segments)
+        for segment in segments:
+            segment.sync()
+
+    def close(self):
+        """Stop the sync thread and fsync every open segment"""
+        with self.__lock:
+            syncer, self.__syncer = self.__syncer, None
+        if syncer is not None:
+            syncer.stop()
+        self.sync()
+
+    def get_segment_paths(self):
+        """returns paths of all segments on disk, oldest first"""
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def read_segment(self, path):
+        """returns (db_name, collection, records) of a segment, a record cut
+        by a crash at the end of the file is ignored
+        """
+        records = []
+        with open(path, 'rb') as segment_file:
+            try:
+                for record in decode_file_iter(segment_file):
+                    records.append(record)
+            except InvalidBSON:
+                pass
+        if not records:
+            return None, None, []
+        header = records[0]
+        return header['db'], header['coll'], records[1:]
@@ -0,0 +1,118 @@
+from .operations import get_remove_selectors
+
+
+class CollectionWriter(object):
+
+    __slots__ = ('aggregator', 'db_name', 'name', 'check_every',
+                 '__bulk_operator', '__execute_count', '__countdown')
+
+    def __init__(self, aggregator, db_name, name, check_every=100):
+        """Pre-bound handle of a collection returned by
+        MongoQueryAggregator.collection, for tight enqueue loops. Operations
+        go straight to the current BulkOperator, the aggregator path with its
+        interval, backpressure and batch limit checks is only taken every
+        `check_every` operations, when the batch limit is reached or after
+        the BulkOperator was executed.
+        :Parameters:
+          - `aggregator`: the :class:`MongoQueryAggregator`.
+          - `db_name`, `name`: database and collection names.
+          - `check_every` (optional): max operations between two checks.
+            Default is ``100``.
+        """
+        self.aggregator = aggregator
+        self.db_name = db_name
+        self.name = name
+        self.check_every = check_every
+        self.__bulk_operator = None
+        self.__execute_count = 0
+        self.__countdown = 0
+
+    def __get_bulk_operator(self):
+        bulk_operator = self.__bulk_operator
+        if self.__countdown <= 0 or bulk_operator is None or \
+                bulk_operator.execute_count != self.__execute_count:
+            bulk = self.aggregator[self.db_name]
+            bulk_operator = self.__bulk_operator = bulk[self.name]
+            self.__execute_count = bulk_operator.execute_count
+            max_ops_limit = bulk.get_policy(self.name)['max_ops_limit']
+            self.__countdown = max(1, min(self.check_every,
+                                          max_ops_limit - bulk_operator.total_ops))
+        return bulk_operator
+
+    def insert(self, document, future=False, callback=None):
+        """Add an insert of `document`, see BulkOperator.insert"""
+        bulk_operator = self.__get_bulk_operator()
+        self.__countdown -= 1
+        return bulk_operator.insert(document, future, callback)
+
+    def find(self, selector, future=False, callback=None):
+        """returns BulkWriteOperation of `selector`, same as
+        ``aggregator.db.coll.find(selector)``
+        """
+        bulk_operator = self.__get_bulk_operator()
+        self.__countdown -= 1
+        return bulk_operator.find(selector, future, callback)
+
+    def remove(self, selector, future=False, callback=None):
+        """Add a remove of all documents matching `selector`"""
+        bulk_operator = self.__get_bulk_operator()
+        self.__countdown -= 1
+        return bulk_operator.remove(selector, future, callback)
+
+    def remove_one(self, selector, future=False, callback=None):
+        """Add a remove of a single document matching `selector`"""
+        bulk_operator = self.__get_bulk_operator()
+        self.__countdown -= 1
+        return bulk_operator.remove_one(selector, future, callback)
+
+    def write_many(self, operations):
+        """Add ``(op, selector, document, upsert)`` operations, for inserts
+        `selector` is the document, see BulkOperator.add
+        """
+        operations = list(operations)
+        index = 0
+        while index < len(operations):
+            bulk_operator = self.__get_bulk_operator()
+            chunk = operations[index:index + self.__countdown]
+            self.__countdown -= len(chunk)
+            index += len(chunk)
+            add = bulk_operator.add
+            for operation in chunk:
+                add(*operation)
+
+    def insert_many(self, documents):
+        """Add an insert of every document of `documents`"""
+        documents = list(documents)
+        index = 0
+        while index < len(documents):
+            bulk_operator = self.__get_bulk_operator()
+            chunk = documents[index:index + self.__countdown]
+            self.__countdown -= len(chunk)
+            index += len(chunk)
+            insert = bulk_operator.insert
+            for document in chunk:
+                insert(document)
+
+    def update_many(self, updates, upsert=False):
+        """Add an update_one of every ``(selector, update)`` of `updates`,
+        as upserts if `upsert`
+        """
+        self.write_many(('update_one', selector, update, upsert)
+                        for selector, update in updates)
+
+    def delete_many(self, filter, future=False, callback=None):
+        """Add a remove of all documents matching `filter`, same as remove"""
+        return self.remove(filter, future, callback)
+
+    def remove_many(self, selectors):
+        """Add a remove of all documents matching every selector of
+        `selectors`, an iterable of selectors
+        """
+        selectors = get_remove_selectors(selectors)
+        index = 0
+        while index < len(selectors):
+            bulk_operator = self.__get_bulk_operator()
+            chunk = selectors[index:index + self.__countdown]
+            self.__countdown -= len(chunk)
+            index += len(chunk)
+            bulk_operator.remove_many(chunk)
@@ -16,6 +16,7 @@ setup(
     packages=['moquag'],
     install_requires=[
         'pymongo',
+        'futures; python_version < "3"',
     ],
     zip_safe=False
 )
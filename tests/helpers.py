@@ -0,0 +1,40 @@
+import pymongo
+
+from moquag.backends import BulkWriteBackend
+
+
+def count_documents(collection, filter=None):
+    """returns count of documents of `collection` matching `filter`, with
+    count_documents of pymongo >= 3.7 or count of older versions
+    """
+    # attribute lookups on a Collection return sub-collections, so the
+    # version tells which method exists
+    if pymongo.version_tuple >= (3, 7):
+        return collection.count_documents(filter or {})
+    return collection.count(filter)
+
+
+class ResultBackend(BulkWriteBackend):
+    '''backend recording sent operations, its collection is the canned
+    result to return or the exception to raise
+    '''
+
+    def send(self, operations, write_concern=None):
+        self.sent = operations
+        if isinstance(self.collection, Exception):
+            raise self.collection
+        return self.collection
+
+
+class RecordingBackend(BulkWriteBackend):
+    '''backend recording sent operations, raising the exception set on the
+    class once
+    '''
+    error = None
+
+    def send(self, operations, write_concern=None):
+        error, RecordingBackend.error = RecordingBackend.error, None
+        if error is not None:
+            raise error
+        self.sent = operations
+        return {'nInserted': len(operations)}
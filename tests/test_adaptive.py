@@ -0,0 +1,93 @@
+import unittest
+from time import sleep, time
+from unittest import mock
+
+from moquag import MongoQueryAggregator, AdaptiveBatchController
+from benchmarks.fake import FakeMongo
+
+
+class TestAdaptive(unittest.TestCase):
+
+    def test_1(self):
+        '''batch size converges to the target latency within bounds'''
+        controller = AdaptiveBatchController(target_latency=0.1, min_batch_size=10,
+                                             max_batch_size=5000, max_interval=1)
+        self.assertEqual(controller.get_limits('db', 'coll', 1000, 5), (1000, 1))
+        # one flush per second, the clock only moves here so that threads
+        # of other aggregators reading it do not change the rates
+        clock = [0]
+        with mock.patch('moquag.adaptive.time', side_effect=lambda: clock[0]):
+            for _ in range(10):
+                clock[0] += 1
+                batch_size = controller.get_limits('db', 'coll', 1000, 5)[0]
+                # every op takes 1ms, 100 ops fit in the target, 10 are
+                # enqueued per second
+                controller.record_flush('db', 'coll', batch_size * 0.001, 10,
+                                        batch_size, result={})
+            controller.get_limits('db', 'fast', 1000, 5)
+            for _ in range(10):
+                clock[0] += 1
+                controller.record_flush('db', 'fast', 0.001, 1000, 1000, result={})
+        stats = controller.get_stats()[('db', 'coll')]
+        self.assertEqual(stats['batch_size'], 100)
+        self.assertEqual(stats['interval'], 1)
+        self.assertEqual(stats['op_rate'], 10)
+        self.assertEqual(controller.get_stats()[('db', 'fast')]['batch_size'], 5000)
+
+    def test_2(self):
+        '''collections with cheap flushes are flushed on a short interval'''
+        mongo = FakeMongo()
+        controller = AdaptiveBatchController(min_batch_size=1, min_interval=0.01)
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo,
+                                          batch_controller=controller)
+        aggregator.db.coll.insert({'i': 1})
+        aggregator.execute()
+        self.assertLessEqual(controller.get_stats()[('db', 'coll')]['interval'], 0.01)
+        aggregator.db.coll.insert({'i': 2})
+        sleep(0.02)
+        aggregator.db.coll.insert({'i': 3})
+        self.assertEqual(mongo.written_ops, 2)
+        self.assertEqual(aggregator.get_buffered_query_count(),
+                         {('coll', 'db'): {'insert': 1, 'find': 0, 'remove': 0}})
+
+    def test_3(self):
+        '''a collection filling batches faster than it can flush them gets
+        bigger batches than the target latency allows'''
+        controller = AdaptiveBatchController(target_latency=0.1, max_batch_size=100000,
+                                             flush_load=0.1)
+        controller.get_limits('db', 'hot', 1000, 5)
+        # 100 flushes per second of 1000 ops taking 1ms each
+        clock = [0]
+        with mock.patch('moquag.adaptive.time', side_effect=lambda: clock[0]):
+            for _ in range(10):
+                clock[0] += 0.01
+                batch_size = controller.get_limits('db', 'hot', 1000, 5)[0]
+                controller.record_flush('db', 'hot', batch_size * 0.001, 1000,
+                                        batch_size, result={})
+        stats = controller.get_stats()[('db', 'hot')]
+        self.assertAlmostEqual(stats['op_rate'], 100000)
+        self.assertGreater(stats['batch_size'], 100)
+
+    def test_4(self):
+        '''a cold collection is flushed by its tuned interval without more
+        writes to it, by the scheduler or by writes to other collections'''
+        for background_flush in (True, False):
+            mongo = FakeMongo()
+            controller = AdaptiveBatchController(min_batch_size=1, min_interval=0.02)
+            aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo,
+                                              batch_controller=controller,
+                                              background_flush=background_flush)
+            aggregator.db.cold.insert({'i': 1})
+            aggregator.execute()
+            aggregator.db.cold.insert({'i': 2})
+            deadline = time() + 1
+            while mongo.written_ops < 2 and time() < deadline:
+                sleep(0.005)
+                if not background_flush:
+                    aggregator.db.other.insert({'i': 0})
+            self.assertEqual(mongo.written_ops, 2)
+            aggregator.stop_scheduler()
+
+
+if __name__ == '__main__':
+    unittest.main()
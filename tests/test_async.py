@@ -0,0 +1,84 @@
+import unittest
+import asyncio
+from collections import Counter
+from pymongo.operations import InsertOne
+from moquag.aio import AsyncMongoQueryAggregator
+
+
+class FakeBulkWriteResult(object):
+
+    def __init__(self, bulk_api_result):
+        self.bulk_api_result = bulk_api_result
+
+
+class FakeAsyncCollection(object):
+    '''in-process collection having a coroutine bulk_write'''
+
+    def __init__(self):
+        self.batches = []
+
+    async def bulk_write(self, requests, ordered=True, bypass_document_validation=False):
+        self.batches.append(list(requests))
+        await asyncio.sleep(0)
+        n_inserted = sum(1 for request in requests if isinstance(request, InsertOne))
+        return FakeBulkWriteResult({
+            'nInserted': n_inserted, 'nUpserted': 0, 'nMatched': len(requests) - n_inserted,
+            'nModified': len(requests) - n_inserted, 'nRemoved': 0, 'upserted': [],
+            'writeErrors': [], 'writeConcernErrors': []
+        })
+
+
+class FakeAsyncClient(object):
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, db_name):
+        client = self
+
+        class FakeDatabase(object):
+            def __getitem__(self, collection):
+                return client.collections.setdefault((db_name, collection), FakeAsyncCollection())
+        return FakeDatabase()
+
+
+class TestAsync(unittest.IsolatedAsyncioTestCase):
+
+    async def test_1(self):
+        '''insert and upsert are buffered until execute is awaited'''
+        client = FakeAsyncClient()
+        mongo_agg = AsyncMongoQueryAggregator({}, 10, 10, client=client)
+        mongo_agg.testdb1.profiles.insert({'id': 1})
+        mongo_agg.testdb1.profiles.find({'id': 2}).upsert().update({'$set': {'name': 'new2'}})
+        self.assertEqual(mongo_agg.get_buffered_query_count(),
+                         {('profiles', 'testdb1'): {'insert': 1, 'find': 1}})
+        self.assertEqual(client.collections[('testdb1', 'profiles')].batches, [])
+        await mongo_agg.execute()
+        self.assertEqual(len(client.collections[('testdb1', 'profiles')].batches), 1)
+        self.assertEqual(mongo_agg.get_results(),
+                         {('testdb1', 'profiles'): Counter({'nInserted': 1, 'nMatched': 1, 'nModified': 1})})
+
+    async def test_2(self):
+        '''crossing max_ops_limit flushes in a task, periodic task flushes the rest'''
+        client = FakeAsyncClient()
+        async with AsyncMongoQueryAggregator({}, 0.05, 5, client=client) as mongo_agg:
+            for i in range(6):
+                mongo_agg.testdb1.profiles.insert({'id': i})
+            await asyncio.sleep(0)
+            batches = client.collections[('testdb1', 'profiles')].batches
+            self.assertEqual([len(batch) for batch in batches], [5])
+            await asyncio.sleep(0.1)
+            self.assertEqual([len(batch) for batch in batches], [5, 1])
+        self.assertEqual(mongo_agg.get_results(),
+                         {('testdb1', 'profiles'): Counter({'nInserted': 6})})
+
+    async def test_3(self):
+        '''collections without buffered operations are flushed without results'''
+        client = FakeAsyncClient()
+        mongo_agg = AsyncMongoQueryAggregator({}, 10, 10, client=client)
+        self.assertEqual(await mongo_agg.testdb1.profiles.execute(), Counter())
+        mongo_agg.testdb1.events.insert({'id': 1})
+        await mongo_agg.execute()
+        self.assertEqual(mongo_agg.get_results(),
+                         {('testdb1', 'events'): Counter({'nInserted': 1})})
+        self.assertEqual(client.collections[('testdb1', 'profiles')].batches, [])
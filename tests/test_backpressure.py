@@ -0,0 +1,87 @@
+import unittest
+import threading
+import gc
+from unittest import mock
+
+from pymongo.errors import AutoReconnect
+from moquag import MongoQueryAggregator
+from moquag.main import BulkOperator
+from moquag.backends import BulkWriteBackend, EncodedBulkWriteBackend
+from moquag.backpressure import BufferLimiter, BufferFullError
+
+
+class FlakyBackend(BulkWriteBackend):
+    '''backend failing sends of the collection named down'''
+
+    def send(self, operations, write_concern=None):
+        if self.collection.name == 'down':
+            raise AutoReconnect('down')
+        return {'nInserted': len(operations)}
+
+
+class TestBackpressure(unittest.TestCase):
+
+    def test_1(self):
+        '''BufferLimiter reports full on max_ops and max_bytes'''
+        limiter = BufferLimiter(max_ops=2, max_bytes=100)
+        limiter.acquire(1, 10)
+        self.assertFalse(limiter.is_full())
+        limiter.acquire(1, 10)
+        self.assertTrue(limiter.is_full())
+        limiter.release(2, 20)
+        limiter.acquire(1, 100)
+        self.assertTrue(limiter.is_full())
+        limiter.release(1, 100)
+        self.assertEqual(limiter.get_stats(), {'buffered_ops': 0, 'buffered_bytes': 0})
+        self.assertRaises(ValueError, BufferLimiter, 1, None, 'spill')
+
+    def test_2(self):
+        '''block policy waits for a release and times out with BufferFullError'''
+        limiter = BufferLimiter(max_ops=1, policy='block', block_timeout=0.05)
+        limiter.acquire(1, 0)
+        self.assertRaises(BufferFullError, limiter.wait)
+        threading.Timer(0.01, limiter.release, (1, 0)).start()
+        limiter.block_timeout = 5
+        limiter.wait()
+        stats = limiter.get_stats()
+        self.assertEqual(stats['blocked'], 2)
+        self.assertEqual(stats['block_timeouts'], 1)
+        self.assertEqual(stats['buffered_ops'], 0)
+
+    def test_3(self):
+        '''a failing collection neither skips the others nor keeps its admissions'''
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=FlakyBackend,
+                                          max_buffered_ops=10, thread_safe=True)
+        for collection in ('a', 'down', 'b'):
+            aggregator.db[collection].insert({'i': 1})
+        self.assertRaises(AutoReconnect, aggregator.db.execute)
+        self.assertEqual(aggregator.get_results(), {('db', 'a'): {'nInserted': 1},
+                                                    ('db', 'b'): {'nInserted': 1}})
+        self.assertEqual(aggregator.get_backpressure_stats()['buffered_ops'], 0)
+
+    def test_4(self):
+        '''drop_oldest pops the oldest operations of both backends'''
+        for backend in (BulkWriteBackend, EncodedBulkWriteBackend):
+            limiter = BufferLimiter(max_ops=3, policy='drop_oldest')
+            bulk_operator = BulkOperator(None, backend=backend, limiter=limiter)
+            futures = [bulk_operator.insert({'i': i}, future=True) for i in range(10)]
+            self.assertTrue(all(isinstance(future.exception(0), BufferFullError)
+                                for future in futures[:7]))
+            self.assertFalse(any(future.done() for future in futures[7:]))
+            operations = bulk_operator.backend.detach()
+            self.assertEqual([dict(operation[1])['i'] for operation in operations], [7, 8, 9])
+
+    def test_5(self):
+        '''an aggregator rejecting its arguments is collected without errors'''
+        # errors raised by __del__ go to the unraisable hook
+        with mock.patch('sys.unraisablehook') as hook:
+            with self.assertRaises(ValueError):
+                MongoQueryAggregator({}, 1, 10, max_buffered_ops=10, overflow_policy='unknown')
+            with self.assertRaises(ValueError):
+                MongoQueryAggregator({}, 1, 10, routes={'db': 'unknown'})
+            gc.collect()
+        self.assertFalse(hook.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
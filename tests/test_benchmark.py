@@ -0,0 +1,33 @@
+import unittest
+
+from pymongo.errors import BulkWriteError
+from pymongo.operations import InsertOne
+from benchmarks.fake import FakeMongo
+from benchmarks import bench
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_1(self):
+        '''FakeMongo counts writes and injects write errors'''
+        mongo = FakeMongo(seed=1)
+        collection = mongo['db']['coll']
+        result = collection.bulk_write([InsertOne({'i': i}) for i in range(5)])
+        self.assertEqual(result.inserted_count, 5)
+        mongo.error_rate = 1
+        self.assertRaises(BulkWriteError, collection.bulk_write, [InsertOne({})])
+        self.assertEqual(mongo.bulk_writes, 2)
+
+    def test_2(self):
+        '''benchmark reports scenario metrics and regressions against a baseline'''
+        args = ['operator_insert', 'aggregator_insert', '--ops', '200',
+                '--batch-size', '50', '--memory-ops', '50']
+        self.assertEqual(bench.main(args), 0)
+        results = {'aggregator_insert': {'ops_per_sec': 50.0, 'flush_p99': 0.2}}
+        baseline = {'aggregator_insert': {'ops_per_sec': 100.0, 'flush_p99': 0.1}}
+        regressions = bench.compare(results, baseline, 0.1)
+        self.assertEqual(len(regressions), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+from pymongo import MongoClient
+from moquag import MongoQueryAggregator
+from moquag.main import BulkOperator
+from moquag.coalesce import UpdateCoalescer
+from .helpers import RecordingBackend
+from .settings import MONGO_DB_SETTINGS, logger
+from collections import Counter
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = MongoClient(**MONGO_DB_SETTINGS)
+        self.conn.drop_database('testdb1')
+
+    def test_1(self):
+        '''merging $set, $inc and $addToSet on same selector'''
+        coalescer = UpdateCoalescer()
+        self.assertEqual(coalescer.add('update', {'id': 1}, {'$set': {'a': 1}, '$inc': {'n': 1}}, True),
+                         (False, None))
+        self.assertEqual(coalescer.add('update', {'id': 1}, {'$set': {'a': 2}, '$inc': {'n': 2}}, True),
+                         (True, None))
+        self.assertEqual(coalescer.add('update', {'id': 1}, {'$addToSet': {'tags': 'x'}}, True),
+                         (True, None))
+        self.assertEqual(coalescer.add('update', {'id': 1}, {'$addToSet': {'tags': {'$each': ['x', 'y']}}}, True),
+                         (True, None))
+        self.assertEqual(coalescer.add('update', {'id': 2}, {'$set': {'a': 1}}), (False, None))
+        # same selector without upsert closes the merged update
+        self.assertEqual(coalescer.add('update', {'id': 1}, {'$set': {'a': 3}}), (False, (
+            'update', {'id': 1}, {'$set': {'a': 2}, '$inc': {'n': 3},
+                                  '$addToSet': {'tags': {'$each': ['x', 'y']}}}, True)))
+        # conflicting path closes it too
+        self.assertEqual(coalescer.add('update', {'id': 1}, {'$set': {'a.x': 3}}),
+                         (False, ('update', {'id': 1}, {'$set': {'a': 3}}, False)))
+        self.assertEqual(len(coalescer), 2)
+        self.assertEqual(coalescer.folded_count, 3)
+        self.assertEqual(coalescer.close({'id': 2}), ('update', {'id': 2}, {'$set': {'a': 1}}, False))
+        self.assertListEqual(coalescer.drain(), [('update', {'id': 1}, {'$set': {'a.x': 3}}, False)])
+        self.assertEqual(len(coalescer), 0)
+
+    def test_2(self):
+        '''upserting same document 5 times with coalesce sends a single update'''
+        mongo_agg = MongoQueryAggregator(MONGO_DB_SETTINGS, 1, 50, ordered=False, coalesce=True)
+        for i in range(5):
+            mongo_agg.testdb1.profiles.find({'id': 1}).upsert().update(
+                {'$inc': {'count': 1}, '$set': {'last': i}})
+        mongo_agg.execute()
+        data = list(self.conn['testdb1'].profiles.find({}, {'_id': 0}))
+        self.assertListEqual(data, [{'id': 1, 'count': 5, 'last': 4}])
+        aggregators_expected_results = {
+            ('testdb1', 'profiles'): Counter({'nUpserted': 1, 'nCoalesced': 4})
+        }
+        self.assertEqual(aggregators_expected_results, mongo_agg.get_results())
+
+    def test_3(self):
+        '''updates of a selector keep their order around a conflicting one'''
+        bulk_operator = BulkOperator(None, backend=RecordingBackend, coalesce=True)
+        bulk_operator.find({'id': 1}).upsert().update_one({'$set': {'a': 1}})
+        bulk_operator.find({'id': 1}).upsert().update_one({'$inc': {'a': 1}})
+        bulk_operator.find({'id': 1}).upsert().update_one({'$set': {'a': 5}})
+        bulk_operator.find({'id': 2}).upsert().update_one({'$set': {'a': 1}})
+        bulk_operator.find({'id': 2}).replace_one({'a': 2})
+        bulk_operator.find({'id': 2}).upsert().update_one({'$set': {'b': 1}})
+        bulk_operator.find({'id': 2}).upsert().update_one({'$set': {'c': 1}})
+        self.assertEqual(bulk_operator.execute()['nCoalesced'], 1)
+        self.assertListEqual(bulk_operator.backend.sent, [
+            ('update_one', {'id': 1}, {'$set': {'a': 1}}, True),
+            ('update_one', {'id': 1}, {'$inc': {'a': 1}}, True),
+            ('update_one', {'id': 2}, {'$set': {'a': 1}}, True),
+            ('replace_one', {'id': 2}, {'a': 2}, False),
+            ('update_one', {'id': 1}, {'$set': {'a': 5}}, True),
+            ('update_one', {'id': 2}, {'$set': {'b': 1, 'c': 1}}, True)])
@@ -0,0 +1,38 @@
+import unittest
+
+from moquag import MongoQueryAggregator
+from moquag.counters import CounterStore
+from benchmarks.fake import FakeMongo
+
+
+class TestCounters(unittest.TestCase):
+
+    def test_1(self):
+        '''least recently incremented keys are emitted beyond max_keys'''
+        emitted = []
+        store = CounterStore(lambda *args: emitted.append(args), max_keys=2)
+        store.incr('db', 'coll', {'k': 1}, {'hits': 1})
+        store.incr('db', 'coll', {'k': 2}, {'hits': 1})
+        store.incr('db', 'coll', {'k': 1}, {'hits': 2, 'bytes': 10})
+        store.incr('db', 'coll', {'k': 3}, {'hits': 1})
+        self.assertEqual(emitted, [('db', 'coll', {'k': 2}, {'$inc': {'hits': 1}})])
+        store.flush()
+        self.assertEqual(emitted[1:], [('db', 'coll', {'k': 1}, {'$inc': {'hits': 3, 'bytes': 10}}),
+                                       ('db', 'coll', {'k': 3}, {'$inc': {'hits': 1}})])
+        self.assertEqual(store.get_stats(), {'keys': 0, 'increments': 4,
+                                             'emitted': 3, 'evictions': 1})
+
+    def test_2(self):
+        '''aggregator sends one upsert per counter key and flush'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo)
+        for i in range(1000):
+            aggregator.counter('db', 'stats', {'key': i % 10}).incr('hits')
+        aggregator.counter('db', 'stats', {'key': 0}).incr_many({'hits': 1, 'errors': 2})
+        aggregator.execute()
+        self.assertEqual(mongo.written_ops, 10)
+        self.assertEqual(aggregator.get_results()[('db', 'stats')]['nModified'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
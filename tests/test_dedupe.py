@@ -0,0 +1,102 @@
+import unittest
+
+from pymongo.errors import AutoReconnect
+from moquag import MongoQueryAggregator
+from moquag.main import BulkOperator
+from moquag.dedupe import RotatingBloomFilter, encode_key
+from moquag.backpressure import BufferLimiter, BufferFullError
+from benchmarks.fake import FakeMongo
+from .helpers import RecordingBackend
+
+
+class TestDedupe(unittest.TestCase):
+
+    def test_1(self):
+        '''inserts repeating a key of the window are dropped and counted'''
+        bulk_operator = BulkOperator(None, backend=RecordingBackend,
+                                     dedupe_key='msg.id')
+        bulk_operator.insert({'msg': {'id': 1}, 'n': 1})
+        future = bulk_operator.insert({'msg': {'id': 1}, 'n': 2}, future=True)
+        bulk_operator.add('insert', {'msg': {'id': 1}, 'n': 3})
+        bulk_operator.insert({'msg': {'id': {'a': 1}}})
+        bulk_operator.insert({'msg': {'id': {'a': 1}}})
+        bulk_operator.insert({'msg': {'id': True}})
+        bulk_operator.insert({'n': 4})
+        bulk_operator.insert({'n': 4})
+        self.assertIsNone(future.result(0))
+        self.assertEqual(bulk_operator.insert_count, 5)
+        result = bulk_operator.execute()
+        self.assertEqual(result['nDeduplicated'], 3)
+        self.assertEqual(len(bulk_operator.backend.sent), 5)
+        # a new window starts after execute
+        bulk_operator.insert({'msg': {'id': 1}})
+        self.assertEqual(bulk_operator.execute()['nInserted'], 1)
+
+    def test_2(self):
+        '''the filter remembers keys of two generations with few false positives'''
+        bloom_filter = RotatingBloomFilter(1000, 0.01)
+        keys = [encode_key(i) for i in range(3000)]
+        for key in keys[:1000]:
+            bloom_filter.add(key)
+        self.assertTrue(all(key in bloom_filter for key in keys[:1000]))
+        false_positives = sum(key in bloom_filter for key in keys[1000:])
+        self.assertLess(false_positives, 60)
+        for key in keys[1000:2001]:
+            bloom_filter.add(key)
+        # the first generation is forgotten, the second one is kept
+        self.assertLess(sum(key in bloom_filter for key in keys[:1000]), 60)
+        self.assertTrue(all(key in bloom_filter for key in keys[1000:2001]))
+
+    def test_3(self):
+        '''duplicates of earlier flushes are dropped once those succeeded'''
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=RecordingBackend,
+                                          dedupe_filter_capacity=1000,
+                                          write_policies={'db.events': {'dedupe_key': '_id'}})
+        aggregator.db.events.insert({'_id': 1})
+        aggregator.db.other.insert({'_id': 1})
+        RecordingBackend.error = AutoReconnect('down')
+        self.assertRaises(AutoReconnect, aggregator.db.execute)
+        aggregator.db.events.insert({'_id': 1})
+        aggregator.db.other.insert({'_id': 1})
+        aggregator.execute()
+        aggregator.db.events.insert({'_id': 1})
+        aggregator.db.events.insert({'_id': 2})
+        aggregator.db.other.insert({'_id': 1})
+        aggregator.execute()
+        results = aggregator.get_results()
+        self.assertEqual(results[('db', 'events')]['nInserted'], 2)
+        self.assertEqual(results[('db', 'events')]['nDeduplicated'], 1)
+        self.assertEqual(results[('db', 'other')], {'nInserted': 3})
+
+    def test_4(self):
+        '''a window of only duplicates still reports them'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo, dedupe_key='_id',
+                                          dedupe_filter_capacity=1000)
+        aggregator.db.events.insert({'_id': 1})
+        aggregator.execute()
+        aggregator.db.events.insert({'_id': 1})
+        aggregator.execute()
+        self.assertEqual(aggregator.get_results()[('db', 'events')],
+                         {'nInserted': 1, 'nDeduplicated': 1})
+        self.assertEqual(mongo.written_ops, 1)
+
+    def test_5(self):
+        '''inserts dropped by the limiter are not duplicates of their retry'''
+        limiter = BufferLimiter(max_ops=1, policy='drop_newest')
+        other = BulkOperator(None, backend=RecordingBackend, limiter=limiter)
+        bulk_operator = BulkOperator(None, backend=RecordingBackend, limiter=limiter,
+                                     dedupe_key='_id')
+        other.insert({'_id': 1})
+        future = bulk_operator.insert({'_id': 2}, future=True)
+        self.assertIsInstance(future.exception(0), BufferFullError)
+        other.execute()
+        # the retry is in the same window of bulk_operator
+        bulk_operator.insert({'_id': 2})
+        result = bulk_operator.execute()
+        self.assertEqual(result, {'nInserted': 1})
+        self.assertEqual(bulk_operator.backend.sent[0][1], {'_id': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
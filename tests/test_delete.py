@@ -0,0 +1,89 @@
+import unittest
+
+from bson import ObjectId
+from moquag import MongoQueryAggregator
+from moquag.coalesce import DeleteCoalescer, get_delete_field
+from benchmarks.fake import FakeMongo
+
+
+class TestDelete(unittest.TestCase):
+
+    def test_1(self):
+        '''single equality deletes are folded into chunked $in deletes'''
+        self.assertEqual(get_delete_field('remove', {'ts': 1}), 'ts')
+        self.assertEqual(get_delete_field('remove_one', {'_id': 1}), '_id')
+        self.assertIsNone(get_delete_field('remove_one', {'ts': 1}))
+        self.assertIsNone(get_delete_field('remove', {'ts': {'$lt': 1}}))
+        self.assertIsNone(get_delete_field('remove', {'a': 1, 'b': 2}))
+        coalescer = DeleteCoalescer(chunk_size=2)
+        self.assertEqual([coalescer.add('_id', i) for i in range(3)], [False, True, False])
+        self.assertEqual(len(coalescer), 2)
+        self.assertEqual(coalescer.folded_count, 1)
+        self.assertListEqual(coalescer.drain(), [
+            ('remove', {'_id': {'$in': [0, 1]}}, None, False),
+            ('remove', {'_id': {'$in': [2]}}, None, False)])
+        self.assertEqual(len(coalescer), 0)
+
+    def test_2(self):
+        '''aggregator counts buffered removes and folds them with coalesce'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 1000, backend=mongo, ordered=False,
+                                          coalesce=True, delete_chunk_size=100)
+        ids = [ObjectId() for i in range(250)]
+        for object_id in ids[:200]:
+            aggregator.db.sessions.remove_one({'_id': object_id})
+        aggregator.db.sessions.remove_many({'_id': object_id} for object_id in ids[200:])
+        aggregator.db.sessions.remove({'expires': {'$lt': 10}})
+        self.assertEqual(aggregator.get_buffered_query_count(),
+                         {('sessions', 'db'): {'insert': 0, 'find': 0, 'remove': 251}})
+        aggregator.execute()
+        self.assertEqual(mongo.written_ops, 4)
+        self.assertEqual(aggregator.get_results()[('db', 'sessions')]['nCoalesced'], 247)
+
+    def test_3(self):
+        '''removes are not folded without coalesce'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 1000, backend=mongo)
+        writer = aggregator.collection('db', 'sessions')
+        writer.remove_many({'_id': i} for i in range(10))
+        writer.remove_one({'_id': 10})
+        aggregator.execute()
+        self.assertEqual(mongo.written_ops, 11)
+        self.assertEqual(aggregator.get_results()[('db', 'sessions')]['nRemoved'], 11)
+
+    def test_4(self):
+        '''delete_many takes one filter, remove_many rejects anything but selectors'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 1000, backend=mongo)
+        writer = aggregator.collection('db', 'sessions')
+        aggregator.db.sessions.delete_many({'status': 'old'})
+        writer.delete_many({'status': 'expired'})
+        self.assertRaises(TypeError, aggregator.db.sessions.remove_many, {'status': 'old'})
+        self.assertRaises(TypeError, writer.remove_many, [{'_id': 1}, 'status'])
+        self.assertRaises(TypeError, aggregator.db.sessions.delete_many, 'status')
+        self.assertEqual(aggregator.get_buffered_query_count(),
+                         {('sessions', 'db'): {'insert': 0, 'find': 0, 'remove': 2}})
+        aggregator.execute()
+        self.assertEqual(mongo.written_ops, 2)
+
+    def test_5(self):
+        '''removes added by op or through find are counted as removes, folded
+        ones count toward max_ops_limit'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo, ordered=False,
+                                          coalesce=True)
+        aggregator.enqueue('db', 'sessions', 'remove_one', {'_id': 0})
+        aggregator.db.sessions.find({'user': 1}).remove()
+        aggregator.db.sessions.find({'user': 2}).update_one({'$set': {'seen': True}})
+        self.assertEqual(aggregator.get_buffered_query_count(),
+                         {('sessions', 'db'): {'insert': 0, 'find': 1, 'remove': 2}})
+        for i in range(1, 500):
+            aggregator.db.sessions.remove_one({'_id': i})
+        # 5 flushes of 100 operations, the first one of 3 operations after folding
+        self.assertEqual(mongo.written_ops, 3 + 4)
+        self.assertEqual(aggregator.get_buffered_query_count(),
+                         {('sessions', 'db'): {'insert': 0, 'find': 0, 'remove': 2}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+from bson import decode
+
+from moquag import MongoQueryAggregator
+from moquag.backends import BulkWriteBackend, EncodedBulkWriteBackend
+from benchmarks.fake import FakeMongo
+
+
+class TestEncoded(unittest.TestCase):
+
+    def test_1(self):
+        '''operations are kept encoded and decoded back unchanged'''
+        backend = EncodedBulkWriteBackend(None)
+        backend.insert({'i': 1})
+        backend.add('update_one', {'i': 2}, {'$set': {'x': 1}}, True)
+        backend.add('remove', {'i': 3}, None, False)
+        self.assertEqual(len(backend), 3)
+        op, selector, document, upsert = backend.pop_oldest()
+        self.assertEqual((op, decode(selector.raw), document, upsert),
+                         ('insert', {'i': 1}, None, False))
+        operations = [(op, decode(selector.raw), document and decode(document.raw), upsert)
+                      for op, selector, document, upsert in backend.detach()]
+        self.assertEqual(operations, [('update_one', {'i': 2}, {'$set': {'x': 1}}, True),
+                                      ('remove', {'i': 3}, None, False)])
+        self.assertEqual(len(backend), 0)
+        self.assertEqual(len(backend.buffer), 0)
+
+    def test_2(self):
+        '''aggregator tracks encoded sizes and flushes at max_batch_bytes'''
+        mongo = FakeMongo(backend=EncodedBulkWriteBackend)
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo, max_batch_bytes=100)
+        for i in range(10):
+            # 22 bytes per document
+            aggregator.db.coll.insert({'i': i, 's': 'ab'})
+        self.assertEqual([write['ops'] for write in mongo.recent_writes], [4, 4])
+        aggregator.execute()
+        self.assertEqual(mongo.written_ops, 10)
+        self.assertEqual(aggregator.get_metrics()['collections'][('db', 'coll')]['bytes'], 220)
+
+    def test_3(self):
+        '''an operation larger than the average flushes before crossing max_batch_bytes'''
+        mongo = FakeMongo(backend=EncodedBulkWriteBackend)
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo, max_batch_bytes=100)
+        for i in range(3):
+            aggregator.db.coll.insert({'i': i, 's': 'ab'})
+        # 50 bytes, 66 buffered bytes plus the average 22 stay under the limit
+        aggregator.db.coll.insert({'i': 3, 's': 'x' * 30})
+        self.assertEqual([write['ops'] for write in mongo.recent_writes], [3])
+        self.assertEqual(aggregator.db.coll.total_bytes, 50)
+        # a single operation larger than the limit is still sent
+        aggregator.db.other.insert({'i': 0, 's': 'x' * 100})
+        self.assertEqual(aggregator.db.other.total_ops, 1)
+
+    def test_4(self):
+        '''malformed operations are rejected when enqueued, the batch is sent'''
+        for backend in (BulkWriteBackend, EncodedBulkWriteBackend):
+            mongo = FakeMongo(backend=backend)
+            aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo)
+            aggregator.db.coll.insert({'i': 1})
+            self.assertRaises(ValueError, aggregator.db.coll.find({'i': 1}).update_one, {'a': 1})
+            self.assertRaises(ValueError, aggregator.db.coll.find({'i': 1}).replace_one,
+                              {'$set': {'a': 1}})
+            self.assertRaises(TypeError, aggregator.db.coll.insert, [{'i': 2}])
+            self.assertRaises(TypeError, aggregator.db.coll.remove, 'i')
+            aggregator.db.coll.find({'i': 1}).update_one({'$set': {'a': 1}})
+            aggregator.execute()
+            self.assertEqual(mongo.written_ops, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import tempfile
+import shutil
+import os
+from time import sleep, time
+
+from moquag import MongoQueryAggregator
+from moquag.funnel import FunnelServer, FunnelClient, encode_record
+from benchmarks.fake import FakeMongo
+
+
+class TestFunnel(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mongo = FakeMongo()
+        self.aggregator = MongoQueryAggregator({}, 3600, 1000, backend=self.mongo)
+        self.server = FunnelServer(self.aggregator, os.path.join(self.directory, 'funnel.sock'))
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop(flush=False)
+        shutil.rmtree(self.directory)
+
+    def wait_received(self, count):
+        deadline = time() + 5
+        while self.server.received < count and time() < deadline:
+            sleep(0.01)
+
+    def test_1(self):
+        '''operations of many clients are batched by one aggregator'''
+        clients = [FunnelClient(self.server.path, buffer_size=0) for _ in range(3)]
+        for i, client in enumerate(clients):
+            client.db.profiles.insert({'i': i})
+            client.db.profiles.find({'i': i}).upsert().update_one({'$set': {'seen': True}})
+            client.db['events'].find({'i': i}).remove()
+        self.wait_received(9)
+        self.assertEqual(self.aggregator.get_buffered_query_count(), {
+            ('profiles', 'db'): {'insert': 3, 'find': 3, 'remove': 0},
+            ('events', 'db'): {'insert': 0, 'find': 0, 'remove': 3}})
+        clients[0].execute()
+        self.wait_received(10)
+        self.assertEqual(self.mongo.written_ops, 9)
+        self.assertEqual(self.mongo.bulk_writes, 2)
+        for client in clients:
+            client.close()
+
+    def test_2(self):
+        '''client buffers operations until buffer_size is reached'''
+        client = FunnelClient(self.server.path, buffer_size=1 << 20, flush_interval=60)
+        for i in range(10):
+            client.db.coll.insert({'i': i})
+        sleep(0.05)
+        self.assertEqual(self.server.received, 0)
+        client.flush()
+        self.wait_received(10)
+        self.assertEqual(self.server.received, 10)
+        client.close()
+
+    def test_3(self):
+        '''operations of an idle client are written after flush_interval,
+        a thread safe aggregator serves clients without the server lock'''
+        client = FunnelClient(self.server.path, buffer_size=1 << 20, flush_interval=0.05)
+        client.db.coll.insert({'i': 1})
+        self.wait_received(1)
+        self.assertEqual(self.server.received, 1)
+        client.close()
+        aggregator = MongoQueryAggregator({}, 3600, 1000, backend=self.mongo, thread_safe=True)
+        server = FunnelServer(aggregator, os.path.join(self.directory, 'safe.sock'))
+        server.start()
+        clients = [FunnelClient(server.path, buffer_size=0) for _ in range(4)]
+        for i in range(100):
+            clients[i % 4].db.coll.insert({'i': i})
+        deadline = time() + 5
+        while server.received < 100 and time() < deadline:
+            sleep(0.01)
+        server.stop()
+        self.assertEqual(self.mongo.written_ops, 100)
+        for client in clients:
+            client.close()
+
+    def test_4(self):
+        '''a malformed operation is refused by the client, one reaching the
+        server is rejected without losing the following operations'''
+        client = FunnelClient(self.server.path, buffer_size=0)
+        with self.assertRaises(ValueError):
+            client.db.coll.find({'i': 1}).update_one({'i': 2})
+        client.send(encode_record('db', 'coll', 'update_one', {'i': 1}, {'i': 2}))
+        client.send(encode_record('db', 'coll', 'insert', None))
+        client.db.coll.insert({'i': 3})
+        deadline = time() + 5
+        while self.server.received + self.server.rejected < 3 and time() < deadline:
+            sleep(0.01)
+        self.assertEqual(self.server.rejected, 2)
+        self.assertEqual(self.server.received, 1)
+        self.assertEqual(self.aggregator.get_buffered_query_count(), {
+            ('coll', 'db'): {'insert': 1, 'find': 0, 'remove': 0}})
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
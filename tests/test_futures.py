@@ -0,0 +1,85 @@
+import unittest
+import threading
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, WriteError, AutoReconnect
+from moquag import MongoQueryAggregator
+from moquag.main import BulkOperator
+from moquag.futures import WriteFuture
+from benchmarks.fake import FakeMongo
+from .helpers import ResultBackend
+
+
+class TestFutures(unittest.TestCase):
+
+    def test_1(self):
+        '''futures get upserted ids and the write errors of their own index'''
+        upserted_id = ObjectId()
+        result = {'nInserted': 1, 'nUpserted': 1, 'nMatched': 0, 'nModified': 0,
+                  'nRemoved': 0, 'upserted': [{'index': 3, '_id': upserted_id}],
+                  'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'duplicate key'}],
+                  'writeConcernErrors': []}
+        bulk_operator = BulkOperator(BulkWriteError(result), backend=ResultBackend)
+        futures = [bulk_operator.insert({'_id': 1}, future=True),
+                   bulk_operator.insert({'_id': 2}, future=True)]
+        bulk_operator.insert({'_id': 3})
+        called = []
+        futures.append(bulk_operator.find({'name': 'x'}, callback=called.append)
+                       .upsert().update_one({'$set': {'n': 1}}))
+        self.assertFalse(futures[0].done())
+        self.assertRaises(BulkWriteError, bulk_operator.execute)
+        self.assertRaises(WriteError, futures[0].result)
+        self.assertEqual(futures[0].exception().code, 11000)
+        self.assertIsNone(futures[1].result())
+        self.assertEqual(futures[2].result(), upserted_id)
+        self.assertEqual(called, [futures[2]])
+
+    def test_2(self):
+        '''ordered bulks fail the operations after a write error, connection
+        errors fail all of them
+        '''
+        result = {'upserted': [], 'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'x'}]}
+        bulk_operator = BulkOperator(BulkWriteError(result), ordered=True, backend=ResultBackend)
+        futures = [bulk_operator.add('remove', {'i': i}, future=True) for i in range(2)]
+        self.assertRaises(BulkWriteError, bulk_operator.execute)
+        self.assertIsInstance(futures[0].exception(), WriteError)
+        self.assertIsInstance(futures[1].exception(), BulkWriteError)
+        bulk_operator = BulkOperator(AutoReconnect('down'), backend=ResultBackend)
+        future = bulk_operator.remove_one({'_id': 1}, future=True)
+        self.assertRaises(AutoReconnect, bulk_operator.execute)
+        self.assertIsInstance(future.exception(), AutoReconnect)
+
+    def test_3(self):
+        '''operations with a future are not coalesced, without one no future
+        is created
+        '''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo, ordered=False,
+                                          coalesce=True)
+        self.assertIsNone(aggregator.enqueue('db', 'coll', 'remove', {'_id': 1}))
+        aggregator.enqueue('db', 'coll', 'remove', {'_id': 2})
+        future = aggregator.enqueue('db', 'coll', 'remove', {'_id': 3}, future=True)
+        aggregator.execute()
+        self.assertEqual(mongo.written_ops, 2)
+        self.assertIsNone(future.result(timeout=0))
+
+    def test_4(self):
+        '''every callback added while the future resolves is called once,
+        a callback may add another one'''
+        for _ in range(200):
+            future = WriteFuture()
+            calls = []
+            adders = [threading.Thread(target=future.add_done_callback,
+                                       args=(calls.append,)) for _ in range(4)]
+            for adder in adders:
+                adder.start()
+            future.set_result(None)
+            for adder in adders:
+                adder.join()
+            self.assertEqual(len(calls), 4)
+        future.add_done_callback(lambda done: done.add_done_callback(calls.append))
+        self.assertEqual(len(calls), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
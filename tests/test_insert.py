@@ -4,6 +4,7 @@ from pymongo import MongoClient
 from moquag import MongoQueryAggregator
 from time import sleep
 from .settings import MONGO_DB_SETTINGS, logger
+from .helpers import count_documents
 from collections import Counter
 
 
@@ -130,3 +131,45 @@ class TestBulk(unittest.TestCase):
         }
         aggregators_results = mongo_agg.get_results()
         self.assertEqual(aggregators_expected_results, aggregators_results)
+
+    def test_5(self):
+        '''inserting to multiple dbs with max_workers=4 so all
+        collections are flushed in parallel'''
+        mongo_agg = MongoQueryAggregator(MONGO_DB_SETTINGS, 1, 5, max_workers=4)
+        dbs_to_data = {
+            'testdb1': [{'name': 'User1', 'id': 1}, {'name': 'User2', 'id': 2}],
+            'testdb2': [{'name': 'User3', 'id': 3}],
+            'testdb3': [{'name': 'User5', 'id': 5}, {'name': 'User6', 'id': 6}]
+        }
+        for db_name in dbs_to_data:
+            for doc in dbs_to_data[db_name]:
+                mongo_agg[db_name].profiles.insert(doc)
+                mongo_agg[db_name].events.insert({'id': doc['id']})
+        mongo_agg.execute()
+        for db_name in dbs_to_data:
+            data = self.conn[db_name].profiles.find().sort([('id', 1)])
+            self.assertListEqual(list(data), dbs_to_data[db_name])
+            self.assertEqual(count_documents(self.conn[db_name].events),
+                             len(dbs_to_data[db_name]))
+        aggregators_expected_results = {
+            ('testdb1', 'profiles'): Counter({'nInserted': 2}),
+            ('testdb1', 'events'): Counter({'nInserted': 2}),
+            ('testdb2', 'profiles'): Counter({'nInserted': 1}),
+            ('testdb2', 'events'): Counter({'nInserted': 1}),
+            ('testdb3', 'profiles'): Counter({'nInserted': 2}),
+            ('testdb3', 'events'): Counter({'nInserted': 2})
+        }
+        self.assertEqual(aggregators_expected_results, mongo_agg.get_results())
+
+    def test_6(self):
+        '''inserting 10 documents of ~60 bytes with max_batch_bytes=200
+        so documents are flushed in batches of 3'''
+        mongo_agg = MongoQueryAggregator(MONGO_DB_SETTINGS, 1, 50, max_batch_bytes=200)
+        for i in range(10):
+            mongo_agg.testdb1.profiles.insert({'id': i, 'pad': 'x' * 40})
+        self.assertEqual(count_documents(self.conn['testdb1'].profiles), 9)
+        self.assertEqual(mongo_agg.testdb1.profiles.total_ops, 1)
+        aggregators_expected_results = {
+            ('testdb1', 'profiles'): Counter({'nInserted': 9})
+        }
+        self.assertEqual(aggregators_expected_results, mongo_agg.get_results())
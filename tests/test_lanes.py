@@ -0,0 +1,72 @@
+import threading
+import unittest
+
+from moquag import MongoQueryAggregator
+from .helpers import RecordingBackend
+
+LANES = {'realtime': {'interval': 0.01, 'max_ops_limit': 2, 'priority': 1}}
+
+
+def recording_backend(sent, gate=None):
+    class LaneBackend(RecordingBackend):
+
+        def send(self, operations, write_concern=None):
+            collection = self.collection.name
+            if gate is not None and collection == 'analytics' and not gate.wait(5):
+                raise AssertionError('realtime lane waited behind the analytics batch')
+            sent.append((collection, len(operations)))
+            result = RecordingBackend.send(self, operations, write_concern)
+            if gate is not None and collection == 'sessions':
+                gate.set()
+            return result
+
+    return LaneBackend
+
+
+class TestLanes(unittest.TestCase):
+
+    def test_1(self):
+        '''lanes keep their own batch limit and higher priority flushes first'''
+        sent = []
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=recording_backend(sent),
+                                          lanes=LANES)
+        for i in range(3):
+            aggregator.db.analytics.insert({'i': i})
+        for i in range(3):
+            aggregator.lane('realtime').db.sessions.insert({'i': i})
+        self.assertEqual(sent, [('sessions', 2)])
+        aggregator.enqueue('db', 'sessions', 'insert', {'i': 3}, lane='realtime')
+        self.assertEqual(aggregator.get_buffered_query_count()[('sessions', 'db')]['insert'], 2)
+        aggregator.execute()
+        self.assertEqual(sent, [('sessions', 2), ('sessions', 2), ('analytics', 3)])
+        self.assertEqual(aggregator.get_results()[('db', 'sessions')]['nInserted'], 4)
+
+    def test_2(self):
+        '''unknown lanes and lane options are rejected'''
+        aggregator = MongoQueryAggregator({}, 3600, 100, lanes=LANES)
+        self.assertRaises(ValueError, aggregator.lane, 'bulk')
+        self.assertRaises(ValueError, MongoQueryAggregator, {}, 3600, 100,
+                          lanes={'realtime': {'timeout': 1}})
+        self.assertRaises(ValueError, MongoQueryAggregator, {}, 3600, 100,
+                          lanes={'default': {'interval': 1}})
+
+    def test_3(self):
+        '''the realtime lane is flushed while an analytics batch is in flight'''
+        sent = []
+        gate = threading.Event()
+        aggregator = MongoQueryAggregator({}, 3600, 2, backend=recording_backend(sent, gate),
+                                          background_flush=True, lanes=LANES)
+        try:
+            for i in range(3):
+                # the third insert hands the full batch to the default lane thread
+                aggregator.db.analytics.insert({'i': i})
+            aggregator.lane('realtime').db.sessions.insert({'i': 0})
+            self.assertTrue(gate.wait(5))
+        finally:
+            aggregator.stop_scheduler()
+        self.assertEqual(sent[0], ('sessions', 1))
+        self.assertEqual(sorted(sent[1:]), [('analytics', 1), ('analytics', 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
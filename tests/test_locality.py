@@ -0,0 +1,69 @@
+import unittest
+
+from pymongo.errors import BulkWriteError, WriteError
+from moquag import MongoQueryAggregator
+from moquag.main import BulkOperator
+from moquag.locality import get_locality_order, get_sort_value
+from .helpers import ResultBackend
+
+
+class TestLocality(unittest.TestCase):
+
+    def test_1(self):
+        '''operations are grouped by kind and sorted by the key'''
+        operations = [('update_one', {'id': 3}, {'$set': {'a': 1}}, True),
+                      ('remove', {'id': 2}, None, False),
+                      ('insert', {'_id': 9}, None, False),
+                      ('update_one', {'id': {'$in': [1, 2]}}, {'$set': {'a': 1}}, False),
+                      ('update_one', {'id': 'b'}, {'$set': {'a': 1}}, True),
+                      ('insert', {'id': 1, '_id': 10}, None, False),
+                      ('update_one', {'id': 1}, {'$set': {'a': 1}}, True)]
+        self.assertEqual(get_locality_order(operations, 'id'), [5, 2, 6, 0, 4, 3, 1])
+
+    def test_2(self):
+        '''futures get the outcome of their operation in the sorted batch'''
+        error = BulkWriteError({'upserted': [],
+                                'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'dup'}]})
+        bulk_operator = BulkOperator(error, backend=ResultBackend, sort_key='id')
+        futures = [bulk_operator.find({'id': i}, future=True).upsert().update_one(
+            {'$set': {'n': i}}) for i in (5, 1, 3)]
+        bulk_operator.insert({'_id': 7})
+        self.assertRaises(BulkWriteError, bulk_operator.execute)
+        self.assertEqual([operation[1] for operation in bulk_operator.backend.sent],
+                         [{'_id': 7}, {'id': 1}, {'id': 3}, {'id': 5}])
+        self.assertIsNone(futures[0].result())
+        self.assertIsNone(futures[1].result())
+        self.assertIsNone(futures[2].result())
+        error = BulkWriteError({'upserted': [],
+                                'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'dup'}]})
+        bulk_operator = BulkOperator(error, backend=ResultBackend, sort_key='id')
+        futures = [bulk_operator.find({'id': i}, future=True).upsert().update_one(
+            {'$set': {'n': i}}) for i in (5, 1, 3)]
+        self.assertRaises(BulkWriteError, bulk_operator.execute)
+        self.assertIsInstance(futures[2].exception(), WriteError)
+        self.assertIsNone(futures[0].exception())
+        self.assertIsNone(futures[1].exception())
+
+    def test_3(self):
+        '''write policies sort unordered collections only'''
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=ResultBackend,
+                                          write_policies={'db.events': {'ordered': False,
+                                                                        'sort_key': 'id'},
+                                                          'db.audit': {'sort_key': 'id'}})
+        self.assertEqual(aggregator.db.events.sort_key, 'id')
+        self.assertIsNone(aggregator.db.audit.sort_key)
+        self.assertRaises(ValueError, MongoQueryAggregator, {}, 3600, 100, sort_key='id')
+        self.assertRaises(ValueError, BulkOperator, None, ordered=True, sort_key='id')
+
+    def test_4(self):
+        '''text keys are sorted by value before bytes keys'''
+        self.assertEqual(get_sort_value(u'b'), (1, u'b'))
+        self.assertEqual(get_sort_value(b'b'), (2, b'b'))
+        operations = [('insert', {'id': b'a'}, None, False),
+                      ('insert', {'id': u'b'}, None, False),
+                      ('insert', {'id': u'a'}, None, False)]
+        self.assertEqual(get_locality_order(operations, 'id'), [2, 1, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
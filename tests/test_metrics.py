@@ -0,0 +1,54 @@
+import unittest
+from unittest import mock
+
+from moquag.metrics import Histogram, FlushMetrics, render_prometheus
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_1(self):
+        '''Histogram keeps cumulative fixed buckets'''
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['buckets'], [(1, 2), (10, 3), (float('inf'), 4)])
+        self.assertEqual(snapshot['sum'], 56.5)
+        self.assertEqual(snapshot['count'], 4)
+
+    def test_2(self):
+        '''FlushMetrics counts flushes, errors and retries per collection'''
+        metrics = FlushMetrics()
+        metrics.record_flush('db', 'coll', 0.01, 12, 10, 1000,
+                             {'nRetried': 2, 'writeErrors': [{'index': 0}]})
+        metrics.record_flush('db', 'coll', 0.02, 5, 5)
+        snapshot = metrics.snapshot(buffered_ops=3)
+        self.assertEqual(snapshot['enqueued'], 17)
+        coll = snapshot['collections'][('db', 'coll')]
+        self.assertEqual(coll['flushes'], 2)
+        self.assertEqual(coll['errors'], 1)
+        self.assertEqual(coll['retries'], 2)
+        self.assertEqual(coll['write_errors'], 1)
+        self.assertEqual(coll['bytes_per_flush']['count'], 1)
+        text = render_prometheus(snapshot)
+        self.assertIn('moquag_flush_duration_seconds_count{db="db",collection="coll"} 2', text)
+        self.assertIn('moquag_retries_total{db="db",collection="coll"} 2', text)
+        self.assertIn('moquag_buffered_ops 3', text)
+
+    def test_3(self):
+        '''enqueued never drops with buffered ops and reads do not reset the rate'''
+        metrics = FlushMetrics()
+        with mock.patch('moquag.metrics.time', return_value=metrics.start_time + 10):
+            metrics.record_flush('db', 'coll', 0.01, 100, 100)
+        with mock.patch('moquag.metrics.time', return_value=metrics.start_time + 20):
+            first = metrics.snapshot(buffered_ops=50)
+            second = metrics.snapshot(buffered_ops=0)
+        self.assertEqual(first['enqueued'], 100)
+        self.assertEqual(second['enqueued'], 100)
+        self.assertEqual(first['enqueue_rate'], 5)
+        self.assertEqual(second['enqueue_rate'], 5)
+        self.assertIn('moquag_enqueued_ops_total 100', render_prometheus(second))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from moquag import MongoQueryAggregator
+from moquag.overlay import PendingWriteOverlay, get_equality_key
+from benchmarks.fake import FakeMongo
+
+
+class TestOverlay(unittest.TestCase):
+
+    def setUp(self):
+        self.overlay = PendingWriteOverlay()
+        self.flushes = []
+
+    def find_one(self, selector, stored=None):
+        return self.overlay.find_one('db', 'coll', selector, lambda: stored,
+                                     lambda: self.flushes.append(selector))
+
+    def test_1(self):
+        '''pending $set updates are merged into the stored document'''
+        self.assertEqual(get_equality_key({'a': 1, 'b': 2}), get_equality_key({'b': 2, 'a': 1}))
+        self.assertIsNone(get_equality_key({'a': {'$gt': 1}}))
+        pending = self.overlay.open('db', 'coll')
+        pending.record('update_one', {'_id': 1}, {'$set': {'name': 'x', 'address.city': 'y'}})
+        self.assertEqual(self.find_one({'_id': 1}, {'_id': 1, 'n': 2}),
+                         {'_id': 1, 'n': 2, 'name': 'x', 'address': {'city': 'y'}})
+        # without upsert a missing document stays missing
+        self.assertIsNone(self.find_one({'_id': 1}))
+        pending.record('update_one', {'_id': 1}, {'$set': {'n': 3}}, True)
+        self.assertEqual(self.find_one({'_id': 1}),
+                         {'_id': 1, 'n': 3})
+        pending.close()
+        self.assertEqual(self.find_one({'_id': 1}, {'_id': 1}), {'_id': 1})
+        self.assertEqual(self.flushes, [])
+
+    def test_2(self):
+        '''writes which can not be merged flush before the read'''
+        pending = self.overlay.open('db', 'coll')
+        pending.record('update_one', {'_id': 1}, {'$inc': {'n': 1}})
+        self.assertEqual(self.find_one({'_id': 1}, {'_id': 1, 'n': 1}), {'_id': 1, 'n': 1})
+        pending.close()
+        pending = self.overlay.open('db', 'coll')
+        pending.record('remove', {'n': {'$lt': 1}})
+        self.find_one({'_id': 2})
+        self.assertEqual(self.flushes, [{'_id': 1}, {'_id': 2}])
+
+    def test_4(self):
+        '''writes on other fields of the collection flush before the read'''
+        pending = self.overlay.open('db', 'coll')
+        pending.record('update_one', {'email': 'a'}, {'$set': {'email': 'b'}})
+        pending.record('insert', {'_id': 1, 'email': 'c'})
+        self.find_one({'_id': 1})
+        self.find_one({'email': 'b'})
+        self.find_one({'email': 'c'})
+        self.assertEqual(self.flushes, [{'_id': 1}, {'email': 'b'}, {'email': 'c'}])
+        pending.close()
+        # writes on other _ids never change the document of an _id
+        pending = self.overlay.open('db', 'coll')
+        pending.record('insert', {'_id': 2, 'email': 'c'})
+        pending.record('update_one', {'_id': 3}, {'$set': {'email': 'd'}})
+        self.assertEqual(self.find_one({'_id': 1}, {'_id': 1}), {'_id': 1})
+        self.assertEqual(len(self.flushes), 3)
+
+    def test_3(self):
+        '''aggregator answers from buffered inserts and updates'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo, read_overlay=True)
+        document = {'name': 'x'}
+        aggregator.db.users.insert(document)
+        aggregator.db.users.find({'_id': document['_id']}).update_one({'$set': {'age': 3}})
+        self.assertEqual(aggregator.find_one('db', 'users', {'_id': document['_id']}),
+                         {'_id': document['_id'], 'name': 'x', 'age': 3})
+        aggregator.db.users.remove_one({'_id': document['_id']})
+        self.assertIsNone(aggregator.find_one('db', 'users', {'_id': document['_id']}))
+        self.assertEqual(mongo.written_ops, 0)
+        aggregator.execute()
+        self.assertEqual(mongo.written_ops, 3)
+        self.assertEqual(aggregator.overlay.get_operations('db', 'users', {'_id': 1}), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+from time import sleep, time
+
+from moquag import MongoQueryAggregator, WritePolicy, WritePolicyRegistry
+from benchmarks.fake import FakeMongo
+
+
+class TestPolicies(unittest.TestCase):
+
+    def test_1(self):
+        '''specific patterns override database and wildcard patterns'''
+        registry = WritePolicyRegistry({
+            'billing': WritePolicy(ordered=True, write_concern={'w': 'majority'}),
+            'billing.*': {'max_ops_limit': 10},
+            'billing.events': {'ordered': False},
+            '*.audit_*': {'bypass_document_validation': True},
+        })
+        self.assertEqual(registry.resolve('billing', 'events'),
+                         {'ordered': False, 'write_concern': {'w': 'majority'},
+                          'max_ops_limit': 10})
+        self.assertEqual(registry.resolve('billing', 'invoices'),
+                         {'ordered': True, 'write_concern': {'w': 'majority'},
+                          'max_ops_limit': 10})
+        self.assertEqual(registry.resolve('analytics', 'audit_log'),
+                         {'bypass_document_validation': True})
+        registry.register('analytics', ordered=False)
+        self.assertEqual(registry.resolve('analytics', 'audit_log'),
+                         {'bypass_document_validation': True, 'ordered': False})
+
+    def test_2(self):
+        '''aggregator applies ordered, write concern and max_ops_limit per collection'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo, write_policies={
+            'analytics': {'ordered': False, 'write_concern': {'w': 1}, 'max_ops_limit': 2},
+            'billing.*': {'write_concern': {'w': 'majority'}},
+        })
+        for i in range(3):
+            aggregator.analytics.events.insert({'i': i})
+        aggregator.billing.invoices.insert({'i': 0})
+        aggregator.execute()
+        writes = sorted(mongo.recent_writes, key=lambda write: (write['db'], -write['ops']))
+        self.assertEqual([(write['db'], write['ops'], write['ordered'], write['write_concern'])
+                          for write in writes],
+                         [('analytics', 2, False, {'w': 1}),
+                          ('analytics', 1, False, {'w': 1}),
+                          ('billing', 1, True, {'w': 'majority'})])
+
+    def test_3(self):
+        '''a policy interval flushes its collection without more traffic'''
+        for background_flush in (True, False):
+            mongo = FakeMongo()
+            aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo,
+                                              background_flush=background_flush,
+                                              write_policies={'realtime': {'interval': 0.02}})
+            aggregator.realtime.events.insert({'i': 0})
+            aggregator.analytics.events.insert({'i': 0})
+            deadline = time() + 1
+            while mongo.written_ops < 1 and time() < deadline:
+                sleep(0.005)
+                if not background_flush:
+                    aggregator.counter('analytics', 'totals', {'_id': 1}).incr('n')
+            self.assertEqual([write['db'] for write in mongo.recent_writes], ['realtime'])
+            aggregator.stop_scheduler(flush=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import unittest
+from time import sleep, time
+from pymongo.errors import BulkWriteError, AutoReconnect
+from moquag import RetryPolicy
+from moquag.main import BulkOperator
+from moquag.backends import BulkWriteBackend
+
+
+class FailingBackend(object):
+    '''backend failing with the given errors, one per send'''
+
+    def __init__(self, failures, ordered=False):
+        self.collection = None
+        self.ordered = ordered
+        self.failures = list(failures)
+        self.sent = []
+
+    def send(self, operations, write_concern=None):
+        self.sent.append(list(operations))
+        failure = self.failures.pop(0) if self.failures else None
+        if isinstance(failure, Exception):
+            raise failure
+        write_errors = failure or []
+        n_inserted = len(operations) - len(write_errors)
+        if self.ordered and write_errors:
+            n_inserted = write_errors[0]['index']
+        ret = {'nInserted': n_inserted, 'nUpserted': 0,
+               'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': [],
+               'writeErrors': write_errors, 'writeConcernErrors': []}
+        if write_errors:
+            raise BulkWriteError(ret)
+        return ret
+
+
+def insert(i):
+    return ('insert', {'_id': i}, None, False)
+
+
+class FailingBulkBackend(BulkWriteBackend):
+    '''backend of a BulkOperator whose collection is a FailingBackend'''
+
+    def send(self, operations, write_concern=None):
+        return self.collection.send(operations, write_concern)
+
+
+class TestRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.dead_letters = []
+        self.policy = RetryPolicy(backoff=0, dead_letter=self.dead_letter)
+
+    def dead_letter(self, collection, operation, error):
+        self.dead_letters.append((operation, error['index']))
+
+    def test_1(self):
+        '''only transient failures are returned to be sent again, permanent
+        ones are dead lettered'''
+        backend = FailingBackend([
+            [{'index': 1, 'code': 10107, 'errmsg': 'not primary'},
+             {'index': 2, 'code': 11000, 'errmsg': 'duplicate key'}],
+            AutoReconnect('connection closed')
+        ])
+        result, retries = self.policy.send(backend, [insert(i) for i in range(4)])
+        self.assertListEqual([position for position, state in retries], [1])
+        attempt, deadline, not_before = retries[0][1]
+        self.assertEqual(attempt, 1)
+        self.assertLessEqual(not_before, deadline)
+        self.assertListEqual(self.dead_letters, [(insert(2), 2)])
+        self.assertEqual(result['nInserted'], 2)
+        self.assertEqual(result['nRetried'], 1)
+        self.assertEqual(result['nDeadLettered'], 1)
+        self.assertListEqual([error['index'] for error in result['writeErrors']], [2])
+        result, retries = self.policy.send(backend, [insert(1)], states=[retries[0][1]])
+        self.assertListEqual(retries, [(0, (2, deadline, retries[0][1][2]))])
+        self.assertEqual(len(backend.sent), 2)
+
+    def test_2(self):
+        '''ordered bulk sends operations after the failed one again, gives
+        up after max_retries'''
+        backend = FailingBackend([
+            [{'index': 1, 'code': 11000, 'errmsg': 'duplicate key'}],
+            [{'index': 0, 'code': 91, 'errmsg': 'shutdown'}],
+        ], ordered=True)
+        policy = RetryPolicy(max_retries=1, backoff=0, dead_letter=self.dead_letter)
+        result, retries = policy.send(backend, [insert(i) for i in range(3)])
+        self.assertListEqual([position for position, state in retries], [2])
+        result, retries = policy.send(backend, [insert(2)], states=[retries[0][1]])
+        self.assertListEqual(retries, [])
+        self.assertListEqual(self.dead_letters, [(insert(1), 1), (insert(2), 0)])
+        self.assertEqual(result['nDeadLettered'], 1)
+
+    def test_3(self):
+        '''without a dead letter failures left after the retry window are
+        raised by the BulkOperator'''
+        backend = FailingBackend([AutoReconnect('election')] * 1000)
+        policy = RetryPolicy(backoff=0.001, max_backoff=0.01, retry_window=0.1)
+        bulk_op = BulkOperator(backend, backend=FailingBulkBackend, retry_policy=policy)
+        futures = [bulk_op.insert({'_id': i}, future=True) for i in range(2)]
+        started = time()
+        while time() - started < 5:
+            try:
+                bulk_op.execute()
+            except BulkWriteError as e:
+                details = e.details
+                break
+            sleep(0.001)
+        self.assertGreaterEqual(time() - started, 0.1)
+        self.assertGreater(len(backend.sent), 2)
+        self.assertListEqual([error['index'] for error in details['writeErrors']], [0, 1])
+        self.assertEqual(details['nDeadLettered'], 0)
+        self.assertTrue(all(future.exception() is not None for future in futures))
+        self.assertEqual(bulk_op.execute(), {'ops': 'No ops found'})
+        self.assertRaises(ValueError, RetryPolicy, retry_window=None)
+
+    def test_4(self):
+        '''execute never waits for a retry, the failed operation is buffered
+        again and sent ahead of newer ones once its backoff passed'''
+        backend = FailingBackend([[{'index': 1, 'code': 91, 'errmsg': 'shutdown'}]])
+        policy = RetryPolicy(dead_letter=self.dead_letter)
+        policy.get_delay = lambda attempt: 0.05
+        bulk_op = BulkOperator(backend, backend=FailingBulkBackend, retry_policy=policy)
+        futures = [bulk_op.insert({'_id': i}, future=True) for i in range(2)]
+        started = time()
+        self.assertEqual(bulk_op.execute()['nRetried'], 1)
+        self.assertLess(time() - started, 0.05)
+        self.assertTrue(futures[0].done())
+        self.assertFalse(futures[1].done())
+        bulk_op.insert({'_id': 2})
+        bulk_op.execute()
+        self.assertListEqual(backend.sent[-1], [insert(2)])
+        self.assertFalse(futures[1].done())
+        sleep(0.06)
+        bulk_op.insert({'_id': 3})
+        bulk_op.execute()
+        self.assertListEqual(backend.sent[-1], [insert(1), insert(3)])
+        self.assertIsNone(futures[1].result(0))
+        self.assertEqual(bulk_op.execute(), {'ops': 'No ops found'})
+
+    def test_5(self):
+        '''an ordered BulkOperator holds newer operations behind a retry
+        which is not due'''
+        backend = FailingBackend([[{'index': 0, 'code': 91, 'errmsg': 'shutdown'}]],
+                                 ordered=True)
+        policy = RetryPolicy(dead_letter=self.dead_letter)
+        policy.get_delay = lambda attempt: 0.05
+        bulk_op = BulkOperator(backend, ordered=True, backend=FailingBulkBackend,
+                               retry_policy=policy)
+        bulk_op.insert({'_id': 0})
+        bulk_op.insert({'_id': 1})
+        self.assertEqual(bulk_op.execute()['nRetried'], 2)
+        bulk_op.insert({'_id': 2})
+        self.assertEqual(bulk_op.execute(), {'ops': 'No ops found'})
+        self.assertEqual(len(backend.sent), 1)
+        sleep(0.06)
+        bulk_op.execute()
+        self.assertListEqual(backend.sent[-1], [insert(0), insert(1), insert(2)])
@@ -0,0 +1,93 @@
+import threading
+import unittest
+from time import sleep, time
+
+from moquag import MongoQueryAggregator
+from moquag.routing import ClusterRouter
+from moquag.backends import BulkWriteBackend
+
+CLUSTERS = {'eu': {'host': 'mongodb://eu.invalid:27017'},
+            'us': {'host': 'mongodb://us.invalid:27017'}}
+
+
+class TestRouting(unittest.TestCase):
+
+    def test_1(self):
+        '''databases are routed by exact then wildcard patterns'''
+        router = ClusterRouter({'host': 'mongodb://default.invalid:27017'}, CLUSTERS,
+                               {'tenant_*': 'eu', 'tenant_us_1': 'us'})
+        self.assertEqual(router.get_cluster('tenant_us_1'), 'us')
+        self.assertEqual(router.get_cluster('tenant_2'), 'eu')
+        self.assertEqual(router.get_cluster('other'), 'default')
+        self.assertIs(router.get_database_client('tenant_2'), router.get_client('eu'))
+        self.assertIsNot(router.get_client('eu'), router.get_client('us'))
+        self.assertRaises(ValueError, router.add_route, 'x', 'asia')
+        router.close()
+
+    def test_2(self):
+        '''a cluster waiting on another one is flushed concurrently'''
+        fast_sent = threading.Event()
+        sent = []
+
+        class GatedBackend(BulkWriteBackend):
+
+            def send(self, operations, write_concern=None):
+                db_name = self.collection.database.name
+                if db_name == 'slow' and not fast_sent.wait(5):
+                    raise AssertionError('fast cluster was not flushed concurrently')
+                sent.append((db_name, len(operations)))
+                if db_name == 'fast':
+                    fast_sent.set()
+                return {'nInserted': len(operations)}
+
+        aggregator = MongoQueryAggregator({'host': 'mongodb://default.invalid:27017'},
+                                          3600, 100, backend=GatedBackend,
+                                          clusters=CLUSTERS, routes={'slow': 'eu', 'fast': 'us'})
+        aggregator.slow.coll.insert({'i': 1})
+        aggregator.fast.coll.insert({'i': 2})
+        aggregator.fast.coll.insert({'i': 3})
+        aggregator.execute()
+        self.assertEqual(sent, [('fast', 2), ('slow', 1)])
+        self.assertEqual(aggregator.get_results()[('slow', 'coll')]['nInserted'], 1)
+
+    def test_3(self):
+        '''background flushes keep flushing other clusters while one is stuck'''
+        release = threading.Event()
+        sent = []
+
+        class StuckBackend(BulkWriteBackend):
+
+            def send(self, operations, write_concern=None):
+                db_name = self.collection.database.name
+                if db_name == 'slow':
+                    release.wait(5)
+                sent.append((db_name, len(operations)))
+                return {'nInserted': len(operations)}
+
+        def wait_sent(count):
+            deadline = time() + 5
+            while len([db_name for db_name, _ in sent if db_name == 'fast']) < count and \
+                    time() < deadline:
+                sleep(0.01)
+
+        for max_workers in (None, 2):
+            del sent[:]
+            release.clear()
+            aggregator = MongoQueryAggregator({'host': 'mongodb://default.invalid:27017'},
+                                              0.01, 100, backend=StuckBackend,
+                                              background_flush=True, max_workers=max_workers,
+                                              clusters=CLUSTERS, routes={'slow': 'eu', 'fast': 'us'})
+            aggregator.slow.coll.insert({'i': 1})
+            aggregator.fast.coll.insert({'i': 2})
+            wait_sent(1)
+            aggregator.fast.coll.insert({'i': 3})
+            wait_sent(2)
+            self.assertEqual(sent, [('fast', 1), ('fast', 1)])
+            release.set()
+            aggregator.stop_scheduler()
+            self.assertEqual(sorted(sent), [('fast', 1), ('fast', 1), ('slow', 1)])
+        self.assertRaises(ValueError, ClusterRouter, {}, {'default': {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import time
+from pymongo import MongoClient
+from moquag import MongoQueryAggregator
+from .settings import MONGO_DB_SETTINGS, logger
+from .helpers import count_documents
+from collections import Counter
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = MongoClient(**MONGO_DB_SETTINGS)
+        self.conn.drop_database('testdb1')
+
+    def test_1(self):
+        '''inserting 2 documents with background flush, docs should be
+        flushed after interval without any new traffic'''
+        mongo_agg = MongoQueryAggregator(MONGO_DB_SETTINGS, 0.1, 10, background_flush=True)
+        mongo_agg.testdb1.profiles.insert({'name': 'User1', 'id': 1})
+        mongo_agg.testdb1.profiles.insert({'name': 'User2', 'id': 2})
+        self.assertEqual(count_documents(self.conn['testdb1'].profiles), 0)
+        time.sleep(0.3)
+        self.assertEqual(count_documents(self.conn['testdb1'].profiles), 2)
+        mongo_agg.stop_scheduler()
+        aggregators_expected_results = {
+            ('testdb1', 'profiles'): Counter({'nInserted': 2})
+        }
+        self.assertEqual(aggregators_expected_results, mongo_agg.get_results())
+
+    def test_2(self):
+        '''inserting 6 documents with max_ops_limit=5, first five docs
+        are flushed by scheduler and last one on stop_scheduler'''
+        mongo_agg = MongoQueryAggregator(MONGO_DB_SETTINGS, 10, 5)
+        mongo_agg.start_scheduler()
+        for i in range(6):
+            mongo_agg.testdb1.profiles.insert({'id': i})
+        time.sleep(0.1)
+        self.assertEqual(count_documents(self.conn['testdb1'].profiles), 5)
+        mongo_agg.stop_scheduler()
+        self.assertEqual(count_documents(self.conn['testdb1'].profiles), 6)
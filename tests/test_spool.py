@@ -0,0 +1,123 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from moquag import MongoQueryAggregator
+from moquag.main import BulkOperator
+from moquag.backends import BulkWriteBackend
+from moquag.spool import Spool
+from benchmarks.fake import FakeMongo
+from .settings import MONGO_DB_SETTINGS, logger
+
+
+class FailingBackend(BulkWriteBackend):
+    '''backend failing the operations of the writeErrors set on the class'''
+    write_errors = []
+
+    def send(self, operations, write_concern=None):
+        raise BulkWriteError({'nUpserted': len(operations) - len(self.write_errors),
+                              'writeErrors': self.write_errors, 'upserted': []})
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_1(self):
+        '''writing and reading back a segment, a record cut by a crash is ignored'''
+        spool = Spool(self.spool_dir, fsync_interval=0)
+        segment = spool.open_segment('testdb1', 'profiles')
+        segment.append('insert', {'_id': 1, 'id': 1})
+        segment.append('update_one', {'id': 1}, {'$set': {'name': 'new1'}}, True)
+        segment.close()
+        with open(segment.path, 'ab') as segment_file:
+            segment_file.write(b'\x40\x00\x00\x00\x02op')
+        self.assertListEqual(spool.get_segment_paths(), [segment.path])
+        db_name, collection, records = spool.read_segment(segment.path)
+        self.assertEqual((db_name, collection), ('testdb1', 'profiles'))
+        self.assertListEqual(records, [
+            {'op': 'insert', 's': {'_id': 1, 'id': 1}, 'u': False},
+            {'op': 'update_one', 's': {'id': 1}, 'd': {'$set': {'name': 'new1'}}, 'u': True}
+        ])
+        segment.remove()
+        self.assertListEqual(spool.get_segment_paths(), [])
+
+    def test_2(self):
+        '''operations spooled by an aggregator which never flushed are
+        replayed by the next aggregator using the same spool'''
+        conn = MongoClient(**MONGO_DB_SETTINGS)
+        conn.drop_database('testdb1')
+        segment = Spool(self.spool_dir).open_segment('testdb1', 'profiles')
+        segment.append('insert', {'_id': 1, 'id': 1})
+        segment.append('update_one', {'id': 2}, {'$set': {'name': 'new2'}}, True)
+        segment.close()
+
+        mongo_agg = MongoQueryAggregator(MONGO_DB_SETTINGS, 1, 50, spool_dir=self.spool_dir)
+        self.assertEqual(mongo_agg.get_buffered_query_count(),
+                         {('profiles', 'testdb1'): {'insert': 1, 'find': 1, 'remove': 0}})
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+        mongo_agg.execute()
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        data = list(conn['testdb1'].profiles.find({}, {'_id': 0}).sort([('id', 1)]))
+        self.assertListEqual(data, [{'id': 1}, {'id': 2, 'name': 'new2'}])
+
+    def test_3(self):
+        '''the last records of a burst are synced by the spool thread'''
+        spool = Spool(self.spool_dir, fsync_interval=0.05)
+        with mock.patch('moquag.spool.os.fsync') as fsync:
+            segment = spool.open_segment('testdb1', 'profiles')
+            for i in range(3):
+                segment.append('insert', {'_id': i})
+            self.assertEqual(fsync.call_count, 0)
+            time.sleep(0.2)
+            self.assertEqual(fsync.call_count, 1)
+            segment.append('insert', {'_id': 3})
+            spool.close()
+            self.assertEqual(fsync.call_count, 2)
+            segment.remove()
+
+    def test_4(self):
+        '''a partially failed batch keeps only the operations to replay'''
+        spool = Spool(self.spool_dir, fsync_interval=None)
+        collection = FakeMongo()['testdb1']['counts']
+        for ordered, write_errors, replayed in [
+                (False, [{'index': 1, 'code': 11000, 'errmsg': 'dup'}], []),
+                (False, [{'index': 1, 'code': 11000, 'errmsg': 'dup'},
+                         {'index': 3, 'code': 91, 'errmsg': 'shutdown'}], [3]),
+                (True, [{'index': 2, 'code': 11000, 'errmsg': 'dup'}], [3, 4])]:
+            FailingBackend.write_errors = write_errors
+            bulk_operator = BulkOperator(collection, ordered, backend=FailingBackend,
+                                         spool=spool)
+            for i in range(5):
+                bulk_operator.find({'id': i}).upsert().update_one({'$inc': {'n': 1}})
+            self.assertRaises(BulkWriteError, bulk_operator.execute)
+            paths = spool.get_segment_paths()
+            records = [spool.read_segment(path)[2] for path in paths]
+            self.assertEqual(records, [[{'op': 'update_one', 's': {'id': i},
+                                         'd': {'$inc': {'n': 1}}, 'u': True}
+                                        for i in replayed]] if replayed else [])
+            for path in paths:
+                os.remove(path)
+
+    def test_5(self):
+        '''a failed periodic sync is logged and the syncer keeps running'''
+        spool = Spool(self.spool_dir, fsync_interval=0.05)
+        with mock.patch('moquag.spool.os.fsync', side_effect=[OSError('full'), None]) as fsync, \
+                mock.patch('moquag.scheduler.sys.stderr') as stderr:
+            segment = spool.open_segment('testdb1', 'profiles')
+            segment.append('insert', {'_id': 1})
+            time.sleep(0.2)
+            segment.append('insert', {'_id': 2})
+            time.sleep(0.2)
+            self.assertEqual(fsync.call_count, 2)
+            self.assertIn('moquag-spool-syncer', stderr.write.call_args[0][0])
+            spool.close()
+            segment.remove()
@@ -0,0 +1,100 @@
+import threading
+import unittest
+
+from moquag import MongoQueryAggregator
+from moquag.locks import LockStripes
+from benchmarks.fake import FakeMongo
+
+
+class TestThreads(unittest.TestCase):
+
+    def test_1(self):
+        '''every collection gets the same lock of the stripes'''
+        locks = LockStripes(4)
+        self.assertIs(locks.get('db', 'coll'), locks.get('db', 'coll'))
+        self.assertEqual(len(set(locks.get('db', str(i)) for i in range(100))), 4)
+
+    def test_2(self):
+        '''concurrent producers and flushes neither lose nor double send ops'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 50, backend=mongo, thread_safe=True)
+        stopped = threading.Event()
+
+        def produce(thread):
+            # a held BulkOperator is sealed by flushes, its ops are redirected
+            held = aggregator.db['coll{}'.format(thread % 3)]
+            for i in range(2000):
+                if i % 2:
+                    held.insert({'i': i})
+                else:
+                    aggregator.db['coll{}'.format(thread % 3)].find({'i': i}).update_one(
+                        {'$set': {'thread': thread}})
+
+        def flush():
+            while not stopped.is_set():
+                aggregator.execute()
+
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+        producers = [threading.Thread(target=produce, args=(thread,)) for thread in range(6)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        stopped.set()
+        flusher.join()
+        aggregator.execute()
+        self.assertEqual(mongo.written_ops, 12000)
+        results = aggregator.get_results()
+        self.assertEqual(sum(results[('db', 'coll{}'.format(i))]['nInserted'] for i in range(3)),
+                         6000)
+        self.assertEqual(aggregator.get_buffered_query_count(), {})
+
+    def test_3(self):
+        '''background flushes racing producers neither lose nor double send ops'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 0.001, 50, backend=mongo, background_flush=True)
+
+        def produce(thread):
+            for i in range(5000):
+                aggregator.db['coll{}'.format(thread % 2)].insert({'i': i})
+
+        producers = [threading.Thread(target=produce, args=(thread,)) for thread in range(4)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        aggregator.stop_scheduler()
+        self.assertEqual(mongo.written_ops, 20000)
+
+    def test_4(self):
+        '''callbacks of dropped operations run without the lock and may enqueue'''
+        mongo = FakeMongo()
+        aggregator = MongoQueryAggregator({}, 3600, 100, backend=mongo, thread_safe=True,
+                                          dedupe_key='_id', max_buffered_ops=2,
+                                          overflow_policy='drop_oldest')
+        dropped = []
+
+        def requeue(future):
+            dropped.append(future.exception())
+            aggregator.db.coll.insert({'_id': 'requeued-{}'.format(len(dropped))})
+
+        def produce():
+            aggregator.db.coll.insert({'_id': 1}, callback=requeue)
+            aggregator.db.coll.insert({'_id': 1}, callback=requeue)
+            aggregator.db.coll.insert({'_id': 2})
+            aggregator.db.coll.insert({'_id': 3})
+
+        producer = threading.Thread(target=produce)
+        # a deadlocked producer must not keep the tests running
+        producer.daemon = True
+        producer.start()
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(len(dropped), 2)
+        self.assertIsNone(dropped[0])
+        self.assertIsNotNone(dropped[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
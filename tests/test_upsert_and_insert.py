@@ -172,9 +172,9 @@ class TestBulk(unittest.TestCase):
             for search_query, update_query in data:
                 mongo_agg[db_name][collection_name].find(search_query).upsert().update({'$set': update_query})
         expected_query_count = {
-            ('events', 'testdb2'): {'insert': 1, 'find': 1},
-            ('profiles', 'testdb1'): {'insert': 2, 'find': 1},
-            ('users_details', 'testdb3'): {'insert': 3, 'find': 2}
+            ('events', 'testdb2'): {'insert': 1, 'find': 1, 'remove': 0},
+            ('profiles', 'testdb1'): {'insert': 2, 'find': 1, 'remove': 0},
+            ('users_details', 'testdb3'): {'insert': 3, 'find': 2, 'remove': 0}
         }
         query_count = mongo_agg.get_buffered_query_count()
         self.assertEqual(expected_query_count, query_count)
@@ -204,9 +204,9 @@ class TestBulk(unittest.TestCase):
             for search_query, update_query in data:
                 mongo_agg[db_name][collection_name].find(search_query).upsert().update({'$set': update_query})
         expected_query_count = {
-            ('events', 'testdb1'): {'insert': 1, 'find': 1},
-            ('profiles', 'testdb1'): {'insert': 2, 'find': 1},
-            ('users_details', 'testdb3'): {'insert': 3, 'find': 2}
+            ('events', 'testdb1'): {'insert': 1, 'find': 1, 'remove': 0},
+            ('profiles', 'testdb1'): {'insert': 2, 'find': 1, 'remove': 0},
+            ('users_details', 'testdb3'): {'insert': 3, 'find': 2, 'remove': 0}
         }
         query_count = mongo_agg.get_buffered_query_count()
         self.assertEqual(expected_query_count, query_count)
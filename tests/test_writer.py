@@ -0,0 +1,38 @@
+import unittest
+
+from moquag import MongoQueryAggregator
+from benchmarks.fake import FakeMongo
+
+
+class TestWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.mongo = FakeMongo()
+        self.aggregator = MongoQueryAggregator({}, 3600, 10, backend=self.mongo)
+
+    def test_1(self):
+        '''handles are cached and flush at max_ops_limit'''
+        writer = self.aggregator.collection('db', 'coll', check_every=4)
+        self.assertIs(writer, self.aggregator.collection('db', 'coll'))
+        for i in range(25):
+            writer.insert({'i': i})
+        self.assertEqual([write['ops'] for write in self.mongo.recent_writes], [10, 10])
+        writer.find({'i': 1}).upsert().update_one({'$set': {'x': 1}})
+        self.assertEqual(self.aggregator.get_buffered_query_count(),
+                         {('coll', 'db'): {'insert': 5, 'find': 1, 'remove': 0}})
+
+    def test_2(self):
+        '''batch calls survive flushes of the aggregator'''
+        writer = self.aggregator.collection('db', 'coll')
+        writer.insert_many({'i': i} for i in range(15))
+        self.aggregator.execute()
+        writer.update_many([({'i': i}, {'$inc': {'n': 1}}) for i in range(3)], upsert=True)
+        writer.write_many([('insert', {'i': 20}, None, False),
+                           ('remove', {'i': 0}, None, False)])
+        self.aggregator.execute()
+        self.assertEqual([write['ops'] for write in self.mongo.recent_writes], [10, 5, 5])
+        self.assertEqual(self.mongo.written_ops, 20)
+
+
+if __name__ == '__main__':
+    unittest.main()